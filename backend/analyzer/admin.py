@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import AnalysisJob
+
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'model_type', 'status', 'progress', 'input_name', 'created_at')
+    list_filter = ('status', 'kind', 'model_type')
+    readonly_fields = ('result',)
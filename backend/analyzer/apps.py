@@ -1,6 +1,31 @@
+import multiprocessing
+import os
+import sys
+
 from django.apps import AppConfig
 
 
 class AnalyzerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'analyzer'
+
+    def ready(self):
+        # Opt-in: only when MODEL_PRELOAD lists model keys
+        if not os.getenv('MODEL_PRELOAD'):
+            return
+
+        # Skip the job pool's worker processes: they run django.setup() with the web process's
+        # argv and environment, and load only the model a job needs
+        if multiprocessing.parent_process() is not None:
+            return
+
+        # Skip management commands (migrate, shell, ...) and the runserver autoreload parent
+        if sys.argv and os.path.basename(sys.argv[0]) == 'manage.py':
+            command = sys.argv[1] if len(sys.argv) > 1 else ''
+            if command != 'runserver':
+                return
+            if '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+                return
+
+        from .warmup import start_warmup
+        start_warmup()
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .formats import FORMAT_JSON, negotiate_format, render_predict_response, sse_event
+from .llm import GeminiNotConfigured, agenerate, agenerate_report, astream_chat, chat_prompt, get_model
+from .model_loader import ModelLoader
+from .pipeline import segment, build_predict_result, build_mitigate_result
+from .views import CHAT_ERROR_REPLY
+
+
+# --- ASYNC VIEW CONFIGURATION ---
+# Threads running upload parsing, inference and encoding for the async views. This bounds
+# how much CPU-bound work is in flight; LLM calls stay on the event loop and are not limited.
+INFERENCE_EXECUTOR_WORKERS = int(os.getenv('INFERENCE_EXECUTOR_WORKERS', '4'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=INFERENCE_EXECUTOR_WORKERS, thread_name_prefix='inference')
+        return _executor
+
+
+async def run_in_executor(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), fn, *args)
+
+
+def _flag(request, name):
+    """Reads a boolean form field or query parameter ('1', 'true', 'yes')."""
+    value = request.POST.get(name, request.GET.get(name, ''))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def _json_body(request):
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return {}
+
+
+def _segment_request(request, kind):
+    """
+    Everything CPU-bound for /predict/ and /mitigate/: multipart parsing, inference and
+    encoding. Runs on the executor thread and returns the finished HttpResponse.
+    """
+    # Executor threads outlive requests, so they close their database connection (result
+    # store lookups) around each one, as Django does for request threads
+    close_old_connections()
+    try:
+        return _segment_response(request, kind)
+    finally:
+        close_old_connections()
+
+
+def _segment_response(request, kind):
+    file_obj = request.FILES.get('file')
+    model_type = request.POST.get('model_type', 'v2')  # Default to v2
+
+    if not file_obj:
+        return JsonResponse({'error': 'No file provided'}, status=400)
+
+    output_format = FORMAT_JSON
+    if kind == 'predict':
+        try:
+            output_format = negotiate_format(request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        model = ModelLoader().load_model(model_type)
+        if not model:
+            return JsonResponse({'error': f'Model {model_type} not loaded'}, status=503)
+
+        input_tensor, processed, _ = segment(file_obj, model_type, tiled=_flag(request, 'tiled'))
+
+        if kind == 'mitigate':
+            return JsonResponse(build_mitigate_result(input_tensor, processed, model_type))
+        if output_format != FORMAT_JSON:
+            return render_predict_response(output_format, input_tensor, processed, model_type)
+        return JsonResponse(build_predict_result(input_tensor, processed, model_type))
+
+    except Exception as e:
+        print(f"Prediction Error: {e}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncPredictView(View):
+    """Async counterpart of PredictView; inference runs on the bounded executor."""
+
+    async def post(self, request, *args, **kwargs):
+        return await run_in_executor(_segment_request, request, 'predict')
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncMitigateView(View):
+    async def post(self, request, *args, **kwargs):
+        return await run_in_executor(_segment_request, request, 'mitigate')
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncGeminiAnalysisView(View):
+    async def get(self, request, *args, **kwargs):
+        return JsonResponse({'status': 'Gemini Analysis Endpoint Ready. Send POST request with class percentages.'})
+
+    async def post(self, request, *args, **kwargs):
+        percentages = _json_body(request).get('percentages')
+        if not percentages:
+            return JsonResponse({'error': 'No percentages provided'}, status=400)
+        if not isinstance(percentages, dict):
+            return JsonResponse({'error': 'percentages must be an object of class names and values'}, status=400)
+
+        try:
+            return JsonResponse({'analysis': await agenerate_report(percentages)})
+
+        except GeminiNotConfigured as e:
+            return JsonResponse({'error': str(e)}, status=503)
+        except Exception as e:
+            print(f"Gemini API Error: {e}")
+            # Return the actual error to the frontend for debugging
+            return JsonResponse({'analysis': f"AI Analysis Error: {str(e)}"})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    async def post(self, request, *args, **kwargs):
+        body = _json_body(request)
+        message = body.get('message')
+        metrics = body.get('image_metrics')
+
+        if not message:
+            return JsonResponse({'error': 'No message provided'}, status=400)
+
+        try:
+            return JsonResponse({'reply': await agenerate(chat_prompt(message, metrics))})
+
+        except GeminiNotConfigured as e:
+            return JsonResponse({'error': str(e)}, status=503)
+        except Exception as e:
+            print(f"Chat Error: {e}")
+            return JsonResponse({'reply': CHAT_ERROR_REPLY})
+
+
+async def _chat_events(chunks):
+    """
+    SSE framing for astream_chat. Django cancels the response task when the client
+    disconnects; the CancelledError unwinds through here and closes the Gemini stream.
+    """
+    try:
+        async for text in chunks:
+            yield sse_event('token', {'text': text})
+        yield sse_event('done', {})
+    except Exception as e:
+        print(f"Chat Stream Error: {e}")
+        yield sse_event('error', {'reply': CHAT_ERROR_REPLY})
+    finally:
+        await chunks.aclose()
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatStreamView(View):
+    async def post(self, request, *args, **kwargs):
+        body = _json_body(request)
+        message = body.get('message')
+        metrics = body.get('image_metrics')
+
+        if not message:
+            return JsonResponse({'error': 'No message provided'}, status=400)
+
+        try:
+            model = get_model()
+        except GeminiNotConfigured as e:
+            return JsonResponse({'error': str(e)}, status=503)
+
+        response = StreamingHttpResponse(_chat_events(astream_chat(chat_prompt(message, metrics), model)),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
@@ -0,0 +1,265 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .batching import MAX_BATCH_SIZE
+from .cache import prediction_cache
+from .formats import rle_encode, predict_metadata
+from .metrics import model_context, segmentations_total, stage_timer
+from .result_store import result_store
+from .pipeline import build_predict_result, class_percentages, predict_masks, predict_scene_indices, preprocess_for_model, segment_cache_key
+from .tiling import TILE_SIZE
+from .utils import postprocess_indices
+
+
+# --- BATCH PREDICTION CONFIGURATION ---
+# Upper bound on files per request, counting archive members
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '500'))
+# Archive members larger than this (uncompressed) are reported as errors instead of being read
+BATCH_MAX_MEMBER_MB = int(os.getenv('BATCH_MAX_MEMBER_MB', '64'))
+BATCH_PREPROCESS_WORKERS = int(os.getenv('BATCH_PREPROCESS_WORKERS', '4'))
+# Files stacked into one model.predict call (defaults to the micro-batcher's batch size)
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', str(MAX_BATCH_SIZE)))
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp', '.npy')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# Per-file output: the full /predict/ body, metadata plus a run-length mask, or metadata only
+OUTPUT_JSON = 'json'
+OUTPUT_RLE = 'rle'
+OUTPUT_SUMMARY = 'summary'
+OUTPUTS = (OUTPUT_JSON, OUTPUT_RLE, OUTPUT_SUMMARY)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=BATCH_PREPROCESS_WORKERS, thread_name_prefix='batch-preprocess')
+        return _executor
+
+
+class BatchError(Exception):
+    """A single file of the batch could not be read; reported on its own NDJSON line."""
+
+
+def _member(name, payload):
+    file_obj = io.BytesIO(payload)
+    file_obj.name = name
+    return file_obj
+
+
+def _is_image(name):
+    base = os.path.basename(name)
+    return not base.startswith('.') and base.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _zip_members(upload):
+    with zipfile.ZipFile(upload) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or info.filename.startswith('__MACOSX/') or not _is_image(info.filename):
+                continue
+            if info.file_size > BATCH_MAX_MEMBER_MB * 1024 * 1024:
+                yield info.filename, BatchError(f"Larger than {BATCH_MAX_MEMBER_MB} MB")
+                continue
+            yield info.filename, _member(info.filename, archive.read(info))
+
+
+def _tar_members(upload):
+    with tarfile.open(fileobj=upload, mode='r:*') as archive:
+        for info in archive:
+            if not info.isfile() or not _is_image(info.name):
+                continue
+            if info.size > BATCH_MAX_MEMBER_MB * 1024 * 1024:
+                yield info.name, BatchError(f"Larger than {BATCH_MAX_MEMBER_MB} MB")
+                continue
+            yield info.name, _member(info.name, archive.extractfile(info).read())
+
+
+def iter_files(uploads):
+    """
+    Yields (filename, file object or BatchError) for every uploaded image, expanding
+    .zip and .tar(.gz/.bz2/.xz) uploads into their image members. Members are read
+    lazily, so a large archive is never extracted in full.
+    """
+    count = 0
+    for upload in uploads:
+        name = getattr(upload, 'name', '') or ''
+        lowered = name.lower()
+        if lowered.endswith(ARCHIVE_EXTENSIONS):
+            members = _zip_members(upload) if lowered.endswith('.zip') else _tar_members(upload)
+        else:
+            members = iter([(name, upload)])
+
+        try:
+            for member in members:
+                count += 1
+                if count > BATCH_MAX_FILES:
+                    yield member[0], BatchError(f"Batch limit of {BATCH_MAX_FILES} files reached; the rest were skipped")
+                    return
+                yield member
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            yield name, BatchError(f"Unreadable archive: {e}")
+
+
+def _prepare(file_obj, model_type, output):
+    """
+    Runs on the preprocessing pool: cache lookup, else a result store lookup plus the model's
+    preprocessing. Returns (key, input_tensor, processed or None, origin). Store hits skip
+    preprocessing (input_tensor None) unless the json output needs the preview.
+    """
+    # Pool threads outlive requests, so they close their database connection (result store
+    # lookups) around each file, as Django does for request threads
+    close_old_connections()
+    try:
+        return _prepare_file(file_obj, model_type, output)
+    finally:
+        close_old_connections()
+
+
+def _prepare_file(file_obj, model_type, output):
+    with model_context(model_type):
+        key = segment_cache_key(file_obj, model_type)
+        cached = prediction_cache.get(key)
+        if cached is not None:
+            segmentations_total.inc(model_type, 'hit')
+            return key, cached[0], cached[1], 'cache'
+        stored = result_store.load(key)
+        segmentations_total.inc(model_type, 'miss' if stored is None else 'store')
+        if stored is not None and output != OUTPUT_JSON:
+            return key, None, stored, 'store'
+        with stage_timer('preprocess'):
+            return key, preprocess_for_model(file_obj, model_type), stored, None if stored is None else 'store'
+
+
+def _render(item, model_type, output):
+    processed = item['processed']
+    if output == OUTPUT_JSON:
+        # Stores the encoded images with the entry, or reuses them on store and cache hits
+        return build_predict_result(item['input_tensor'], processed, model_type,
+                                    key=item['key'], fresh=item['origin'] is None)
+    result = predict_metadata(processed, model_type)
+    if output == OUTPUT_RLE:
+        result['mask_rle'] = rle_encode(processed.mask)
+    return result
+
+
+def _infer(prepared, model_type):
+    """
+    Runs every uncached 256x256 tensor of a chunk in one stacked forward pass; other sizes
+    (large .npy scenes) get tiled inference on their own. Fills in processed in place and
+    records new results in the prediction cache and result store.
+    """
+    stacked = [item for item in prepared if item['processed'] is None and
+               item['input_tensor'].shape[1:3] == (TILE_SIZE, TILE_SIZE)]
+    if stacked:
+        try:
+            outputs = predict_masks([item['input_tensor'] for item in stacked], model_type)
+        except Exception as e:
+            outputs = [e] * len(stacked)
+        for item, processed in zip(stacked, outputs):
+            item['processed'] = processed
+
+    for item in prepared:
+        if item['processed'] is None:
+            try:
+                raw_mask = predict_scene_indices(item['input_tensor'][0], model_type)
+                with stage_timer('postprocess'):
+                    item['processed'] = postprocess_indices(raw_mask)
+            except Exception as e:
+                item['processed'] = e
+        if isinstance(item['processed'], Exception):
+            continue
+        if item['origin'] is None:
+            result_store.save(item['key'], item['processed'], class_percentages(item['processed'].counts),
+                              model_type, input_name=item['result']['filename'])
+        # Store hits without a tensor stay out of the cache: /mitigate/ needs the input
+        if item['origin'] != 'cache' and item['input_tensor'] is not None:
+            prediction_cache.put(item['key'], (item['input_tensor'], item['processed']))
+
+
+def _run_chunk(chunk, model_type, output):
+    """Waits for a chunk's preprocessing, runs inference and returns its per-file results in order."""
+    results, prepared = [], []
+    for index, filename, future in chunk:
+        result = {'index': index, 'filename': filename, 'status': 'ok'}
+        try:
+            if isinstance(future, BatchError):
+                raise future
+            key, input_tensor, processed, origin = future.result()
+            prepared.append(dict(result=result, key=key, input_tensor=input_tensor,
+                                 processed=processed, origin=origin))
+        except Exception as e:
+            result['error'] = e
+        results.append(result)
+
+    with model_context(model_type):
+        _infer(prepared, model_type)
+
+    for item in prepared:
+        if isinstance(item['processed'], Exception):
+            item['result']['error'] = item['processed']
+        else:
+            try:
+                item['result'].update(_render(item, model_type, output))
+            except Exception as e:
+                item['result']['error'] = e
+
+    for result in results:
+        if 'error' in result:
+            print(f"Batch Prediction Error ({result['filename']}): {result['error']}")
+            result['status'] = 'error'
+            result['error'] = str(result['error'])
+    return results
+
+
+def stream_predictions(uploads, model_type, output=OUTPUT_JSON):
+    """
+    Generator of NDJSON lines, one per file in upload/archive order, then a summary line
+    ({"done": true, ...}). Files are preprocessed in parallel on a thread pool while the
+    previous chunk of BATCH_CHUNK_SIZE runs through the model, so at most two chunks of
+    tensors are held at once.
+    """
+    started = time.perf_counter()
+    chunk_size = max(1, BATCH_CHUNK_SIZE)
+    pending = deque()
+    counts = {'ok': 0, 'error': 0}
+
+    def drain(limit):
+        chunk = [pending.popleft() for _ in range(min(limit, len(pending)))]
+        results = _run_chunk(chunk, model_type, output)
+        for result in results:
+            counts[result['status']] += 1
+        return [json.dumps(result) + '\n' for result in results]
+
+    for index, (filename, file_obj) in enumerate(iter_files(uploads)):
+        if isinstance(file_obj, BatchError):
+            prepared = file_obj
+        else:
+            prepared = get_executor().submit(_prepare, file_obj, model_type, output)
+        pending.append((index, filename, prepared))
+        if len(pending) >= 2 * chunk_size:
+            yield from drain(chunk_size)
+
+    while pending:
+        yield from drain(chunk_size)
+
+    yield json.dumps({
+        'done': True,
+        'files': counts['ok'] + counts['error'],
+        'succeeded': counts['ok'],
+        'failed': counts['error'],
+        'elapsed_ms': (time.perf_counter() - started) * 1000.0,
+    }) + '\n'
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from . import inference_server
+from .metrics import observe_stage, registry
+from .profiling import active_session, profile_call, suspend_profile
+
+
+# --- MICRO-BATCHING CONFIGURATION ---
+# Requests are held for at most INFERENCE_MAX_WAIT_MS (or until INFERENCE_MAX_BATCH_SIZE
+# rows are pending) and then run as a single forward pass.
+MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', '8'))
+MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', '10'))
+
+
+class _PendingRequest:
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.rows = tensor.shape[0]
+        self.enqueued_at = time.perf_counter()
+        # Profiling session of the submitting request, if it is being profiled
+        self.profile = active_session.get()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects pending (N, 256, 256, 8) tensors for one model and runs them
+    as a single batched predict call. Each caller gets back its own slice.
+
+    Only tensors with the same per-sample shape are stacked together, so
+    odd-sized .npy uploads simply run in a batch of their own.
+    """
+
+    def __init__(self, model_key, predict_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model_key = model_key
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+
+        # Counters
+        self._stats_lock = threading.Lock()
+        self.batches_run = 0
+        self.requests_served = 0
+        self.rows_served = 0
+        self.batch_size_histogram = {}
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def predict(self, input_tensor):
+        """Blocking call: enqueue the tensor and wait for its slice of the batch output."""
+        request = _PendingRequest(np.asarray(input_tensor, dtype=np.float32))
+        with self._cond:
+            self._ensure_worker()
+            self._queue.append(request)
+            self._cond.notify()
+
+        with suspend_profile(request.profile):
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(r.rows for r in self._queue)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._run, name=f"batcher-{self.model_key}", daemon=True
+            )
+            self._worker.start()
+
+    def _collect_batch(self):
+        """Waits for the first request, then keeps collecting until the batch is full or max-wait expires."""
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+
+            first = self._queue.popleft()
+            batch = [first]
+            rows = first.rows
+            sample_shape = first.tensor.shape[1:]
+            deadline = first.enqueued_at + self.max_wait
+
+            while rows < self.max_batch_size:
+                # Take whatever compatible work is already queued
+                taken = False
+                for request in list(self._queue):
+                    if request.tensor.shape[1:] == sample_shape and rows + request.rows <= self.max_batch_size:
+                        self._queue.remove(request)
+                        batch.append(request)
+                        rows += request.rows
+                        taken = True
+                if rows >= self.max_batch_size:
+                    break
+
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                if not taken:
+                    self._cond.wait(timeout=remaining)
+
+            return batch, rows
+
+    def _run(self):
+        while True:
+            batch, rows = self._collect_batch()
+            started = time.perf_counter()
+
+            try:
+                if len(batch) == 1:
+                    stacked = batch[0].tensor
+                else:
+                    stacked = np.concatenate([r.tensor for r in batch], axis=0)
+                sessions = [r.profile for r in batch if r.profile is not None]
+                if sessions:
+                    output = profile_call(sessions, self.predict_fn, stacked)
+                else:
+                    output = self.predict_fn(stacked)
+                observe_stage('inference', self.model_key, time.perf_counter() - started)
+
+                offset = 0
+                for request in batch:
+                    request.result = output[offset:offset + request.rows]
+                    offset += request.rows
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            self._record(batch, rows, started)
+            for request in batch:
+                request.done.set()
+
+    def _record(self, batch, rows, started):
+        with self._stats_lock:
+            self.batches_run += 1
+            self.requests_served += len(batch)
+            self.rows_served += rows
+            self.batch_size_histogram[rows] = self.batch_size_histogram.get(rows, 0) + 1
+            for request in batch:
+                wait = started - request.enqueued_at
+                observe_stage('queue_wait', self.model_key, wait)
+                self.total_queue_wait += wait
+                self.max_queue_wait = max(self.max_queue_wait, wait)
+
+    def stats(self):
+        with self._stats_lock:
+            served = self.requests_served
+            return {
+                'model_key': self.model_key,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches_run': self.batches_run,
+                'requests_served': served,
+                'rows_served': self.rows_served,
+                'mean_batch_size': (self.rows_served / self.batches_run) if self.batches_run else 0.0,
+                'batch_size_histogram': dict(sorted(self.batch_size_histogram.items())),
+                'mean_queue_wait_ms': (self.total_queue_wait / served * 1000.0) if served else 0.0,
+                'max_queue_wait_ms': self.max_queue_wait * 1000.0,
+                'queue_depth': self.queue_depth(),
+            }
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_key):
+    """Returns the shared MicroBatcher for a model key, creating it on first use."""
+    with _batchers_lock:
+        batcher = _batchers.get(model_key)
+        if batcher is None:
+            # Imported here so the batching module stays free of TensorFlow at import time
+            from .model_loader import ModelLoader
+
+            def predict_fn(batch, _key=model_key):
+                model = ModelLoader().load_model(_key)
+                if model is None:
+                    raise RuntimeError(f"Model {_key} not loaded")
+                return model.predict(batch, verbose=0)
+
+            # With an inference server the batching happens there, across all workers;
+            # waiting here as well would only add latency
+            max_wait_ms = 0 if inference_server.INFERENCE_SERVER_SOCKET else MAX_WAIT_MS
+            batcher = MicroBatcher(model_key, predict_fn, max_wait_ms=max_wait_ms)
+            _batchers[model_key] = batcher
+        return batcher
+
+
+@registry.collector
+def _batching_metrics():
+    stats = batching_stats()
+    yield ('cloudvision_batch_queue_depth', 'gauge', 'Rows waiting for the micro-batcher.',
+           [({'model': key}, s['queue_depth']) for key, s in stats.items()])
+    yield ('cloudvision_batches_total', 'counter', 'Batched forward passes run.',
+           [({'model': key}, s['batches_run']) for key, s in stats.items()])
+    yield ('cloudvision_batch_rows_total', 'counter', 'Rows run through the model.',
+           [({'model': key}, s['rows_served']) for key, s in stats.items()])
+
+
+def batching_stats():
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    return {b.model_key: b.stats() for b in batchers}
@@ -0,0 +1,97 @@
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def time_callable(fn, repeat=20, warmup=2):
+    """Runs fn() warmup + repeat times and returns timing statistics in milliseconds."""
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000.0)
+
+    return {
+        'runs': repeat,
+        'mean_ms': float(np.mean(timings)),
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'min_ms': float(np.min(timings)),
+    }
+
+
+def synthetic_prediction(size, num_classes=5, seed=0):
+    """Random (1, size, size, num_classes) softmax-like scores."""
+    rng = np.random.default_rng(seed)
+    return rng.random((1, size, size, num_classes), dtype=np.float32)
+
+
+def synthetic_image(size, seed=0):
+    """Deterministic (size, size, 3) uint8 scene: smooth gradients plus noise, so codecs do real work."""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    base = np.stack([
+        np.add.outer(ramp, ramp) / 2,
+        np.tile(ramp, (size, 1)),
+        np.tile(ramp[:, None], (1, size)),
+    ], axis=-1)
+    noise = rng.normal(0, 20, (size, size, 3))
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_upload(fmt, size, seed=0):
+    """Returns (filename, bytes, content_type) for a synthetic png, jpeg or npy upload."""
+    buffer = io.BytesIO()
+    if fmt == 'npy':
+        rng = np.random.default_rng(seed)
+        np.save(buffer, rng.random((size, size, 8), dtype=np.float32))
+        return f'scene_{size}.npy', buffer.getvalue(), 'application/octet-stream'
+
+    pil_format = {'png': 'PNG', 'jpeg': 'JPEG', 'jpg': 'JPEG'}[fmt]
+    Image.fromarray(synthetic_image(size, seed)).save(buffer, format=pil_format)
+    return f'scene_{size}.{fmt}', buffer.getvalue(), f'image/{pil_format.lower()}'
+
+
+def latency_summary(timings_ms):
+    """p50/p95/p99/mean/max of a list of latencies in milliseconds."""
+    if not timings_ms:
+        return {'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'mean_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'p50_ms': float(np.percentile(timings_ms, 50)),
+        'p95_ms': float(np.percentile(timings_ms, 95)),
+        'p99_ms': float(np.percentile(timings_ms, 99)),
+        'mean_ms': float(np.mean(timings_ms)),
+        'max_ms': float(np.max(timings_ms)),
+    }
+
+
+def peak_rss_bytes(pid=None):
+    """Peak resident set size of a process (VmHWM), or of this process when pid is None."""
+    if pid is not None:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StubSegmentationModel:
+    """Stands in for a Keras model in benchmarks that measure everything but the forward pass."""
+
+    def __init__(self, num_classes=5, seed=0):
+        self.num_classes = num_classes
+        self._rng = np.random.default_rng(seed)
+
+    def predict(self, batch, verbose=0):
+        return self._rng.random(batch.shape[:3] + (self.num_classes,), dtype=np.float32)
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import registry
+
+
+# --- PREDICTION CACHE CONFIGURATION ---
+CACHE_MAX_BYTES = int(os.getenv('PREDICTION_CACHE_MAX_MB', '256')) * 1024 * 1024
+CACHE_TTL_SECONDS = float(os.getenv('PREDICTION_CACHE_TTL', '600'))
+
+
+def upload_digest(file_obj):
+    """SHA-256 of the uploaded bytes. Leaves the file pointer at the start."""
+    digest = hashlib.sha256()
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+
+    if hasattr(file_obj, 'chunks'):
+        # Django UploadedFile: streams from memory or the spooled temp file
+        for chunk in file_obj.chunks():
+            digest.update(chunk)
+    else:
+        for chunk in iter(lambda: file_obj.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def _entry_size(value):
+    """Total array bytes held by a (possibly nested) tuple of arrays."""
+    if isinstance(value, tuple):
+        return sum(_entry_size(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+def _detach(value):
+    """
+    Copies np.memmap items into memory. A memmap of a temporary upload keeps the unlinked
+    file's disk blocks allocated for as long as it is referenced, i.e. until eviction.
+    """
+    if isinstance(value, tuple):
+        return tuple(np.array(item) if isinstance(item, np.memmap) else item for item in value)
+    return value
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache with a TTL for (input_tensor, post-processed outputs) pairs.
+    Entries are evicted least-recently-used first once the total array size
+    exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(digest, model_type, model_fingerprint, preprocess_version):
+        return f"{digest}:{model_type}:{model_fingerprint}:{preprocess_version}"
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = _entry_size(value)
+        if size > self.max_bytes:
+            return
+        value = _detach(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+prediction_cache = PredictionCache()
+
+
+@registry.collector
+def _cache_metrics():
+    stats = prediction_cache.stats()
+    yield ('cloudvision_prediction_cache_bytes', 'gauge', 'Array bytes held by the prediction cache.', [({}, stats['bytes'])])
+    yield ('cloudvision_prediction_cache_entries', 'gauge', 'Entries in the prediction cache.', [({}, stats['entries'])])
+    yield ('cloudvision_prediction_cache_evictions_total', 'counter', 'Prediction cache LRU evictions.', [({}, stats['evictions'])])
@@ -0,0 +1,117 @@
+import base64
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .metrics import encoder_seconds
+
+
+# --- IMAGE ENCODING CONFIGURATION ---
+# 'png' (default) or 'webp' (always lossless)
+IMAGE_CODEC = os.getenv('IMAGE_CODEC', 'png').lower()
+# zlib level for PNG output: 0 (fastest, largest) .. 9 (slowest, smallest). PIL's default is 6.
+PNG_COMPRESS_LEVEL = int(os.getenv('PNG_COMPRESS_LEVEL', '6'))
+# Encode the 4-class mask as a 2-bit palette PNG instead of 8-bit grayscale. The image looks
+# the same, but tools reading raw pixel values will see class indices (0-3) instead of 0/85/170/255.
+MASK_PALETTE = os.getenv('MASK_PALETTE', 'False') == 'True'
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', '3'))
+
+MIME_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+MASK_PALETTE_COLORS = [0, 0, 0, 85, 85, 85, 170, 170, 170, 255, 255, 255]
+
+
+class EncoderTimings:
+    """Per-encoder call counts and wall time, reported at /api/stats/."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def record(self, name, seconds, size):
+        encoder_seconds.observe(seconds, name)
+        with self._lock:
+            entry = self._timings.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'total_bytes': 0})
+            entry['count'] += 1
+            entry['total_ms'] += seconds * 1000.0
+            entry['max_ms'] = max(entry['max_ms'], seconds * 1000.0)
+            entry['total_bytes'] += size
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name, entry in self._timings.items():
+                result[name] = dict(entry, mean_ms=entry['total_ms'] / entry['count'] if entry['count'] else 0.0)
+            return {'codec': IMAGE_CODEC, 'png_compress_level': PNG_COMPRESS_LEVEL,
+                    'mask_palette': MASK_PALETTE, 'encoders': result}
+
+
+encoder_timings = EncoderTimings()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+        return _executor
+
+
+def mime_type(codec=None):
+    return MIME_TYPES.get(codec or IMAGE_CODEC, 'image/png')
+
+
+def _save(img, codec):
+    buffer = io.BytesIO()
+    if codec == 'webp':
+        img.save(buffer, format='WEBP', lossless=True)
+    else:
+        img.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def encode_image(img_array, name, mode=None):
+    """Encodes a uint8 array with the configured codec. Returns (bytes, mime type)."""
+    started = time.perf_counter()
+    img = Image.fromarray(img_array.astype(np.uint8, copy=False), mode=mode)
+    payload = _save(img, IMAGE_CODEC)
+    encoder_timings.record(name, time.perf_counter() - started, len(payload))
+    return payload, mime_type()
+
+
+def encode_mask(display_mask, gray):
+    """The grayscale mask image, optionally as a 2-bit palette PNG of the 4 display classes."""
+    if not MASK_PALETTE:
+        return encode_image(gray, 'mask', mode='L')
+
+    started = time.perf_counter()
+    img = Image.fromarray(display_mask.astype(np.uint8, copy=False), mode='P')
+    img.putpalette(MASK_PALETTE_COLORS)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', bits=2, compress_level=PNG_COMPRESS_LEVEL)
+    payload = buffer.getvalue()
+    encoder_timings.record('mask', time.perf_counter() - started, len(payload))
+    return payload, MIME_TYPES['png']
+
+
+def encode_parallel(tasks):
+    """
+    Runs several encode callables concurrently on the shared pool (PIL releases the GIL
+    while compressing). tasks: {name: callable -> (bytes, mime)}. Returns {name: (bytes, mime)}.
+    """
+    if len(tasks) == 1:
+        name, task = next(iter(tasks.items()))
+        return {name: task()}
+    futures = {name: get_executor().submit(task) for name, task in tasks.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def to_base64(payload):
+    return base64.b64encode(payload).decode('utf-8')
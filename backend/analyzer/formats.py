@@ -0,0 +1,141 @@
+import json
+import uuid
+
+import numpy as np
+from django.http import HttpResponse
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+from .pipeline import class_percentages, encode_outputs
+
+
+# --- RESPONSE FORMATS FOR /predict/ ---
+FORMAT_JSON = 'json'            # default: JSON with base64 PNGs (used by the frontend)
+FORMAT_RAW = 'raw'              # uint8 display-class mask bytes, metadata in headers
+FORMAT_RLE = 'rle'              # JSON with a run-length-encoded mask, no images
+FORMAT_MULTIPART = 'multipart'  # multipart/mixed: JSON metadata + binary image parts
+
+FORMAT_MEDIA_TYPES = {
+    FORMAT_RAW: 'application/octet-stream',
+    FORMAT_RLE: 'application/vnd.cloudvision.rle+json',
+    FORMAT_MULTIPART: 'multipart/mixed',
+}
+# Query parameter that overrides the Accept header. Not 'format', which DRF reserves.
+FORMAT_PARAM = 'output'
+
+
+class FallbackContentNegotiation(DefaultContentNegotiation):
+    """
+    Lets binary Accept headers through to the view (which answers them itself)
+    instead of DRF rejecting the request with 406 up front.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return (renderers[0], renderers[0].media_type)
+
+
+def negotiate_format(request):
+    """Picks the /predict/ response format from ?output=... or the Accept header."""
+    # DRF requests expose query_params/data; plain Django (async) views have GET/POST
+    query = getattr(request, 'query_params', request.GET)
+    data = getattr(request, 'data', request.POST)
+    requested = query.get(FORMAT_PARAM) or data.get(FORMAT_PARAM)
+    if requested:
+        requested = str(requested).lower()
+        if requested in FORMAT_MEDIA_TYPES or requested == FORMAT_JSON:
+            return requested
+        raise ValueError(f"Unknown output format '{requested}'")
+
+    accept = request.META.get('HTTP_ACCEPT', '')
+    for fmt, media_type in FORMAT_MEDIA_TYPES.items():
+        if media_type in accept:
+            return fmt
+    return FORMAT_JSON
+
+
+def rle_encode(mask):
+    """
+    Row-major run-length encoding of a class mask.
+    Returns {'shape': [H, W], 'values': [...], 'lengths': [...]}.
+    """
+    flat = np.ascontiguousarray(mask).ravel()
+    if flat.size == 0:
+        return {'shape': list(mask.shape), 'values': [], 'lengths': []}
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    lengths = np.diff(np.concatenate((starts, [flat.size])))
+    return {
+        'shape': list(mask.shape),
+        'values': flat[starts].tolist(),
+        'lengths': lengths.tolist(),
+    }
+
+
+def rle_decode(rle, dtype=np.uint8):
+    return np.repeat(np.asarray(rle['values'], dtype=dtype), rle['lengths']).reshape(rle['shape'])
+
+
+def predict_metadata(processed, model_type):
+    """Percentages, shadow flag and mask shape: the image-free part of a /predict/ result."""
+    percentages = class_percentages(processed.counts)
+    return {
+        'percentages': percentages,
+        'has_shadow': percentages["Shadow"] > 1.0,
+        'model_used': model_type,
+        'shape': list(processed.mask.shape),
+        'classes': ['Clear', 'Shadow', 'Thin Cloud', 'Thick Cloud'],
+    }
+
+
+def _multipart(parts):
+    """parts: list of (name, content_type, bytes). Returns (body, boundary)."""
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for name, content_type, payload in parts:
+        chunks.append(
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Disposition: inline; name=\"{name}\"\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n".encode('ascii')
+        )
+        chunks.append(payload)
+        chunks.append(b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode('ascii'))
+    return b"".join(chunks), boundary
+
+
+def render_predict_response(fmt, input_tensor, processed, model_type):
+    """Builds the HttpResponse for the non-JSON /predict/ formats."""
+    metadata = predict_metadata(processed, model_type)
+
+    if fmt == FORMAT_RAW:
+        response = HttpResponse(processed.mask.astype(np.uint8).tobytes(), content_type=FORMAT_MEDIA_TYPES[FORMAT_RAW])
+        response['X-Mask-Shape'] = ','.join(str(d) for d in processed.mask.shape)
+        response['X-Mask-Dtype'] = 'uint8'
+        response['X-Percentages'] = json.dumps(metadata['percentages'])
+        response['X-Has-Shadow'] = 'true' if metadata['has_shadow'] else 'false'
+        response['X-Model-Used'] = model_type
+        return response
+
+    if fmt == FORMAT_RLE:
+        metadata['mask_rle'] = rle_encode(processed.mask)
+        return HttpResponse(json.dumps(metadata), content_type=FORMAT_MEDIA_TYPES[FORMAT_RLE])
+
+    if fmt == FORMAT_MULTIPART:
+        images = encode_outputs(input_tensor, processed, model_type)
+        parts = [('metadata', 'application/json', json.dumps(metadata).encode('utf-8'))]
+        for name in ('mask', 'original_image', 'solar_heatmap'):
+            payload, mime = images[name]
+            parts.append((name, mime, payload))
+        body, boundary = _multipart(parts)
+        return HttpResponse(body, content_type=f'multipart/mixed; boundary={boundary}')
+
+    raise ValueError(f"Unsupported output format '{fmt}'")
+
+
+def sse_event(event, payload):
+    """One server-sent event with a JSON data line."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
@@ -0,0 +1,128 @@
+import os
+import re
+import tempfile
+from contextlib import ExitStack
+
+import numpy as np
+
+from .pipeline import predict_scene
+
+
+# --- GEOTIFF CONFIGURATION (mirrors 1_data_preprocessing.py) ---
+# Blue, Green, Red, NIR, SWIR 1, SWIR 2 and the two Thermal bands
+BANDS_TO_USE = [2, 3, 4, 5, 6, 7, 10, 11]
+MIN_VAL = 0
+MAX_VAL = 40000
+# Longest side of the mask thumbnails returned with a full-scene result
+PREVIEW_MAX_SIZE = int(os.getenv('GEOTIFF_PREVIEW_MAX_SIZE', '1024'))
+# Rows processed at a time when post-processing the full-resolution mask
+CHUNK_ROWS = 1024
+
+BAND_PATTERN = re.compile(r'_B(\d{1,2})\.TIF{1,2}$', re.IGNORECASE)
+
+
+def normalize_bands(stacked):
+    """Same clip + scale as process_scene_with_tiling in the training pipeline."""
+    stacked = np.clip(stacked.astype(np.float32), MIN_VAL, MAX_VAL)
+    return (stacked - MIN_VAL) / (MAX_VAL - MIN_VAL)
+
+
+class RasterioSource:
+    """
+    (H, W, 8) view over one or more open rasterio datasets.
+    Slicing reads only the requested window of each band, then clips and normalizes it.
+    """
+
+    def __init__(self, band_readers):
+        # band_readers: list of (dataset, band_index) in model channel order
+        self.band_readers = band_readers
+        first = band_readers[0][0]
+        self.height, self.width = first.height, first.width
+        for dataset, _ in band_readers:
+            if (dataset.height, dataset.width) != (self.height, self.width):
+                raise ValueError("All bands must have the same dimensions")
+        self.shape = (self.height, self.width, len(band_readers))
+
+    def __getitem__(self, key):
+        from rasterio.windows import Window
+
+        rows, cols = key[0], key[1]
+        y0, y1, _ = rows.indices(self.height)
+        x0, x1, _ = cols.indices(self.width)
+        window = Window(x0, y0, x1 - x0, y1 - y0)
+        bands = [dataset.read(index, window=window) for dataset, index in self.band_readers]
+        return normalize_bands(np.stack(bands, axis=-1))
+
+
+def _open_dataset(file_obj, stack):
+    """Opens an upload with rasterio, from its spooled temp file when Django has one."""
+    import rasterio
+    from rasterio.io import MemoryFile
+
+    if hasattr(file_obj, 'temporary_file_path'):
+        return stack.enter_context(rasterio.open(file_obj.temporary_file_path()))
+
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    memfile = stack.enter_context(MemoryFile(file_obj.read()))
+    return stack.enter_context(memfile.open())
+
+
+def open_band_readers(file_objs, stack):
+    """
+    Accepts either one multi-band GeoTIFF or a set of per-band TIFs named like
+    LC08_..._B4.TIF, and returns (dataset, band_index) pairs in BANDS_TO_USE order.
+    """
+    if len(file_objs) == 1:
+        dataset = _open_dataset(file_objs[0], stack)
+        if dataset.count == len(BANDS_TO_USE):
+            # Already stacked in model order
+            return [(dataset, i + 1) for i in range(dataset.count)]
+        if dataset.count >= max(BANDS_TO_USE):
+            # Full Landsat stack: band numbers match rasterio's 1-based indexes
+            return [(dataset, b) for b in BANDS_TO_USE]
+        raise ValueError(
+            f"Expected {len(BANDS_TO_USE)} bands or a full Landsat stack, got {dataset.count}"
+        )
+
+    by_band = {}
+    for file_obj in file_objs:
+        match = BAND_PATTERN.search(getattr(file_obj, 'name', ''))
+        if match:
+            by_band[int(match.group(1))] = file_obj
+
+    missing = [b for b in BANDS_TO_USE if b not in by_band]
+    if missing:
+        raise ValueError(f"Missing band files for bands {missing} (expected names ending in _B<n>.TIF)")
+    return [(_open_dataset(by_band[b], stack), 1) for b in BANDS_TO_USE]
+
+
+def _thumbnail(mask):
+    step = max(1, int(np.ceil(max(mask.shape) / PREVIEW_MAX_SIZE)))
+    return np.array(mask[::step, ::step])
+
+
+def analyze_geotiff(file_objs, model_type):
+    """
+    Full-resolution prediction over a GeoTIFF scene with bounded memory.
+
+    Windows are read straight from the rasters and the mask is written to a temporary
+    memory-mapped file, so peak RSS depends on the scene width (one strip of windows),
+    not on its area. Returns (mask_thumbnail, counts, (height, width)).
+    """
+    with ExitStack() as stack:
+        source = RasterioSource(open_band_readers(file_objs, stack))
+        height, width = source.shape[:2]
+
+        mask_file = stack.enter_context(tempfile.NamedTemporaryFile(suffix='.mask'))
+        mask = np.memmap(mask_file.name, dtype=np.uint8, mode='w+', shape=(height, width))
+
+        predict_scene(source, model_type, out=mask)
+
+        counts = np.zeros(4, dtype=np.int64)
+        for top in range(0, height, CHUNK_ROWS):
+            counts += np.bincount(mask[top:top + CHUNK_ROWS].ravel(), minlength=4)[:4]
+
+        thumbnail = _thumbnail(mask)
+        del mask
+        return thumbnail, counts, (height, width)
@@ -0,0 +1,408 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+# --- INFERENCE SERVER CONFIGURATION ---
+# Path of a running run_inference_server socket. When set, this process never loads models
+# (or imports TensorFlow): ModelLoader hands out RemoteModel proxies instead.
+INFERENCE_SERVER_SOCKET = os.getenv('INFERENCE_SERVER_SOCKET', '')
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'cloudvision-inference.sock')
+# Seconds a worker waits for a reply before the request fails
+INFERENCE_SERVER_TIMEOUT = float(os.getenv('INFERENCE_SERVER_TIMEOUT', '120'))
+HEALTH_TIMEOUT = 5.0
+# Arrays below this size travel inline over the socket, larger ones through shared memory
+INFERENCE_SHM_MIN_BYTES = int(os.getenv('INFERENCE_SHM_MIN_KB', '64')) * 1024
+
+MAGIC = b'CVIS'
+PROTOCOL_VERSION = 1
+
+# Requests carry an op, replies a status in the same header field
+OP_PREDICT = 1
+OP_LOAD = 2
+OP_HEALTH = 3
+OP_NAMES = {OP_PREDICT: 'predict', OP_LOAD: 'load', OP_HEALTH: 'health'}
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+TRANSPORT_NONE = 0
+TRANSPORT_INLINE = 1
+TRANSPORT_SHM = 2
+
+# dtype code 0: the payload is plain bytes (JSON or an error message), not an array
+DTYPES = {1: np.dtype(np.float32), 2: np.dtype(np.float16), 3: np.dtype(np.uint8)}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+MAX_DIMS = 4
+SHM_PREFIX = 'cvis_'
+
+# magic, version, op/status, dtype code, ndim, transport, model key, shape,
+# shared memory segment name, inline payload length
+HEADER = struct.Struct('!4sBBBBB3x16s4I32sQ')
+MAX_KEY_BYTES = 16
+
+
+class InferenceServerError(RuntimeError):
+    """The inference server is unreachable, spoke an unexpected protocol or failed the request."""
+
+
+def _untrack(shm):
+    """
+    Segments handed to another process are unlinked there. Stops this process's resource
+    tracker from unlinking them (and warning about leaks) when it exits.
+    """
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def send_message(sock, code, model_key='', array=None, payload=b'', shm_min_bytes=INFERENCE_SHM_MIN_BYTES):
+    """
+    Writes one message. Arrays of shm_min_bytes or more are copied into a new shared memory
+    segment, which is returned: the caller keeps it open until the peer has read it.
+    """
+    if len(model_key.encode()) > MAX_KEY_BYTES:
+        raise InferenceServerError(f"Model key {model_key!r} is longer than {MAX_KEY_BYTES} bytes")
+    shm = None
+    dtype_code, shape = 0, ()
+    transport = TRANSPORT_INLINE if payload else TRANSPORT_NONE
+    shm_name = ''
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        if array.dtype not in DTYPE_CODES or array.ndim > MAX_DIMS:
+            raise InferenceServerError(f"Unsupported array {array.dtype} with {array.ndim} dimensions")
+        dtype_code, shape = DTYPE_CODES[array.dtype], array.shape
+        if array.nbytes >= shm_min_bytes:
+            shm = shared_memory.SharedMemory(name=f"{SHM_PREFIX}{uuid.uuid4().hex[:16]}", create=True, size=array.nbytes)
+            np.ndarray(shape, array.dtype, buffer=shm.buf)[...] = array
+            transport, shm_name, payload = TRANSPORT_SHM, shm.name, b''
+        else:
+            transport, payload = TRANSPORT_INLINE, array.tobytes()
+
+    padded_shape = tuple(shape) + (0,) * (MAX_DIMS - len(shape))
+    header = HEADER.pack(MAGIC, PROTOCOL_VERSION, code, dtype_code, len(shape), transport,
+                         model_key.encode(), *padded_shape, shm_name.encode(), len(payload))
+    try:
+        sock.sendall(header + payload)
+    except OSError:
+        _release(shm, unlink=True)
+        raise
+    return shm
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Connection closed")
+        received += count
+    return buffer
+
+
+def recv_message(sock, unlink=False):
+    """
+    Reads one message: (op or status, model key, array or bytes). Arrays in shared memory are
+    copied out and the segment is closed; unlink=True also removes it (replies, whose segments
+    the server created for us).
+    """
+    header = _recv_exact(sock, HEADER.size)
+    magic, version, code, dtype_code, ndim, transport, key, *rest = HEADER.unpack(header)
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise InferenceServerError(f"Unexpected protocol header {bytes(magic)!r} v{version}")
+    shape = tuple(rest[:MAX_DIMS][:ndim])
+    shm_name = rest[MAX_DIMS].rstrip(b'\0').decode()
+    length = rest[MAX_DIMS + 1]
+    model_key = key.rstrip(b'\0').decode()
+
+    payload = _recv_exact(sock, length) if length else b''
+    if dtype_code == 0:
+        return code, model_key, bytes(payload)
+    dtype = DTYPES[dtype_code]
+    if transport == TRANSPORT_INLINE:
+        return code, model_key, np.frombuffer(payload, dtype=dtype).reshape(shape)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        array = np.ndarray(shape, dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+        else:
+            _untrack(shm)
+    return code, model_key, array
+
+
+def _release(shm, unlink):
+    if shm is None:
+        return
+    shm.close()
+    if unlink:
+        shm.unlink()
+    else:
+        _untrack(shm)
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    """One worker connection: requests are answered in order until the worker disconnects."""
+
+    def handle(self):
+        while True:
+            try:
+                op, model_key, body = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            except InferenceServerError as e:
+                print(f"Inference server: dropping connection ({e})")
+                return
+            try:
+                self.server.dispatch(self.request, op, model_key, body)
+            except OSError:
+                # The worker went away before reading its reply
+                return
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Owns the models for every Django worker on the host. Each connection gets a thread; all
+    of them submit to the process's MicroBatchers, so requests from different workers share
+    forward passes. Started by `manage.py run_inference_server`.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        self.socket_path = socket_path
+        self._remove_stale_socket()
+        super().__init__(socket_path, _ConnectionHandler)
+        os.chmod(socket_path, 0o660)
+
+        self.started_at = time.time()
+        self._stats_lock = threading.Lock()
+        self.requests = {name: 0 for name in OP_NAMES.values()}
+        self.errors = 0
+        self.rows_served = 0
+        self.total_seconds = 0.0
+        self.warmup = {}        # model_key -> warm_up_model timings
+        self.load_errors = {}   # model_key -> error from the startup preload
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)  # Left behind by a server that did not shut down cleanly
+            return
+        finally:
+            probe.close()
+        raise InferenceServerError(f"An inference server is already listening on {self.socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def dispatch(self, sock, op, model_key, body):
+        started = time.perf_counter()
+        array, payload, status = None, b'', STATUS_OK
+        try:
+            array, payload = self._run(op, model_key, body)
+        except Exception as e:
+            status, payload = STATUS_ERROR, str(e).encode()
+            print(f"Inference server {OP_NAMES.get(op, op)} error ({model_key}): {e}")
+
+        name = OP_NAMES.get(op, 'unknown')
+        with self._stats_lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.total_seconds += time.perf_counter() - started
+            if status == STATUS_ERROR:
+                self.errors += 1
+            elif op == OP_PREDICT:
+                self.rows_served += array.shape[0]
+
+        # The worker copies the output out of shared memory and unlinks the segment
+        _release(send_message(sock, status, model_key, array=array, payload=payload), unlink=False)
+
+    def _run(self, op, model_key, body):
+        """(array, payload) reply for a request; raises on failure."""
+        # Imported here: the client side of this module must not pull in TensorFlow
+        from .batching import get_batcher
+        from .model_loader import ModelLoader
+
+        if op == OP_PREDICT:
+            return np.asarray(get_batcher(model_key).predict(body), dtype=np.float32), b''
+        if op == OP_LOAD:
+            if ModelLoader().load_model(model_key) is None:
+                raise RuntimeError(f"Model {model_key} could not be loaded")
+            return None, json.dumps(ModelLoader().stats()['models'].get(model_key, {})).encode()
+        if op == OP_HEALTH:
+            return None, json.dumps(self.health()).encode()
+        raise InferenceServerError(f"Unknown op {op}")
+
+    def health(self):
+        from .batching import batching_stats
+        from .model_loader import ModelLoader
+
+        with self._stats_lock:
+            served = sum(self.requests.values())
+            counters = {
+                'requests': dict(self.requests),
+                'errors': self.errors,
+                'rows_served': self.rows_served,
+                'avg_request_ms': (self.total_seconds / served * 1000.0) if served else 0.0,
+            }
+        return dict(
+            counters,
+            status='degraded' if self.load_errors else 'ok',
+            pid=os.getpid(),
+            socket=self.socket_path,
+            uptime_seconds=time.time() - self.started_at,
+            warmup=self.warmup,
+            load_errors=self.load_errors,
+            models=ModelLoader().stats(),
+            batching=batching_stats(),
+        )
+
+
+class InferenceClient:
+    """
+    Worker side of the protocol. Each thread keeps its own connection, so concurrent requests
+    reach the server (and its batcher) in parallel; a broken connection is reopened once.
+    """
+
+    def __init__(self, socket_path, timeout=INFERENCE_SERVER_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.total_seconds = 0.0
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, op, model_key='', array=None, timeout=None):
+        """Sends one request and returns the reply body (array or bytes)."""
+        started = time.perf_counter()
+        reused = getattr(self._local, 'sock', None) is not None
+        while True:
+            shm = None
+            try:
+                sock = self._socket()
+                sock.settimeout(timeout or self.timeout)
+                shm = send_message(sock, op, model_key, array=array)
+                status, _, body = recv_message(sock, unlink=True)
+                break
+            except OSError as e:
+                # A half-read reply leaves the stream out of sync, so the connection goes either way
+                self._drop()
+                if reused and not isinstance(e, socket.timeout):
+                    # Most likely a connection from before a server restart: retry once on a fresh one
+                    reused = False
+                    with self._stats_lock:
+                        self.reconnects += 1
+                    continue
+                with self._stats_lock:
+                    self.errors += 1
+                raise InferenceServerError(f"Inference server at {self.socket_path} unavailable: {e}") from e
+            finally:
+                _release(shm, unlink=True)
+
+        with self._stats_lock:
+            self.requests += 1
+            self.total_seconds += time.perf_counter() - started
+            if status != STATUS_OK:
+                self.errors += 1
+        if status != STATUS_OK:
+            raise InferenceServerError(body.decode(errors='replace'))
+        return body
+
+    def predict(self, model_key, batch):
+        return self.call(OP_PREDICT, model_key, np.asarray(batch, dtype=np.float32))
+
+    def load(self, model_key):
+        """Has the server load a model; returns the server's info for it."""
+        return json.loads(self.call(OP_LOAD, model_key))
+
+    def health(self):
+        return json.loads(self.call(OP_HEALTH, timeout=HEALTH_TIMEOUT))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'socket': self.socket_path,
+                'requests': self.requests,
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+                'avg_round_trip_ms': (self.total_seconds / self.requests * 1000.0) if self.requests else 0.0,
+            }
+
+
+class RemoteModel:
+    """Stands in for a loaded Keras model in workers: predict() runs on the inference server."""
+
+    def __init__(self, client, model_key):
+        self.client = client
+        self.model_key = model_key
+
+    def predict(self, batch, verbose=0):
+        return self.client.predict(self.model_key, batch)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(socket_path=None):
+    """The process-wide client for a socket (INFERENCE_SERVER_SOCKET by default)."""
+    socket_path = socket_path or INFERENCE_SERVER_SOCKET
+    with _clients_lock:
+        client = _clients.get(socket_path)
+        if client is None:
+            client = _clients[socket_path] = InferenceClient(socket_path)
+        return client
+
+
+def inference_server_stats():
+    """Client counters plus the server's health report; None when models run in-process."""
+    if not INFERENCE_SERVER_SOCKET:
+        return None
+    client = get_client()
+    stats = client.stats()
+    try:
+        stats['health'] = client.health()
+    except InferenceServerError as e:
+        stats['health'] = {'status': 'unreachable', 'error': str(e)}
+    return stats
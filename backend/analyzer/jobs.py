@@ -0,0 +1,230 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import AnalysisJob
+
+
+# --- JOB CONFIGURATION ---
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_STORAGE_DIR = os.getenv('JOB_STORAGE_DIR', os.path.join(settings.BASE_DIR, 'media', 'jobs'))
+# Minimum seconds between progress writes (and cancellation checks) from a running job
+PROGRESS_INTERVAL = float(os.getenv('JOB_PROGRESS_INTERVAL', '1.0'))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_futures = {}
+
+
+def get_executor():
+    """Process pool shared by the web process. 'spawn' keeps TensorFlow state out of the fork."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+        return _executor
+
+
+def _init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+
+
+def submit_job(file_obj, kind, model_type, tiled=False):
+    """Stores the upload on disk, records the job and queues it on the process pool."""
+    os.makedirs(JOB_STORAGE_DIR, exist_ok=True)
+    input_name = os.path.basename(getattr(file_obj, 'name', 'upload'))
+    input_path = os.path.join(JOB_STORAGE_DIR, f"{uuid.uuid4().hex}_{input_name}")
+
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    with open(input_path, 'wb') as f:
+        if hasattr(file_obj, 'chunks'):
+            for chunk in file_obj.chunks():
+                f.write(chunk)
+        else:
+            f.write(file_obj.read())
+
+    job = AnalysisJob.objects.create(
+        kind=kind,
+        model_type=model_type,
+        tiled=tiled,
+        input_name=input_name,
+        input_path=input_path,
+        owner=_owner(),
+    )
+
+    try:
+        future = get_executor().submit(run_job, str(job.id))
+    except Exception as e:
+        _fail(str(job.id), f"Could not queue the job: {e}")
+        _remove_input(input_path)
+        raise
+    _futures[str(job.id)] = future
+    future.add_done_callback(lambda f, job_id=str(job.id): _job_done(job_id, f))
+    return job
+
+
+def _owner():
+    """Identifies this web process (and so its pool) on the job rows it submits."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _fail(job_id, error):
+    """Marks a job that has not finished as failed."""
+    return AnalysisJob.objects.filter(
+        pk=job_id, status__in=[AnalysisJob.STATUS_QUEUED, AnalysisJob.STATUS_RUNNING]
+    ).update(status=AnalysisJob.STATUS_FAILED, error=error, finished_at=timezone.now())
+
+
+def _job_done(job_id, future):
+    """
+    Runs on the pool's management thread. run_job records its own outcome; an exception here
+    means the job never finished, e.g. its worker process died (BrokenProcessPool).
+    """
+    _futures.pop(job_id, None)
+    if future.cancelled() or future.exception() is None:
+        return
+    try:
+        _fail(job_id, f"Worker failed: {future.exception()!r}")
+    finally:
+        close_old_connections()
+
+
+def _owner_is_gone(owner):
+    if not owner:
+        # Submitted before jobs recorded their owner
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        # Lookups on the submitting host recover it
+        return False
+    if int(pid) == os.getpid():
+        # Ours, but no longer in the pool
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def recover_orphaned_job(job):
+    """
+    Queued and running jobs live in the pool of the web process that submitted them. If that
+    process has exited (restart, crash) or lost the job, it never finishes: mark it failed.
+    Returns True if the job was recovered.
+    """
+    if job.is_finished or str(job.id) in _futures or not _owner_is_gone(job.owner):
+        return False
+    if not _fail(job.id, "The job was lost when its worker process stopped; please resubmit it"):
+        return False
+    _remove_input(job.input_path)
+    job.refresh_from_db()
+    return True
+
+
+def cancel_job(job):
+    """
+    Queued jobs are dropped from the pool; running jobs see the cancelled status at
+    their next progress update and stop.
+    """
+    if job.is_finished:
+        return False
+
+    future = _futures.get(str(job.id))
+    if future is not None and future.cancel():
+        _remove_input(job.input_path)
+
+    updated = AnalysisJob.objects.filter(
+        pk=job.pk, status__in=[AnalysisJob.STATUS_QUEUED, AnalysisJob.STATUS_RUNNING]
+    ).update(status=AnalysisJob.STATUS_CANCELLED, finished_at=timezone.now())
+    return updated > 0
+
+
+def _progress_reporter(job_id):
+    last_write = [0.0]
+
+    def report(fraction):
+        now = time.monotonic()
+        if fraction < 1.0 and now - last_write[0] < PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+
+        # Scale inference to 0-90%; the remainder is post-processing and encoding
+        updated = AnalysisJob.objects.filter(pk=job_id, status=AnalysisJob.STATUS_RUNNING).update(
+            progress=round(0.9 * fraction, 4)
+        )
+        if not updated:
+            raise JobCancelled()
+
+    return report
+
+
+def run_job(job_id):
+    """Entry point inside a pool worker process."""
+    from .pipeline import segment, build_predict_result, build_mitigate_result
+    from .model_loader import ModelLoader
+
+    started = AnalysisJob.objects.filter(pk=job_id, status=AnalysisJob.STATUS_QUEUED).update(
+        status=AnalysisJob.STATUS_RUNNING, started_at=timezone.now()
+    )
+    if not started:
+        # Cancelled before a worker picked it up
+        _remove_input(AnalysisJob.objects.get(pk=job_id).input_path)
+        return
+
+    job = AnalysisJob.objects.get(pk=job_id)
+    try:
+        if ModelLoader().load_model(job.model_type) is None:
+            raise RuntimeError(f"Model {job.model_type} not loaded")
+
+        with open(job.input_path, 'rb') as file_obj:
+            input_tensor, processed, _ = segment(
+                file_obj, job.model_type, tiled=job.tiled, progress=_progress_reporter(job_id)
+            )
+
+        if job.kind == AnalysisJob.KIND_MITIGATE:
+            result = build_mitigate_result(input_tensor, processed, job.model_type)
+        else:
+            result = build_predict_result(input_tensor, processed, job.model_type)
+
+        AnalysisJob.objects.filter(pk=job_id, status=AnalysisJob.STATUS_RUNNING).update(
+            status=AnalysisJob.STATUS_SUCCEEDED, progress=1.0, result=result, finished_at=timezone.now()
+        )
+    except JobCancelled:
+        print(f"Job {job_id} cancelled.")
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        AnalysisJob.objects.filter(pk=job_id, status=AnalysisJob.STATUS_RUNNING).update(
+            status=AnalysisJob.STATUS_FAILED, error=str(e), finished_at=timezone.now()
+        )
+    finally:
+        _remove_input(job.input_path)
+
+
+def _remove_input(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import google.generativeai as genai
+
+from .metrics import chat_ttft_seconds
+
+
+# --- GEMINI CONFIGURATION ---
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-2.5-flash-lite')
+# Answer locally with canned text instead of calling Gemini (offline development, tests, benchmarks)
+GEMINI_STUB = os.getenv('GEMINI_STUB', 'False') == 'True'
+
+# --- REPORT CACHE CONFIGURATION ---
+# Decimal places the percentages are rounded to before they key the cache (and build the prompt)
+GEMINI_CACHE_PRECISION = int(os.getenv('GEMINI_CACHE_PRECISION', '1'))
+GEMINI_CACHE_TTL = float(os.getenv('GEMINI_CACHE_TTL', '86400'))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '512'))
+# Optional JSON file the cache is persisted to, so reports survive restarts
+GEMINI_CACHE_PATH = os.getenv('GEMINI_CACHE_PATH', '')
+
+
+class GeminiNotConfigured(Exception):
+    pass
+
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """Offline stand-in for genai.GenerativeModel. Echoes the start of the prompt and counts calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def _reply(self, prompt):
+        self.calls += 1
+        return _StubResponse(f"[stub] {prompt[:120]}")
+
+    def _chunks(self, prompt):
+        # stream=True: the reply word by word, like the SDK's partial responses
+        for word in self._reply(prompt).text.split(' '):
+            yield _StubResponse(word + ' ')
+
+    async def _achunks(self, prompt):
+        for chunk in self._chunks(prompt):
+            yield chunk
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return self._chunks(prompt) if stream else self._reply(prompt)
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        return self._achunks(prompt) if stream else self._reply(prompt)
+
+
+stub_model = StubModel()
+
+
+def get_model():
+    """A configured Gemini model. Raises GeminiNotConfigured when no API key is set."""
+    if GEMINI_STUB:
+        return stub_model
+
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_key:
+        raise GeminiNotConfigured('Gemini API Key not configured')
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def analysis_prompt(percentages):
+    return (
+        f"Analyze these satellite cloud metrics: {json.dumps(percentages)}. "
+        "Provide a meteorological report in the following format:\n"
+        "1. Small Paragraph: General overview.\n"
+        "2. AI Suggestions: Actionable advice.\n"
+        "3. Future Prediction: Short-term forecast.\n"
+        "4. Precautions: Safety measures.\n"
+        "Do not use special characters like asterisks or markdown bolding. Keep it clean text."
+    )
+
+
+def chat_prompt(message, metrics):
+    # Construct System Prompt
+    context = f"The user is looking at an image with the following stats: {json.dumps(metrics)}." if metrics else "No specific image context provided."
+
+    system_prompt = (
+        "You are CloudVision AI, an expert Satellite Analyst for CloudVision. "
+        f"{context} "
+        "Answer the user's questions specifically based on this data if available. "
+        "Keep answers concise, professional, and helpful. "
+        "If asked about solar potential, refer to the Clear Sky percentage. "
+        "If asked about weather, refer to the Cloud Coverage."
+    )
+
+    return f"{system_prompt}\n\nUser: {message}\nCloudVision AI:"
+
+
+def generate(prompt):
+    """Blocking Gemini call; returns the response text."""
+    return get_model().generate_content(prompt).text
+
+
+async def agenerate(prompt):
+    """Awaitable Gemini call, so the event loop keeps serving while the request is in flight."""
+    response = await get_model().generate_content_async(prompt)
+    return response.text
+
+
+class StreamStats:
+    """Streaming chat counters and time-to-first-token, reported at /api/stats/."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.disconnected = 0
+        self.failed = 0
+        self.ttft_count = 0
+        self.ttft_total_ms = 0.0
+        self.ttft_max_ms = 0.0
+
+    def record_start(self):
+        with self._lock:
+            self.started += 1
+
+    def record_first_token(self, seconds):
+        chat_ttft_seconds.observe(seconds)
+        with self._lock:
+            self.ttft_count += 1
+            self.ttft_total_ms += seconds * 1000.0
+            self.ttft_max_ms = max(self.ttft_max_ms, seconds * 1000.0)
+
+    def record_end(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'completed': self.completed,
+                'disconnected': self.disconnected,
+                'failed': self.failed,
+                'ttft_mean_ms': (self.ttft_total_ms / self.ttft_count) if self.ttft_count else 0.0,
+                'ttft_max_ms': self.ttft_max_ms,
+            }
+
+
+stream_stats = StreamStats()
+
+
+def _chunk_text(chunk):
+    # Chunks without text parts (e.g. safety metadata) raise on .text
+    try:
+        return chunk.text
+    except ValueError:
+        return ''
+
+
+def stream_chat(prompt, model=None):
+    """
+    Yields the reply text chunk by chunk as Gemini produces it. Pull-based: the next chunk
+    is only requested once the caller has consumed (sent) the previous one.
+    """
+    model = model or get_model()
+    started = time.perf_counter()
+    stream_stats.record_start()
+    outcome = 'disconnected'
+    first = True
+    try:
+        for chunk in model.generate_content(prompt, stream=True):
+            text = _chunk_text(chunk)
+            if not text:
+                continue
+            if first:
+                stream_stats.record_first_token(time.perf_counter() - started)
+                first = False
+            yield text
+        outcome = 'completed'
+    except Exception:
+        outcome = 'failed'
+        raise
+    finally:
+        # GeneratorExit (client went away) lands here with outcome still 'disconnected'
+        stream_stats.record_end(outcome)
+
+
+async def astream_chat(prompt, model=None):
+    """Async counterpart of stream_chat; cancellation on client disconnect stops the Gemini stream."""
+    model = model or get_model()
+    started = time.perf_counter()
+    stream_stats.record_start()
+    outcome = 'disconnected'
+    first = True
+    try:
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            text = _chunk_text(chunk)
+            if not text:
+                continue
+            if first:
+                stream_stats.record_first_token(time.perf_counter() - started)
+                first = False
+            yield text
+        outcome = 'completed'
+    except Exception:
+        outcome = 'failed'
+        raise
+    finally:
+        # asyncio.CancelledError and GeneratorExit are BaseExceptions and keep 'disconnected'
+        stream_stats.record_end(outcome)
+
+
+class ReportCache:
+    """
+    Bounded LRU cache with a TTL for Gemini analysis reports, keyed on the rounded
+    class percentages. Optionally persisted to a JSON file after every insert.
+    """
+
+    def __init__(self, ttl=GEMINI_CACHE_TTL, max_entries=GEMINI_CACHE_MAX_ENTRIES,
+                 precision=GEMINI_CACHE_PRECISION, path=GEMINI_CACHE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.path = path
+        self._entries = OrderedDict()  # key -> (expires_at, text), wall clock so it survives restarts
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    def quantize(self, percentages):
+        if not isinstance(percentages, dict):
+            raise ValueError("percentages must be an object of class names and values")
+        return {
+            name: round(float(value), self.precision) if isinstance(value, (int, float)) else value
+            for name, value in sorted(percentages.items())
+        }
+
+    def make_key(self, percentages):
+        return json.dumps(self.quantize(percentages), sort_keys=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable Gemini cache file {self.path}: {e}")
+            return
+        now = time.time()
+        for key, expires_at, text in stored:
+            if expires_at >= now:
+                self._entries[key] = (expires_at, text)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        if not self.path:
+            return
+        # Write a uniquely named sibling file and swap it in, so a crash never leaves a truncated
+        # cache and workers sharing the path never write into each other's temporary file
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.path)),
+                                         suffix='.tmp', delete=False) as f:
+            json.dump([[key, expires_at, text] for key, (expires_at, text) in self._entries.items()], f)
+        try:
+            os.replace(f.name, self.path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'precision': self.precision,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'persisted': bool(self.path),
+            }
+
+
+report_cache = ReportCache()
+
+
+def generate_report(percentages, cache=None):
+    """The Gemini analysis report for a percentages dict, served from the report cache when possible."""
+    cache = cache or report_cache
+    key = cache.make_key(percentages)
+    text = cache.get(key)
+    if text is None:
+        # Prompt with the rounded values, so the cached text matches every scene sharing the key
+        text = generate(analysis_prompt(cache.quantize(percentages)))
+        cache.put(key, text)
+    return text
+
+
+async def agenerate_report(percentages, cache=None):
+    cache = cache or report_cache
+    key = cache.make_key(percentages)
+    text = cache.get(key)
+    if text is None:
+        text = await agenerate(analysis_prompt(cache.quantize(percentages)))
+        # put() may rewrite the persisted cache file; keep that off the event loop
+        await asyncio.to_thread(cache.put, key, text)
+    return text
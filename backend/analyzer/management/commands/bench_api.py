@@ -0,0 +1,253 @@
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from analyzer import llm
+from analyzer.benchmarking import StubSegmentationModel, latency_summary, peak_rss_bytes, synthetic_upload
+
+UPLOAD_ENDPOINTS = ('predict', 'mitigate')
+TEXT_ENDPOINTS = ('chat', 'gemini-analysis')
+
+
+class InProcessTransport:
+    """Drives the app through Django's test client (one client per thread)."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client()
+        return client
+
+    def upload(self, path, filename, payload, content_type, fields):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        data = dict(fields, file=SimpleUploadedFile(filename, payload, content_type=content_type))
+        response = self._client().post(path, data)
+        return response.status_code, response.content
+
+    def post_json(self, path, body):
+        response = self._client().post(path, body, content_type='application/json')
+        return response.status_code, response.content
+
+
+class HttpTransport:
+    """Drives a running server (runserver, gunicorn, uvicorn) over HTTP."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _send(self, path, body, content_type):
+        request = urllib.request.Request(self.base_url + path, data=body, headers={'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def upload(self, path, filename, payload, content_type, fields):
+        boundary = uuid.uuid4().hex
+        chunks = []
+        for name, value in fields.items():
+            chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        chunks.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode()
+        )
+        chunks.append(payload)
+        chunks.append(f'\r\n--{boundary}--\r\n'.encode())
+        return self._send(path, b''.join(chunks), f'multipart/form-data; boundary={boundary}')
+
+    def post_json(self, path, body):
+        return self._send(path, json.dumps(body).encode(), 'application/json')
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the analyzer API in-process (default) or against --url with synthetic uploads. "
+        "Reports throughput, p50/p99 latency and peak RSS per endpoint, model and input."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Base URL of a running server, e.g. http://localhost:8000 (start it with GEMINI_STUB=True)")
+        parser.add_argument('--server-pid', type=int, help="PID of the --url server, for its peak RSS")
+        parser.add_argument('--endpoints', nargs='+', default=['predict', 'mitigate', 'chat'],
+                            choices=UPLOAD_ENDPOINTS + TEXT_ENDPOINTS)
+        parser.add_argument('--models', nargs='+', default=['v2'])
+        parser.add_argument('--formats', nargs='+', default=['png', 'jpeg', 'npy'], choices=['png', 'jpeg', 'npy'])
+        parser.add_argument('--sizes', nargs='+', type=int, default=[256, 1024])
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4])
+        parser.add_argument('--requests', type=int, default=20, help="Requests per scenario")
+        parser.add_argument('--tiled', action='store_true', help="Send tiled=true (full-resolution inference)")
+        parser.add_argument('--allow-cache', action='store_true',
+                            help="Repeat identical uploads (measures prediction/report cache hits)")
+        parser.add_argument('--stub-models', action='store_true',
+                            help="In-process only: serve random predictions instead of loading the models")
+        parser.add_argument('--timeout', type=float, default=300.0)
+        parser.add_argument('--output', default='bench_api.json')
+        parser.add_argument('--compare', help="Previous report to print the change against")
+
+    def handle(self, *args, **options):
+        if options['url']:
+            transport = HttpTransport(options['url'], options['timeout'])
+            if options['stub_models']:
+                raise CommandError("--stub-models only applies to in-process runs")
+        else:
+            transport = InProcessTransport()
+            # In-process runs never hit the network
+            llm.GEMINI_STUB = True
+            if options['stub_models']:
+                from analyzer.model_loader import ModelLoader
+                for model_key in options['models']:
+                    ModelLoader().install_model(model_key, StubSegmentationModel(), backend='stub')
+
+        self._counter = itertools.count()
+        results = []
+        for scenario in self._scenarios(options):
+            result = self._run_scenario(transport, scenario, options)
+            results.append(result)
+            self._print_result(result)
+
+        report = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'target': options['url'] or 'in-process',
+            'stub_models': options['stub_models'],
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f"Report written to {options['output']}")
+
+        if options['compare']:
+            self._compare(options['compare'], results)
+
+    def _scenarios(self, options):
+        for endpoint in options['endpoints']:
+            for concurrency in options['concurrency']:
+                if endpoint in TEXT_ENDPOINTS:
+                    yield {'endpoint': endpoint, 'model': None, 'format': None, 'size': None, 'concurrency': concurrency}
+                    continue
+                for model, fmt, size in itertools.product(options['models'], options['formats'], options['sizes']):
+                    yield {'endpoint': endpoint, 'model': model, 'format': fmt, 'size': size, 'concurrency': concurrency}
+
+    def _request_fn(self, transport, scenario, options):
+        endpoint = scenario['endpoint']
+        path = f"/api/{endpoint}/"
+
+        if endpoint in UPLOAD_ENDPOINTS:
+            filename, payload, content_type = synthetic_upload(scenario['format'], scenario['size'])
+            fields = {'model_type': scenario['model']}
+            if options['tiled']:
+                fields['tiled'] = 'true'
+
+            def send():
+                body = payload
+                if not options['allow_cache']:
+                    # Trailing bytes are ignored by the decoders but change the upload digest
+                    body = payload + next(self._counter).to_bytes(8, 'little')
+                return transport.upload(path, filename, body, content_type, fields)
+            return send
+
+        if endpoint == 'chat':
+            def send():
+                return transport.post_json(path, {'message': 'Is this scene good for solar?',
+                                                  'image_metrics': {'Clear': 70.0, 'Shadow': 5.0}})
+            return send
+
+        def send():
+            clear = 90.0 if options['allow_cache'] else random.uniform(0, 100)
+            return transport.post_json(path, {'percentages': {'Clear': clear, 'Shadow': 100 - clear}})
+        return send
+
+    def _run_scenario(self, transport, scenario, options):
+        send = self._request_fn(transport, scenario, options)
+        send()  # warm-up: model load, first-call allocations
+
+        timings = []
+        errors = []
+        lock = threading.Lock()
+
+        def one_request(_):
+            started = time.perf_counter()
+            try:
+                status_code, _ = send()
+            except Exception as e:
+                status_code = str(e)
+            elapsed = (time.perf_counter() - started) * 1000.0
+            with lock:
+                timings.append(elapsed)
+                if status_code != 200:
+                    errors.append(status_code)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=scenario['concurrency']) as pool:
+            list(pool.map(one_request, range(options['requests'])))
+        wall = time.perf_counter() - started
+
+        if options['url']:
+            peak = peak_rss_bytes(options['server_pid']) if options['server_pid'] else None
+        else:
+            peak = peak_rss_bytes()
+        return dict(
+            scenario,
+            requests=options['requests'],
+            errors=len(errors),
+            error_codes=sorted({str(e) for e in errors}),
+            throughput_rps=options['requests'] / wall if wall > 0 else 0.0,
+            peak_rss_mb=(peak / 1e6) if peak is not None else None,
+            **latency_summary(timings),
+        )
+
+    @staticmethod
+    def _key(result):
+        return (result['endpoint'], result['model'], result['format'], result['size'], result['concurrency'])
+
+    @staticmethod
+    def _label(result):
+        parts = [result['endpoint']]
+        if result['model']:
+            parts.append(f"{result['model']} {result['format']} {result['size']}px")
+        parts.append(f"c={result['concurrency']}")
+        return ' '.join(parts)
+
+    def _print_result(self, result):
+        rss = f"{result['peak_rss_mb']:.0f}MB" if result['peak_rss_mb'] is not None else 'n/a'
+        self.stdout.write(
+            f"{self._label(result):<40} {result['throughput_rps']:>8.2f} req/s  "
+            f"p50 {result['p50_ms']:>9.1f}ms  p99 {result['p99_ms']:>9.1f}ms  "
+            f"rss {rss:>7}  errors {result['errors']}"
+        )
+
+    def _compare(self, path, results):
+        if not os.path.exists(path):
+            raise CommandError(f"No report at {path}")
+        with open(path) as f:
+            previous = {self._key(r): r for r in json.load(f)['results']}
+
+        self.stdout.write(f"\nChange against {path}:")
+        for result in results:
+            before = previous.get(self._key(result))
+            if before is None:
+                continue
+            self.stdout.write(
+                f"{self._label(result):<40} throughput {self._ratio(result['throughput_rps'], before['throughput_rps'])}  "
+                f"p50 {self._ratio(result['p50_ms'], before['p50_ms'])}  p99 {self._ratio(result['p99_ms'], before['p99_ms'])}"
+            )
+
+    @staticmethod
+    def _ratio(now, before):
+        if not before:
+            return '   n/a'
+        return f"{(now / before - 1) * 100:+6.1f}%"
@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer.benchmarking import synthetic_prediction, time_callable
+from analyzer.utils import fused_postprocess
+
+
+def legacy_postprocess(prediction):
+    """
+    The pre-LUT path, kept here as the benchmark baseline: argmax + boolean-mask remap,
+    np.bincount, boolean-mask grayscale, boolean-mask heatmap + applyColorMap + cvtColor.
+    """
+    pred_mask = np.argmax(prediction, axis=-1)[0]
+    mask = np.zeros_like(pred_mask)
+    mask[pred_mask == 2] = 1
+    mask[pred_mask == 3] = 2
+    mask[pred_mask == 4] = 3
+
+    counts = np.bincount(mask.flatten(), minlength=4)
+
+    gray = np.zeros(mask.shape, dtype=np.uint8)
+    gray[mask == 1] = 85
+    gray[mask == 2] = 170
+    gray[mask == 3] = 255
+
+    heat = np.zeros(mask.shape, dtype=np.uint8)
+    heat[mask == 0] = 255
+    heat[mask == 2] = 127
+    heat[mask == 1] = 25
+    heat[mask == 3] = 25
+    heatmap = cv2.cvtColor(cv2.applyColorMap(heat, cv2.COLORMAP_JET), cv2.COLOR_BGR2RGB)
+
+    return mask, gray, heatmap, counts
+
+
+class Command(BaseCommand):
+    help = "Compares the fused LUT post-processing stage with the previous multi-pass path."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[256, 1024, 4096])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'size':>6}  {'legacy p50':>12}  {'fused p50':>12}  {'speedup':>8}")
+        for size in options['sizes']:
+            prediction = synthetic_prediction(size)
+
+            # Both paths must agree before their timings mean anything
+            legacy = legacy_postprocess(prediction)
+            fused = fused_postprocess(prediction)
+            for name, a, b in zip(('mask', 'gray', 'heatmap', 'counts'), legacy, fused):
+                if not np.array_equal(a, b):
+                    raise CommandError(f"Fused output '{name}' differs from the legacy path at {size}x{size}")
+
+            repeat = options['repeat'] if size <= 1024 else max(3, options['repeat'] // 5)
+            legacy_t = time_callable(lambda: legacy_postprocess(prediction), repeat=repeat)
+            fused_t = time_callable(lambda: fused_postprocess(prediction), repeat=repeat)
+            self.stdout.write(
+                f"{size:>6}  {legacy_t['p50_ms']:>10.2f}ms  {fused_t['p50_ms']:>10.2f}ms  "
+                f"{legacy_t['p50_ms'] / fused_t['p50_ms']:>7.2f}x"
+            )
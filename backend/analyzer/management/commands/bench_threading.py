@@ -0,0 +1,178 @@
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer.benchmarking import latency_summary
+
+# Lines of the per-process protocol on stdout; everything else (model loading logs) is ignored
+READY = 'BENCH-READY'
+RESULT = 'BENCH-RESULT '
+
+
+def available_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+class Command(BaseCommand):
+    help = (
+        "Sweeps TensorFlow intra-op/inter-op thread counts, oneDNN and CPU pinning with several "
+        "model processes running at once (as gunicorn workers would) and reports the configuration "
+        "with the best throughput and the best tail latency on this host."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='v2')
+        parser.add_argument('--processes', type=int, default=2, help="Concurrent model processes (workers per node)")
+        parser.add_argument('--intra', nargs='+', type=int, default=[0, 1, 2, 4], help="0 = TensorFlow default")
+        parser.add_argument('--inter', nargs='+', type=int, default=[0, 1, 2], help="0 = TensorFlow default")
+        parser.add_argument('--onednn', nargs='+', default=['default'], choices=['default', 'True', 'False'])
+        parser.add_argument('--pinning', nargs='+', default=['off', 'auto'], choices=['off', 'auto'],
+                            help="auto gives each process its own block of <cpus / processes> cores")
+        parser.add_argument('--batch-size', type=int, default=1)
+        parser.add_argument('--requests', type=int, default=30, help="Timed predict calls per process")
+        parser.add_argument('--timeout', type=float, default=600.0, help="Seconds allowed per configuration")
+        parser.add_argument('--output', default='bench_threading.json')
+        # Internal: run as one of the measured processes
+        parser.add_argument('--worker', action='store_true', help="(internal) measure this process and print the result")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            return self._run_worker(options)
+
+        cpus = available_cpus()
+        configs = list(itertools.product(options['intra'], options['inter'], options['onednn'], options['pinning']))
+        self.stdout.write(f"{len(configs)} configurations, {options['processes']} processes each, {cpus} CPUs\n")
+        self.stdout.write(f"{'intra':>5} {'inter':>5} {'onednn':>8} {'pinning':>7}  {'rows/s':>9}  {'p50':>10}  {'p99':>10}")
+
+        results = []
+        for intra, inter, onednn, pinning in configs:
+            config = {'intra_op_threads': intra, 'inter_op_threads': inter, 'onednn': onednn, 'pinning': pinning}
+            try:
+                result = dict(config, **self._run_config(config, cpus, options))
+            except CommandError as e:
+                self.stderr.write(f"{config}: {e}")
+                continue
+            results.append(result)
+            self.stdout.write(
+                f"{intra:>5} {inter:>5} {onednn:>8} {pinning:>7}  {result['throughput_rows_per_s']:>9.2f}  "
+                f"{result['p50_ms']:>8.1f}ms  {result['p99_ms']:>8.1f}ms"
+            )
+
+        if not results:
+            raise CommandError("No configuration completed")
+        best_throughput = max(results, key=lambda r: r['throughput_rows_per_s'])
+        best_latency = min(results, key=lambda r: r['p99_ms'])
+        report = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'model': options['model'],
+            'processes': options['processes'],
+            'cpus': cpus,
+            'batch_size': options['batch_size'],
+            'results': results,
+            'best_throughput': best_throughput,
+            'best_latency': best_latency,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.stdout.write(f"\nBest throughput: {self._settings(best_throughput, options['processes'], cpus)}")
+        self.stdout.write(f"Best p99 latency: {self._settings(best_latency, options['processes'], cpus)}")
+        self.stdout.write(f"Report written to {options['output']}")
+
+    @staticmethod
+    def _settings(result, processes, cpus):
+        """The environment that reproduces a configuration in production."""
+        settings = [f"TF_INTRA_OP_THREADS={result['intra_op_threads']}", f"TF_INTER_OP_THREADS={result['inter_op_threads']}"]
+        if result['onednn'] != 'default':
+            settings.append(f"TF_ONEDNN={result['onednn']}")
+        if result['pinning'] == 'auto':
+            settings.append(f"CPU_AFFINITY_CORES={max(1, cpus // processes)}")
+        return ' '.join(settings) + f"  ({result['throughput_rows_per_s']:.2f} rows/s, p99 {result['p99_ms']:.1f}ms)"
+
+    def _run_config(self, config, cpus, options):
+        """Starts the processes, releases them together once all are warm, and merges their timings."""
+        with tempfile.TemporaryDirectory() as slot_dir:
+            # Fresh processes: thread pools and oneDNN cannot change once TensorFlow is initialized
+            env = dict(
+                os.environ,
+                TF_INTRA_OP_THREADS=str(config['intra_op_threads']),
+                TF_INTER_OP_THREADS=str(config['inter_op_threads']),
+                TF_ONEDNN='' if config['onednn'] == 'default' else config['onednn'],
+                CPU_AFFINITY='',
+                CPU_AFFINITY_CORES=str(max(1, cpus // options['processes'])) if config['pinning'] == 'auto' else '0',
+                CPU_SLOT_DIR=slot_dir,
+                INFERENCE_SERVER_SOCKET='',
+            )
+            command = [sys.executable, sys.argv[0], 'bench_threading', '--worker', '--model', options['model'],
+                       '--batch-size', str(options['batch_size']), '--requests', str(options['requests'])]
+            workers = [subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                       for _ in range(options['processes'])]
+            # A stuck configuration is killed, which ends its reads with a CommandError
+            watchdog = threading.Timer(options['timeout'], lambda: [worker.kill() for worker in workers])
+            watchdog.start()
+            try:
+                for worker in workers:
+                    self._read_until(worker, READY)
+                for worker in workers:
+                    worker.stdin.write('go\n')
+                    worker.stdin.flush()
+                outputs = [json.loads(self._read_until(worker, RESULT)[len(RESULT):]) for worker in workers]
+                for worker in workers:
+                    worker.wait(timeout=options['timeout'])
+            finally:
+                watchdog.cancel()
+                for worker in workers:
+                    if worker.poll() is None:
+                        worker.kill()
+
+        timings = [t for output in outputs for t in output['timings_ms']]
+        rows = sum(output['rows'] for output in outputs)
+        wall = max(output['elapsed_seconds'] for output in outputs)
+        return dict(
+            throughput_rows_per_s=rows / wall if wall > 0 else 0.0,
+            pinned_cpus=[output['pinned_cpus'] for output in outputs],
+            **latency_summary(timings),
+        )
+
+    @staticmethod
+    def _read_until(worker, marker):
+        for line in worker.stdout:
+            if line.startswith(marker):
+                return line.rstrip('\n')
+        raise CommandError(f"Benchmark process exited with code {worker.wait()} before reporting")
+
+    def _run_worker(self, options):
+        from analyzer.model_loader import ModelLoader
+        from analyzer.tf_runtime import runtime_info
+
+        model = ModelLoader().load_model(options['model'])
+        if model is None:
+            raise CommandError(f"Model {options['model']} could not be loaded")
+        batch = np.random.default_rng(os.getpid()).random((options['batch_size'], 256, 256, 8), dtype=np.float32)
+        for _ in range(2):
+            model.predict(batch, verbose=0)  # Graph tracing and first-call allocations
+
+        print(READY, flush=True)
+        sys.stdin.readline()
+        timings = []
+        started = time.perf_counter()
+        for _ in range(options['requests']):
+            call_started = time.perf_counter()
+            model.predict(batch, verbose=0)
+            timings.append((time.perf_counter() - call_started) * 1000.0)
+        elapsed = time.perf_counter() - started
+
+        print(RESULT + json.dumps({
+            'timings_ms': timings,
+            'rows': options['requests'] * options['batch_size'],
+            'elapsed_seconds': elapsed,
+            'pinned_cpus': runtime_info()['pinned_cpus'],
+        }), flush=True)
@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer import mitigation, utils
+from analyzer.benchmarking import synthetic_image, synthetic_prediction, synthetic_upload, time_callable
+
+# .npy uploads are (size, size, 8) float32: 512 MB at 4096, so they stop at 1024
+NPY_MAX_SIZE = 1024
+
+
+def upload(fmt, size):
+    """A fresh file object per call, as a view would get it."""
+    filename, payload, _ = synthetic_upload(fmt, size)
+
+    def make():
+        file_obj = io.BytesIO(payload)
+        file_obj.name = filename
+        return file_obj
+    return make
+
+
+def input_tensor(size):
+    """What segment() hands on at this size: (1, 256, 256, 8) resized input, or the (1, H, W, 3) tiled scene."""
+    if size == 256:
+        tensor = np.zeros((1, 256, 256, 8), dtype=np.float32)
+        tensor[0, :, :, :3] = synthetic_image(256) / 255.0
+        return tensor
+    return (synthetic_image(size) / np.float32(255.0))[np.newaxis]
+
+
+def cases(size):
+    """(name, fn) pairs for one input size. Inputs are built once; fn only runs the function under test."""
+    prediction = synthetic_prediction(size)
+    mask = utils.remap_classes(prediction)
+    tensor = input_tensor(size)
+    png = upload('png', size)
+    # All 8 bands, for the multi-band mitigation engine
+    bands = np.random.default_rng(0).random((size, size, 8), dtype=np.float32) if size <= NPY_MAX_SIZE else None
+    jpeg = upload('jpeg', size)
+
+    # Full decode then resize (the pre-draft path) vs. the reduced-resolution decode preprocessing uses
+    yield 'decode[jpeg,full]', lambda: Image.open(jpeg()).convert('RGB').resize((256, 256))
+    yield 'decode[jpeg,draft]', lambda: utils.decode_resized(jpeg())
+    yield 'decode[png]', lambda: utils.decode_resized(png())
+    yield 'preprocess_v1', lambda: utils.preprocess_v1(png())
+    yield 'preprocess_v2', lambda: utils.preprocess_v2(png())
+    yield 'preprocess_v3', lambda: utils.preprocess_v3(png())
+    if size <= NPY_MAX_SIZE:
+        npy = upload('npy', size)
+        yield 'preprocess_v2[npy]', lambda: utils.preprocess_v2(npy())
+    yield 'remap_classes', lambda: utils.remap_classes(prediction)
+    yield 'mask_to_base64', lambda: utils.mask_to_base64(mask)
+    yield 'mitigate_shadows', lambda: mitigation.mitigate_shadows(tensor, mask)
+    yield 'mitigate_shadows_legacy', lambda: utils.mitigate_shadows_legacy(tensor, mask)
+    if size <= NPY_MAX_SIZE:
+        yield 'mitigate_bands', lambda: mitigation.mitigate_bands(bands, mask)
+    yield 'generate_preview_image', lambda: utils.generate_preview_image(tensor)
+    yield 'generate_solar_heatmap', lambda: utils.generate_solar_heatmap(mask)
+
+
+def peak_allocation(fn):
+    """Peak bytes allocated (Python and NumPy) during one call."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Command(BaseCommand):
+    help = (
+        "Microbenchmarks the per-request helpers in analyzer.utils on fixed synthetic inputs. "
+        "Tracks time and peak allocations and fails on regressions against a saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[256, 1024, 4096])
+        parser.add_argument('--functions', nargs='+', help="Only these functions (default: all)")
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--baseline', default='bench_utils_baseline.json')
+        parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="Allowed slowdown / allocation growth over the baseline (0.25 = 25%%)")
+        parser.add_argument('--output', help="Also write this run's results to a JSON file")
+
+    def handle(self, *args, **options):
+        results = {}
+        self.stdout.write(f"{'function':<24} {'size':>6}  {'p50':>10}  {'min':>10}  {'peak alloc':>12}")
+        for size in options['sizes']:
+            # Fewer runs for the big inputs, as in bench_postprocess
+            repeat = options['repeat'] if size <= 1024 else max(3, options['repeat'] // 5)
+            for name, fn in cases(size):
+                if options['functions'] and name.split('[')[0] not in options['functions']:
+                    continue
+                timing = time_callable(fn, repeat=repeat)
+                allocated = peak_allocation(fn)
+                results[f"{name}@{size}"] = dict(timing, peak_alloc_bytes=allocated)
+                self.stdout.write(
+                    f"{name:<24} {size:>6}  {timing['p50_ms']:>8.2f}ms  {timing['min_ms']:>8.2f}ms  "
+                    f"{allocated / 1e6:>10.1f}MB"
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Baseline written to {options['baseline']}")
+        elif os.path.exists(options['baseline']):
+            self._check_regressions(results, options['baseline'], options['threshold'])
+        else:
+            self.stdout.write(f"No baseline at {options['baseline']}; run with --save-baseline to create one.")
+
+    def _check_regressions(self, results, path, threshold):
+        with open(path) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        self.stdout.write(f"\nAgainst {path} (threshold {threshold:.0%}):")
+        for key, result in results.items():
+            before = baseline.get(key)
+            if before is None:
+                continue
+            time_change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+            alloc_change = (result['peak_alloc_bytes'] / before['peak_alloc_bytes'] - 1
+                            if before['peak_alloc_bytes'] else 0.0)
+            flagged = time_change > threshold or alloc_change > threshold
+            self.stdout.write(f"{key:<32} time {time_change:+7.1%}  alloc {alloc_change:+7.1%}{'  REGRESSION' if flagged else ''}")
+            if flagged:
+                regressions.append(key)
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmark(s) regressed beyond {threshold:.0%}: {', '.join(regressions)}")
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer.tflite_backend import TFLITE_MODES, TFLiteModel, convert_model, load_patches, mean_iou, tflite_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Converts the .keras models behind MODEL_PATH_V1/V2/V3 to dynamic-range and full-int8 TFLite, "
+        "then reports the mean-IoU drop and latency against the Keras model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', default=['v1', 'v2', 'v3'])
+        parser.add_argument('--modes', nargs='+', default=list(TFLITE_MODES), choices=TFLITE_MODES)
+        parser.add_argument('--calibration-dir', required=True,
+                            help="Directory of preprocessed (256, 256, 8) .npy image patches")
+        parser.add_argument('--calibration-samples', type=int, default=100)
+        parser.add_argument('--eval-dir',
+                            help="Split directory with images/ and masks/ subfolders for the parity check")
+        parser.add_argument('--eval-samples', type=int, default=50)
+        parser.add_argument('--latency-runs', type=int, default=20)
+        parser.add_argument('--report', help="Write the parity/latency report to this JSON file")
+
+    def handle(self, *args, **options):
+        import tensorflow as tf
+        from analyzer.model_loader import _model_config
+
+        calibration, _ = load_patches(options['calibration_dir'], options['calibration_samples'])
+        if not calibration:
+            raise CommandError(f"No .npy patches found in {options['calibration_dir']}")
+
+        eval_images, eval_masks = self._load_eval_set(options['eval_dir'], options['eval_samples'], calibration)
+
+        report = {}
+        for model_key in options['models']:
+            # Always the Keras model, regardless of the MODEL_BACKEND_* serving setting
+            keras_path, custom_objects = _model_config(model_key)
+            if not os.path.exists(keras_path):
+                raise CommandError(f"Keras model for {model_key} not found at {keras_path}")
+            keras_model = tf.keras.models.load_model(keras_path, custom_objects=custom_objects)
+
+            keras_preds = self._predict_masks(keras_model, eval_images)
+            keras_latency = self._latency(keras_model, eval_images[0], options['latency_runs'])
+            model_report = {
+                'keras': {
+                    'path': keras_path,
+                    'size_bytes': os.path.getsize(keras_path),
+                    'latency_ms': keras_latency,
+                    'mean_iou': self._mean_iou(keras_preds, eval_masks, keras_preds),
+                }
+            }
+
+            for mode in options['modes']:
+                output_path = tflite_path(model_key, mode, keras_path)
+                self.stdout.write(f"Converting {model_key} -> {output_path} ({mode})...")
+                content = convert_model(keras_model, mode, calibration)
+                with open(output_path, 'wb') as f:
+                    f.write(content)
+
+                tflite_model = TFLiteModel(output_path, pool_size=1)
+                tflite_preds = self._predict_masks(tflite_model, eval_images)
+                tflite_iou = self._mean_iou(tflite_preds, eval_masks, keras_preds)
+                model_report[mode] = {
+                    'path': output_path,
+                    'size_bytes': len(content),
+                    'latency_ms': self._latency(tflite_model, eval_images[0], options['latency_runs']),
+                    'mean_iou': tflite_iou,
+                    'mean_iou_drop': model_report['keras']['mean_iou'] - tflite_iou,
+                    'agreement_with_keras': self._mean_iou(tflite_preds, None, keras_preds),
+                }
+
+            report[model_key] = model_report
+            self._print_model_report(model_key, model_report)
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['report']}")
+
+    def _load_eval_set(self, eval_dir, limit, fallback):
+        """Ground-truth patches when an eval split is given, else the calibration patches without masks."""
+        if not eval_dir:
+            return fallback[:limit], None
+
+        images, paths = load_patches(os.path.join(eval_dir, 'images'), limit)
+        masks = []
+        for path in paths:
+            mask_path = os.path.join(eval_dir, 'masks', os.path.basename(path))
+            masks.append(np.load(mask_path) if os.path.exists(mask_path) else None)
+        if not images:
+            raise CommandError(f"No .npy patches found in {eval_dir}/images")
+        return images, masks
+
+    @staticmethod
+    def _predict_masks(model, images):
+        return [np.argmax(model.predict(np.expand_dims(img, axis=0), verbose=0)[0], axis=-1) for img in images]
+
+    @staticmethod
+    def _mean_iou(preds, true_masks, reference_preds):
+        """mIoU against ground truth where available, otherwise against the Keras predictions."""
+        scores = []
+        for i, pred in enumerate(preds):
+            target = true_masks[i] if true_masks and true_masks[i] is not None else reference_preds[i]
+            scores.append(mean_iou(pred, target))
+        return float(np.mean(scores))
+
+    @staticmethod
+    def _latency(model, sample, runs):
+        batch = np.expand_dims(sample, axis=0)
+        model.predict(batch, verbose=0)  # warm-up
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            model.predict(batch, verbose=0)
+            timings.append((time.perf_counter() - started) * 1000.0)
+        return {
+            'p50': float(np.percentile(timings, 50)),
+            'p95': float(np.percentile(timings, 95)),
+            'mean': float(np.mean(timings)),
+        }
+
+    def _print_model_report(self, model_key, model_report):
+        self.stdout.write(f"\n=== {model_key} ===")
+        for backend, r in model_report.items():
+            line = (f"  {backend:8s} size={r['size_bytes'] / 1e6:7.1f} MB  "
+                    f"p50={r['latency_ms']['p50']:8.1f} ms  mIoU={r['mean_iou']:.4f}")
+            if 'mean_iou_drop' in r:
+                line += f"  drop={r['mean_iou_drop']:+.4f}  agreement={r['agreement_with_keras']:.4f}"
+            self.stdout.write(line)
@@ -0,0 +1,67 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer import inference_server
+from analyzer.inference_server import DEFAULT_SOCKET_PATH, InferenceClient, InferenceServer, InferenceServerError
+from analyzer.warmup import PRELOAD_MODELS, warm_up_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the inference server: one process that loads the models and serves every Django worker "
+        "on the host over a Unix socket. Point the workers at it with INFERENCE_SERVER_SOCKET."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=inference_server.INFERENCE_SERVER_SOCKET or DEFAULT_SOCKET_PATH)
+        parser.add_argument('--models', nargs='+', default=PRELOAD_MODELS or ['v2'],
+                            help="Loaded and warmed up at startup; other keys load on first use")
+        parser.add_argument('--no-warmup', action='store_true', help="Only load the models, skip the dummy batches")
+        parser.add_argument('--check', action='store_true',
+                            help="Print the health report of the server on --socket and exit (non-zero if unreachable)")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            try:
+                health = InferenceClient(options['socket']).health()
+            except InferenceServerError as e:
+                raise CommandError(str(e))
+            self.stdout.write(json.dumps(health, indent=2))
+            if health['status'] != 'ok':
+                raise CommandError(f"Inference server is {health['status']}")
+            return
+
+        # This process serves the models itself, whatever the shared environment says
+        inference_server.INFERENCE_SERVER_SOCKET = ''
+        try:
+            server = InferenceServer(options['socket'])
+        except InferenceServerError as e:
+            raise CommandError(str(e))
+
+        for model_key in options['models']:
+            try:
+                if options['no_warmup']:
+                    from analyzer.model_loader import ModelLoader
+                    if ModelLoader().load_model(model_key) is None:
+                        raise RuntimeError(f"Model {model_key} could not be loaded")
+                else:
+                    server.warmup[model_key] = warm_up_model(model_key)
+            except Exception as e:
+                self.stderr.write(f"Could not load {model_key}: {e}")
+                server.load_errors[model_key] = str(e)
+
+        # shutdown() blocks until serve_forever returns, so it cannot run on the serving thread
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(f"Inference server listening on {options['socket']} (models: {', '.join(options['models'])})")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        self.stdout.write("Inference server stopped.")
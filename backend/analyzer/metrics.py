@@ -0,0 +1,180 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# --- METRICS CONFIGURATION ---
+# Most recent observations per series that the quantiles are computed over
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '1024'))
+QUANTILES = (0.5, 0.95, 0.99)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Model key of the request being served, so deep helpers (decode) can label their timings
+current_model = contextvars.ContextVar('current_model', default='none')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _quantile(ordered, q):
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Summary:
+    """Sliding-window quantiles plus a running count and sum, one series per label set."""
+
+    kind = 'summary'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [window, count, sum]
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [deque(maxlen=METRICS_WINDOW), 0, 0.0]
+            series[0].append(value)
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = [(values, sorted(s[0]), s[1], s[2]) for values, s in self._series.items()]
+        lines = []
+        for values, ordered, count, total in sorted(snapshot):
+            labels = list(zip(self.labelnames, values))
+            for q in QUANTILES:
+                lines.append(f"{self.name}{_format_labels(labels + [('quantile', q)])} {_quantile(ordered, q)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(list(zip(self.labelnames, values)))} {value}" for values, value in snapshot]
+
+
+class Registry:
+    """
+    Metrics recorded by the request path, plus collectors that read live state
+    (queue depth, model memory, ...) when the endpoint is scraped.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def summary(self, name, documentation, labelnames=()):
+        metric = Summary(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """fn() -> iterable of (name, kind, documentation, [(labels dict, value), ...])."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                families = list(fn())
+            except Exception as e:
+                print(f"Metrics collector {fn.__name__} failed: {e}")
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.summary(
+    'cloudvision_stage_seconds', 'Time spent in each request stage, excluding nested stages.', ('stage', 'model'))
+encoder_seconds = registry.summary(
+    'cloudvision_encoder_seconds', 'Time spent encoding each output image.', ('encoder',))
+chat_ttft_seconds = registry.summary(
+    'cloudvision_chat_time_to_first_token_seconds', 'Time from the chat stream request to its first token.')
+segmentations_total = registry.counter(
+    'cloudvision_segmentations_total', 'Segmentation requests by model and prediction cache outcome.', ('model', 'cache'))
+
+_local = threading.local()
+
+
+@contextmanager
+def model_context(model_key):
+    """Labels stage timings recorded on this thread/task with the model key."""
+    token = current_model.set(model_key)
+    try:
+        yield
+    finally:
+        current_model.reset(token)
+
+
+@contextmanager
+def stage_timer(stage, model_key=None):
+    """
+    Times a stage into cloudvision_stage_seconds. Nested stages are subtracted from
+    the enclosing one, so e.g. 'preprocess' does not double count 'decode'.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0.0)  # time spent in nested stages
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        stage_seconds.observe(elapsed - nested, stage, model_key or current_model.get())
+
+
+def observe_stage(stage, model_key, seconds):
+    """Records a stage timing measured elsewhere (e.g. the batcher's queue wait)."""
+    stage_seconds.observe(seconds, stage, model_key)
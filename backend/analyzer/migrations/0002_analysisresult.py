@@ -0,0 +1,38 @@
+# Generated by Django 5.0 on 2026-10-17 03:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=160, unique=True)),
+                ('digest', models.CharField(db_index=True, max_length=64)),
+                ('model_type', models.CharField(max_length=8)),
+                ('tiled', models.BooleanField(default=False)),
+                ('input_name', models.CharField(blank=True, max_length=255)),
+                ('height', models.PositiveIntegerField()),
+                ('width', models.PositiveIntegerField()),
+                ('percentages', models.JSONField()),
+                ('has_shadow', models.BooleanField(default=False)),
+                ('image_format', models.CharField(blank=True, max_length=32)),
+                ('path', models.CharField(max_length=512)),
+                ('size_bytes', models.BigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
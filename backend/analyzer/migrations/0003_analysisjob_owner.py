@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-17 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0002_analysisresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='owner',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+    ]
@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+
+
+# --- SHADOW MITIGATION CONFIGURATION ---
+# Histogram bins per band for mitigate_bands (mitigate_shadows always uses 256, as it outputs uint8)
+MITIGATION_BINS = int(os.getenv('MITIGATION_BINS', '1024'))
+# Scenes are processed this many rows at a time, so memory-mapped inputs are never fully resident
+MITIGATION_BLOCK_ROWS = int(os.getenv('MITIGATION_BLOCK_ROWS', '512'))
+
+# Display classes (see remap_classes): CLEAR pixels are matched onto the SHADOW distribution
+CLEAR = 0
+SHADOW = 1
+
+
+def _row_blocks(height, block_rows):
+    step = max(1, block_rows)
+    for top in range(0, height, step):
+        yield slice(top, min(top + step, height))
+
+
+def _band_index(bands):
+    """A slice for contiguous band lists (a view instead of a fancy-indexing copy)."""
+    if list(bands) == list(range(bands[0], bands[0] + len(bands))):
+        return slice(bands[0], bands[0] + len(bands))
+    return list(bands)
+
+
+def _read(data, rows, bands):
+    return np.asarray(data[rows][..., _band_index(bands)])
+
+
+def band_ranges(data, bands, joint=False, block_rows=MITIGATION_BLOCK_ROWS):
+    """
+    Per-band (lo, hi) of data[..., bands], computed a block of rows at a time.
+    joint=True gives every band the min/max over all of them (the legacy RGB behaviour).
+    Returned in data's dtype (min/max cannot overflow); quantize() and mitigate_bands()
+    widen them before subtracting.
+    """
+    lo = hi = None
+    for rows in _row_blocks(data.shape[0], block_rows):
+        block = _read(data, rows, bands)
+        # Band by band: reducing over the leading axes of a (rows, W, 3) array is several times slower
+        block_lo = np.array([block[..., b].min() for b in range(len(bands))], dtype=block.dtype)
+        block_hi = np.array([block[..., b].max() for b in range(len(bands))], dtype=block.dtype)
+        lo = block_lo if lo is None else np.minimum(lo, block_lo)
+        hi = block_hi if hi is None else np.maximum(hi, block_hi)
+    if joint:
+        lo = np.full_like(lo, lo.min())
+        hi = np.full_like(hi, hi.max())
+    return lo, hi
+
+
+def quantize(block, lo, hi, bins):
+    """
+    (rows, W, B) values -> bin indices in [0, bins). Matches the legacy
+    ((x - min) / (max - min) * 255).astype(uint8) exactly for bins=256.
+    """
+    dtype = np.uint8 if bins <= 256 else np.uint16
+    # Float inputs keep their precision, as in the legacy code; integer inputs (memory-mapped
+    # .npy uploads keep their stored dtype) are scaled in float64 like the legacy true division
+    work = block.dtype if np.issubdtype(block.dtype, np.floating) else np.float64
+    lo = np.asarray(lo).astype(work)
+    span = np.asarray(hi).astype(work) - lo
+    flat = span <= 0
+    if flat.any():
+        # Constant band: the legacy code skipped the scaling
+        norm = np.where(flat, block, np.subtract(block, lo, dtype=work) / np.where(flat, 1, span))
+        return np.clip(norm * (bins - 1), 0, bins - 1).astype(dtype)
+
+    # Same operations as (x - lo) / span * (bins - 1), in place. Values already lie in [0, bins - 1].
+    norm = np.subtract(block, lo, dtype=work)
+    norm /= span
+    norm *= bins - 1
+    return norm.astype(dtype)
+
+
+def _class_keys(mask_block, bins):
+    """Mask class * bins, so class and bin index combine into one lookup/bincount key."""
+    return mask_block.astype(np.intp) * bins
+
+
+def class_histograms(data, mask, bands, lo, hi, bins, block_rows=MITIGATION_BLOCK_ROWS, keep_indices=False):
+    """
+    (B, bins) np.bincount histograms of the CLEAR (source) and SHADOW (reference) pixels per band.
+    keep_indices=True also returns the quantized blocks, so the apply pass can skip quantizing again.
+    """
+    kept = [] if keep_indices else None
+    source = np.zeros((len(bands), bins), dtype=np.int64)
+    reference = np.zeros((len(bands), bins), dtype=np.int64)
+    for rows in _row_blocks(data.shape[0], block_rows):
+        indices = quantize(_read(data, rows, bands), lo, hi, bins)
+        if kept is not None:
+            kept.append(indices)
+        block_mask = np.asarray(mask[rows])
+        keys = _class_keys(block_mask, bins)
+        classes = max(int(block_mask.max()) + 1, SHADOW + 1) if block_mask.size else SHADOW + 1
+        for b in range(len(bands)):
+            # One bincount per band covers every class: row c of the result is class c's histogram
+            counts = np.bincount((keys + indices[..., b]).ravel(), minlength=classes * bins).reshape(classes, bins)
+            source[b] += counts[CLEAR]
+            reference[b] += counts[SHADOW]
+    return source, reference, kept
+
+
+def _class_tables(luts, classes):
+    """
+    (B, classes * bins) tables indexed by class * bins + bin: the matching LUT for CLEAR,
+    the identity for every other class.
+    """
+    bands, bins = luts.shape
+    tables = np.tile(np.arange(bins, dtype=luts.dtype), (bands, classes))
+    tables[:, CLEAR * bins:(CLEAR + 1) * bins] = luts
+    return tables
+
+
+def matching_luts(source, reference):
+    """
+    (B, bins) float lookup tables mapping a source bin to the reference bin with the same CDF
+    value (np.interp between the two CDFs). Bands without both classes map to themselves.
+    """
+    bins = source.shape[1]
+    luts = np.tile(np.arange(bins, dtype=np.float64), (source.shape[0], 1))
+    for b in range(source.shape[0]):
+        if not source[b].any() or not reference[b].any():
+            continue
+        src_cdf = np.cumsum(source[b]).astype(np.float64)
+        src_cdf /= src_cdf[-1]
+        # Only bins that occur in the reference are interpolation points, as with np.unique
+        ref_values = np.flatnonzero(reference[b])
+        ref_cdf = np.cumsum(reference[b])[ref_values].astype(np.float64)
+        ref_cdf /= ref_cdf[-1]
+        luts[b] = np.interp(src_cdf, ref_cdf, ref_values)
+    return luts
+
+
+def _fit(data, mask, bands, bins, joint, block_rows):
+    """Value ranges, matching LUTs and, for in-memory inputs, the quantized blocks (None for memmaps)."""
+    lo, hi = band_ranges(data, bands, joint=joint, block_rows=block_rows)
+    source, reference, kept = class_histograms(data, mask, bands, lo, hi, bins, block_rows,
+                                               keep_indices=not isinstance(data, np.memmap))
+    return lo, hi, matching_luts(source, reference), kept
+
+
+def mitigate_shadows(input_tensor, mask, block_rows=MITIGATION_BLOCK_ROWS):
+    """
+    Histogram matching of the Clear (0) regions onto the Shadow (1) distribution for the
+    RGB preview. Returns (H, W, 3) uint8, identical to mitigate_shadows_legacy, but with
+    fixed 256-bin histograms instead of a sort per channel, for (1, H, W, C) inputs of any
+    size (including memory-mapped scenes, read block by block).
+    """
+    data = input_tensor[0]
+    bands = [0, 1, 2]
+    lo, hi, luts, kept = _fit(data, mask, bands, 256, True, block_rows)
+    # The legacy code assigned the interpolated floats into a uint8 image, truncating them
+    tables = _class_tables(luts.astype(np.uint8), int(np.max(mask)) + 1)
+
+    out = np.empty(data.shape[:2] + (3,), dtype=np.uint8)
+    for i, rows in enumerate(_row_blocks(data.shape[0], block_rows)):
+        indices = kept[i] if kept is not None else quantize(_read(data, rows, bands), lo, hi, 256)
+        keys = _class_keys(np.asarray(mask[rows]), 256)
+        for b in range(3):
+            out[rows, :, b] = tables[b][keys + indices[..., b]]
+    return out
+
+
+def mitigate_bands(data, mask, bands=None, bins=MITIGATION_BINS, out=None, block_rows=MITIGATION_BLOCK_ROWS):
+    """
+    Histogram matching on the original band values of an (H, W, C) scene (e.g. all 8 bands).
+    Each band gets its own value range and `bins`-bin histograms; Clear pixels are replaced
+    by the matched bin mapped back to the band's units, everything else is copied unchanged.
+    Returns float32 (H, W, len(bands)), written into `out` (e.g. an np.memmap) if given.
+    """
+    bands = list(range(data.shape[-1])) if bands is None else list(bands)
+    lo, hi, luts, kept = _fit(data, mask, bands, bins, False, block_rows)
+    lo = lo.astype(np.float64)
+    span = hi.astype(np.float64) - lo  # hi - lo in an integer dtype could wrap
+    values = (lo[:, None] + luts / (bins - 1) * span[:, None]).astype(np.float32)
+
+    if out is None:
+        out = np.empty(data.shape[:2] + (len(bands),), dtype=np.float32)
+    for i, rows in enumerate(_row_blocks(data.shape[0], block_rows)):
+        block = _read(data, rows, bands)
+        indices = kept[i] if kept is not None else quantize(block, lo, hi, bins)
+        clear = (np.asarray(mask[rows]) == CLEAR)
+        for b in range(len(bands)):
+            out[rows, :, b] = np.where(clear, values[b][indices[..., b]], block[..., b])
+    return out
@@ -1,162 +1,283 @@
-import tensorflow as tf
-from tensorflow.keras import backend as K
+import gc
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from . import inference_server
+from .inference_server import InferenceServerError, RemoteModel, get_client
+from .tf_runtime import import_tensorflow, runtime_info
+from .tflite_backend import TFLiteModel, model_backend, tflite_path
+from .metrics import registry
 
-# --- V2 CONFIGURATION (Advanced) ---
-NUM_CLASSES = 5
-CLASS_WEIGHTS_DICT = {0: 3.531, 1: 0.430, 2: 15.000, 3: 1.708, 4: 0.569}
-# Create tensor (re-creating the clip logic used in training)
-weights_v2 = tf.constant([CLASS_WEIGHTS_DICT[i] for i in range(NUM_CLASSES)], dtype=tf.float32)
-weights_v2 = tf.clip_by_value(weights_v2, 0.2, 10.0)
-weights_v2 = weights_v2 / tf.reduce_mean(weights_v2)
-CLASS_WEIGHTS_TENSOR_V2 = weights_v2
-
-def weighted_categorical_crossentropy_v2(weights):
-    def loss(y_true, y_pred):
-        y_pred = K.clip(y_pred, K.epsilon(), 1 - K.epsilon())
-        loss_map = K.categorical_crossentropy(y_true, y_pred)
-        weight_map = K.sum(y_true * weights, axis=-1)
-        return K.mean(loss_map * weight_map)
-    return loss
-
-def multiclass_soft_dice_loss_v2(y_true, y_pred, smooth=1e-6):
-    y_true = tf.cast(y_true, tf.float32)
-    y_pred = tf.cast(y_pred, tf.float32)
-    axes = [0, 1, 2]
-    intersection = tf.reduce_sum(y_true * y_pred, axis=axes)
-    denominator = tf.reduce_sum(y_true + y_pred, axis=axes)
-    dice_per_class = (2. * intersection + smooth) / (denominator + smooth)
-    return 1.0 - tf.reduce_mean(dice_per_class)
-
-def combined_loss_v2(weights):
-    cce = weighted_categorical_crossentropy_v2(weights)
-    def loss(y_true, y_pred):
-        return 0.5 * cce(y_true, y_pred) + 0.5 * multiclass_soft_dice_loss_v2(y_true, y_pred)
-    return loss
-
-# --- V1 CONFIGURATION (Legacy) ---
-
-CLASS_WEIGHTS_DICT_V1 = {0: 3.531, 1: 0.430, 2: 15.000, 3: 1.708, 4: 0.569} # Assuming same weights were used
-CLASS_WEIGHTS_TENSOR_V1 = tf.constant([CLASS_WEIGHTS_DICT_V1[i] for i in range(NUM_CLASSES)], dtype=tf.float32)
-
-def weighted_categorical_crossentropy_v1(weights):
-    def loss(y_true, y_pred):
-        y_pred = K.clip(y_pred, K.epsilon(), 1 - K.epsilon())
-        loss_map = K.categorical_crossentropy(y_true, y_pred)
-        weight_map = K.sum(y_true * weights, axis=-1)
-        return K.mean(loss_map * weight_map)
-    return loss
-
-def dice_loss_v1(y_true, y_pred, smooth=1e-6):
-    y_true_f = K.flatten(y_true)
-    y_pred_f = K.flatten(y_pred)
-    intersection = K.sum(y_true_f * y_pred_f)
-    return 1 - (2. * intersection + smooth) / (K.sum(y_true_f) + K.sum(y_pred_f) + smooth)
-
-def combined_loss_v1(weights):
-    cce = weighted_categorical_crossentropy_v1(weights)
-    def loss(y_true, y_pred):
-        return 0.5 * cce(y_true, y_pred) + 0.5 * dice_loss_v1(y_true, y_pred)
-    return loss
-
-
-# --- V3 CONFIGURATION ---
-CLASS_WEIGHTS_DICT_V3 = {
-    0: 0.0,   # Fill
-    1: 0.5,   # Clear
-    2: 3.0,   # Shadow
-    3: 3.0,   # Thin Cloud
-    4: 1.0    # Thick Cloud
+# --- MODEL MEMORY BUDGET ---
+# 0 disables eviction. Otherwise the least recently used model is dropped before
+# loading one that would push resident weights over the budget.
+MODEL_MEMORY_BUDGET_BYTES = int(float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0')) * 1024 * 1024)
+
+
+# Weight files per model key, overridden by MODEL_PATH_V1/V2/V3. Unknown keys use v1's.
+MODEL_PATHS = {
+    'v3': 'Attention_UNet_Balanced_Final.keras',
+    'v2': 'Attention_UNet_Advanced_1.keras',
+    'v1': 'model.keras',
 }
-CLASS_WEIGHTS_TENSOR_V3 = tf.constant([CLASS_WEIGHTS_DICT_V3[i] for i in range(NUM_CLASSES)], dtype=tf.float32)
-
-def weighted_categorical_crossentropy_v3(weights):
-    def loss(y_true, y_pred):
-        y_pred = K.clip(y_pred, K.epsilon(), 1 - K.epsilon())
-        loss_map = K.categorical_crossentropy(y_true, y_pred)
-        # Calculate weight map based on true classes
-        weight_map = K.sum(y_true * weights, axis=-1)
-        # Return weighted loss
-        return loss_map * weight_map
-    return loss
-
-def multiclass_soft_dice_loss_v3(y_true, y_pred, smooth=1e-6):
-    """Per-channel Dice Loss to handle imbalance."""
-    y_true = tf.cast(y_true, tf.float32)
-    y_pred = tf.cast(y_pred, tf.float32)
-    axes = [0, 1, 2] # Batch, H, W
-
-    intersection = tf.reduce_sum(y_true * y_pred, axis=axes)
-    denominator = tf.reduce_sum(y_true + y_pred, axis=axes)
-
-    dice_per_class = (2. * intersection + smooth) / (denominator + smooth)
-    return 1.0 - tf.reduce_mean(dice_per_class)
-
-def combined_loss_v3(y_true, y_pred):
+
+
+def keras_path(model_key):
+    """The .keras file of a model key."""
+    key = model_key if model_key in MODEL_PATHS else 'v1'
+    return os.getenv(f'MODEL_PATH_{key.upper()}', MODEL_PATHS[key])
+
+
+def served_path(model_key, backend=None):
+    """The file a model key is served from: the .keras file, or its converted .tflite model."""
+    backend = backend or model_backend(model_key)
+    if backend.startswith('tflite'):
+        # 'tflite-dynamic' / 'tflite-int8' serve the converted model instead
+        return tflite_path(model_key, backend.split('-', 1)[-1], keras_path(model_key))
+    return keras_path(model_key)
+
+
+def model_fingerprint(model_key):
     """
-    UPDATED: 30% CrossEntropy, 70% Dice.
-    Prioritizes Overlap (IoU) over pure pixel accuracy.
+    Identifies the weights behind a model key: the serving backend plus a hash of the served
+    file's path, size and modification time. Part of the result keys, so results of a
+    retrained or re-converted model are never served for another one.
     """
-    cce = weighted_categorical_crossentropy_v3(CLASS_WEIGHTS_TENSOR_V3)(y_true, y_pred)
-    dice = multiclass_soft_dice_loss_v3(y_true, y_pred)
-    return 0.3 * K.mean(cce) + 0.7 * dice
+    with ModelLoader._models_lock:
+        info = ModelLoader._model_info.get(model_key)
+        if model_key in ModelLoader._models and info is not None and info['path'] is None:
+            return info['backend']  # Installed model object (install_model)
+
+    backend = model_backend(model_key)
+    path = served_path(model_key, backend)
+    try:
+        stat = os.stat(path)
+        stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        stamp = 'missing'
+    digest = hashlib.sha1(f"{os.path.abspath(path)}:{stamp}".encode()).hexdigest()[:12]
+    return f"{backend}-{digest}"
+
+
+def _model_config(model_key):
+    """Returns (model_path, custom_objects) for a model key."""
+    # Imported here so only processes that actually load models pay for TensorFlow
+    tf = import_tensorflow()
+    from . import losses
+
+    if model_key == 'v3':
+        custom_objects = {
+            'loss': losses.combined_loss_v3,
+            'combined_loss': losses.combined_loss_v3,
+            'weighted_categorical_crossentropy': losses.weighted_categorical_crossentropy_v3(losses.CLASS_WEIGHTS_TENSOR_V3), # Note: The user's code returned a function, but here we need to match what the model expects. 
+            'weighted_categorical_crossentropy': losses.weighted_categorical_crossentropy_v3,
+            'multiclass_soft_dice_loss': losses.multiclass_soft_dice_loss_v3,
+            'mean_io_u': tf.keras.metrics.OneHotMeanIoU(num_classes=5)
+        }
+    elif model_key == 'v2':
+        custom_objects = {
+            'loss': losses.combined_loss_v2(losses.CLASS_WEIGHTS_TENSOR_V2),
+            'combined_loss': losses.combined_loss_v2(losses.CLASS_WEIGHTS_TENSOR_V2), # For safety
+            'multiclass_soft_dice_loss': losses.multiclass_soft_dice_loss_v2,
+            'mean_io_u': tf.keras.metrics.OneHotMeanIoU(num_classes=5)
+        }
+    else: # v1
+        custom_objects = {
+            'loss': losses.combined_loss_v1(losses.CLASS_WEIGHTS_TENSOR_V1),
+            'combined_loss': losses.combined_loss_v1(losses.CLASS_WEIGHTS_TENSOR_V1),
+            'dice_loss': losses.dice_loss_v1,
+            'weighted_categorical_crossentropy': losses.weighted_categorical_crossentropy_v1(losses.CLASS_WEIGHTS_TENSOR_V1),
+        }
+    return keras_path(model_key), custom_objects
+
+
+def _resident_size(model):
+    """Approximate resident size of a loaded model: the bytes held by its weights."""
+    try:
+        return int(sum(w.nbytes for w in model.get_weights()))
+    except Exception:
+        return 0
 
 
 class ModelLoader:
+    """
+    Process-wide singleton that owns the loaded models.
+
+    Loading is single-flight: concurrent first requests for the same key wait on a
+    per-key lock instead of each deserializing their own copy. Resident models are
+    kept in LRU order and evicted when MODEL_MEMORY_BUDGET_MB would be exceeded.
+    """
     _instance = None
-    _models = {}
+    _instance_lock = threading.Lock()
+    _models = OrderedDict()       # model_key -> model, least recently used first
+    _models_lock = threading.Lock()
+    _load_locks = {}              # model_key -> Lock held while that key loads
+    _model_info = {}              # model_key -> load time / resident size / counters
 
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(ModelLoader, cls).__new__(cls)
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = super(ModelLoader, cls).__new__(cls)
         return cls._instance
 
+    def _get_resident(self, model_key):
+        with self._models_lock:
+            model = self._models.get(model_key)
+            if model is not None:
+                self._models.move_to_end(model_key)
+            return model
+
+    def _key_lock(self, model_key):
+        with self._models_lock:
+            lock = self._load_locks.get(model_key)
+            if lock is None:
+                lock = self._load_locks[model_key] = threading.Lock()
+            return lock
+
     def load_model(self, model_key='v2'):
-        if model_key in self._models:
-            return self._models[model_key]
+        model = self._get_resident(model_key)
+        if model is not None:
+            return model
 
-        print(f"Loading model: {model_key}...")
-        
-        try:
-            if model_key == 'v3':
-                model_path = os.getenv('MODEL_PATH_V3', 'Attention_UNet_Balanced_Final.keras')
-                custom_objects = {
-                    'loss': combined_loss_v3,
-                    'combined_loss': combined_loss_v3,
-                    'weighted_categorical_crossentropy': weighted_categorical_crossentropy_v3(CLASS_WEIGHTS_TENSOR_V3), # Note: The user's code returned a function, but here we need to match what the model expects. 
-                    'weighted_categorical_crossentropy': weighted_categorical_crossentropy_v3,
-                    'multiclass_soft_dice_loss': multiclass_soft_dice_loss_v3,
-                    'mean_io_u': tf.keras.metrics.OneHotMeanIoU(num_classes=5)
-                }
-            elif model_key == 'v2':
-                model_path = os.getenv('MODEL_PATH_V2', 'Attention_UNet_Advanced_1.keras')
-                custom_objects = {
-                    'loss': combined_loss_v2(CLASS_WEIGHTS_TENSOR_V2),
-                    'combined_loss': combined_loss_v2(CLASS_WEIGHTS_TENSOR_V2), # For safety
-                    'multiclass_soft_dice_loss': multiclass_soft_dice_loss_v2,
-                    'mean_io_u': tf.keras.metrics.OneHotMeanIoU(num_classes=5)
-                }
-            else: # v1
-                model_path = os.getenv('MODEL_PATH_V1', 'model.keras')
-                custom_objects = {
-                    'loss': combined_loss_v1(CLASS_WEIGHTS_TENSOR_V1),
-                    'combined_loss': combined_loss_v1(CLASS_WEIGHTS_TENSOR_V1),
-                    'dice_loss': dice_loss_v1,
-                    'weighted_categorical_crossentropy': weighted_categorical_crossentropy_v1(CLASS_WEIGHTS_TENSOR_V1),
-                }
-
-            if not os.path.exists(model_path):
-                print(f"Error: Model file not found at {model_path}")
+        with self._key_lock(model_key):
+            # Another thread may have finished loading while we waited for the lock
+            model = self._get_resident(model_key)
+            if model is not None:
+                return model
+
+            if inference_server.INFERENCE_SERVER_SOCKET:
+                return self._connect_remote(model_key)
+
+            print(f"Loading model: {model_key}...")
+
+            try:
+                _, custom_objects = _model_config(model_key)
+                backend = model_backend(model_key)
+                model_path = served_path(model_key, backend)
+
+                if not os.path.exists(model_path):
+                    print(f"Error: Model file not found at {model_path}")
+                    return None
+
+                # The file size is a good estimate of the weights we are about to hold
+                self._make_room(os.path.getsize(model_path), keep=model_key)
+
+                started = time.perf_counter()
+                if backend.startswith('tflite'):
+                    model = TFLiteModel(model_path)
+                    resident_bytes = model.size_bytes
+                else:
+                    tf = import_tensorflow()
+                    model = tf.keras.models.load_model(model_path, custom_objects=custom_objects)
+                    resident_bytes = _resident_size(model)
+                load_seconds = time.perf_counter() - started
+
+                with self._models_lock:
+                    self._models[model_key] = model
+                    info = self._model_info.setdefault(model_key, {'loads': 0, 'evictions': 0})
+                    info.update({
+                        'path': model_path,
+                        'backend': backend,
+                        'load_seconds': load_seconds,
+                        'resident_bytes': resident_bytes,
+                    })
+                    info['loads'] += 1
+
+                self._make_room(0, keep=model_key)
+                print(f"Model {model_key} loaded successfully in {load_seconds:.2f}s ({resident_bytes / 1e6:.1f} MB).")
+                return model
+
+            except Exception as e:
+                print(f"Error loading model {model_key}: {e}")
                 return None
 
-            model = tf.keras.models.load_model(model_path, custom_objects=custom_objects)
+    def _connect_remote(self, model_key):
+        """Has the inference server load the model and keeps a RemoteModel proxy for it."""
+        started = time.perf_counter()
+        client = get_client()
+        try:
+            server_info = client.load(model_key)
+        except InferenceServerError as e:
+            print(f"Error loading model {model_key} on the inference server: {e}")
+            return None
+
+        model = RemoteModel(client, model_key)
+        with self._models_lock:
             self._models[model_key] = model
-            print(f"Model {model_key} loaded successfully.")
-            return model
+            info = self._model_info.setdefault(model_key, {'loads': 0, 'evictions': 0})
+            info.update({
+                'path': server_info.get('path'),
+                'backend': f"remote:{server_info.get('backend', 'keras')}",
+                'load_seconds': time.perf_counter() - started,
+                'resident_bytes': 0,  # Held by the inference server, not this process
+            })
+            info['loads'] += 1
+        print(f"Model {model_key} served by the inference server at {client.socket_path}.")
+        return model
 
-        except Exception as e:
-            print(f"Error loading model {model_key}: {e}")
-            return None
+    def _make_room(self, incoming_bytes, keep=None):
+        """Evicts least recently used models until incoming_bytes fits in the budget."""
+        if MODEL_MEMORY_BUDGET_BYTES <= 0:
+            return
+
+        evicted = []
+        with self._models_lock:
+            while True:
+                resident = sum(self._model_info[k]['resident_bytes'] for k in self._models)
+                if resident + incoming_bytes <= MODEL_MEMORY_BUDGET_BYTES:
+                    break
+                candidates = [k for k in self._models if k != keep]
+                if not candidates:
+                    break
+                victim = candidates[0]
+                del self._models[victim]
+                self._model_info[victim]['evictions'] += 1
+                evicted.append(victim)
+
+        if evicted:
+            print(f"Evicted models {evicted} to stay within the {MODEL_MEMORY_BUDGET_BYTES / 1e6:.0f} MB budget.")
+            gc.collect()
+
+    def install_model(self, model_key, model, backend='custom'):
+        """Serves an already built model object under model_key (benchmarks with stub models)."""
+        with self._models_lock:
+            self._models[model_key] = model
+            info = self._model_info.setdefault(model_key, {'loads': 0, 'evictions': 0})
+            info.update({'path': None, 'backend': backend, 'load_seconds': 0.0, 'resident_bytes': 0})
+            info['loads'] += 1
+
+    def unload_model(self, model_key):
+        with self._models_lock:
+            removed = self._models.pop(model_key, None)
+        if removed is not None:
+            gc.collect()
+        return removed is not None
 
     def get_model(self, model_key='v2'):
         return self.load_model(model_key)
+
+    def stats(self):
+        with self._models_lock:
+            resident = list(self._models)
+            models = {}
+            for key, info in self._model_info.items():
+                models[key] = dict(info, resident=key in resident)
+            return {
+                'memory_budget_bytes': MODEL_MEMORY_BUDGET_BYTES,
+                'resident_bytes': sum(self._model_info[k]['resident_bytes'] for k in resident),
+                'lru_order': resident,
+                'models': models,
+                'runtime': runtime_info(),
+            }
+
+
+@registry.collector
+def _model_metrics():
+    stats = ModelLoader().stats()
+    yield ('cloudvision_model_resident_bytes', 'gauge', 'Weight memory of loaded models.',
+           [({'model': key}, info['resident_bytes'] if info['resident'] else 0) for key, info in stats['models'].items()])
+    yield ('cloudvision_model_memory_budget_bytes', 'gauge', 'Configured model memory budget (0 = unlimited).',
+           [({}, stats['memory_budget_bytes'])])
@@ -1,3 +1,115 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class AnalysisJob(models.Model):
+    """A long-running scene analysis submitted through /api/jobs/ and run in the worker pool."""
+
+    KIND_PREDICT = 'predict'
+    KIND_MITIGATE = 'mitigate'
+    KIND_CHOICES = [
+        (KIND_PREDICT, 'Predict'),
+        (KIND_MITIGATE, 'Mitigate'),
+    ]
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=KIND_PREDICT)
+    model_type = models.CharField(max_length=8, default='v2')
+    tiled = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    progress = models.FloatField(default=0.0)
+    input_name = models.CharField(max_length=255)
+    input_path = models.CharField(max_length=512)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    owner = models.CharField(max_length=128, blank=True)  # host:pid of the web process whose pool runs the job
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.kind} {self.input_name} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+    def as_status_dict(self):
+        return {
+            'id': str(self.id),
+            'kind': self.kind,
+            'model_type': self.model_type,
+            'tiled': self.tiled,
+            'status': self.status,
+            'progress': self.progress,
+            'input_name': self.input_name,
+            'error': self.error or None,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class AnalysisResult(models.Model):
+    """
+    Index row of a stored segmentation result (see result_store). The compressed mask and
+    encoded images live on disk under RESULT_STORE_DIR; every worker checks here before inference.
+    """
+
+    key = models.CharField(max_length=160, unique=True)  # upload digest:model variant:model fingerprint:preprocessing version
+    digest = models.CharField(max_length=64, db_index=True)
+    model_type = models.CharField(max_length=8)
+    tiled = models.BooleanField(default=False)
+    input_name = models.CharField(max_length=255, blank=True)
+    height = models.PositiveIntegerField()
+    width = models.PositiveIntegerField()
+    percentages = models.JSONField()
+    has_shadow = models.BooleanField(default=False)
+    image_format = models.CharField(max_length=32, blank=True)  # mime type of the stored preview, '' until images are stored
+    path = models.CharField(max_length=512)  # relative to RESULT_STORE_DIR
+    size_bytes = models.BigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.input_name or self.digest[:12]} ({self.model_type})"
 
-# Create your models here.
+    def as_history_dict(self):
+        return {
+            'id': self.id,
+            'digest': self.digest,
+            'input_name': self.input_name,
+            'model_type': self.model_type,
+            'tiled': self.tiled,
+            'shape': [self.height, self.width],
+            'percentages': self.percentages,
+            'has_shadow': self.has_shadow,
+            'has_images': bool(self.image_format),
+            'size_bytes': self.size_bytes,
+            'hits': self.hits,
+            'created_at': self.created_at,
+            'last_used_at': self.last_used_at,
+        }
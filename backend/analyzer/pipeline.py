@@ -0,0 +1,234 @@
+import contextvars
+
+import numpy as np
+
+from .batching import get_batcher
+from .cache import prediction_cache, upload_digest, PredictionCache
+from .encoding import encode_image, encode_mask, encode_parallel, to_base64
+from .metrics import model_context, segmentations_total, stage_timer
+from .model_loader import model_fingerprint
+from .result_store import result_store
+from .tiling import TILE_SIZE, ImageTileSource, predict_tiled
+from .utils import (
+    preprocess_v1, preprocess_v2, preprocess_v3, remap_class_indices, load_full_resolution,
+    fused_postprocess, postprocess_indices, preview_rgb, PREPROCESS_VERSION,
+)
+from .mitigation import mitigate_shadows
+
+REMAP_CHUNK_ROWS = 1024
+
+# (store key, processed, freshly inferred) of the last segment() in this context, so
+# build_predict_result can store or reuse the encoded images of that analysis
+_last_segment = contextvars.ContextVar('last_segment', default=(None, None, False))
+
+
+def preprocess_for_model(file_obj, model_type):
+    """Dispatches to the preprocessing routine matching the model version."""
+    if model_type == 'v1':
+        return preprocess_v1(file_obj)
+    elif model_type == 'v3':
+        return preprocess_v3(file_obj)
+    else:
+        return preprocess_v2(file_obj)
+
+
+def apply_thin_cloud_correction(prediction, model_type):
+    # Correction: Suppress "Thin Cloud" (Class 3) for V2/V3
+    # Reported "extra thin clouds" (false positives).
+    # We apply a penalty to the Thin Cloud channel to reduce sensitivity.
+    if model_type in ['v2', 'v3']:
+        # Index 3 is Thin Cloud (based on remap_classes docstring)
+        # Multiply by 0.65 to require higher confidence for this class
+        prediction[..., 3] *= 0.65
+    return prediction
+
+
+def predict_mask(input_tensor, model_type):
+    """
+    Runs the (batched) forward pass and the fused post-processing stage.
+    Returns a PostProcessed(mask, gray, heatmap, counts).
+    """
+    prediction = get_batcher(model_type).predict(input_tensor)
+    with stage_timer('postprocess', model_type):
+        apply_thin_cloud_correction(prediction, model_type)
+        return fused_postprocess(prediction)
+
+
+def predict_masks(input_tensors, model_type):
+    """
+    predict_mask for several (1, 256, 256, C) tensors, stacked into one forward pass.
+    Returns one PostProcessed per tensor, in order.
+    """
+    prediction = get_batcher(model_type).predict(np.concatenate(input_tensors, axis=0))
+    with stage_timer('postprocess', model_type):
+        apply_thin_cloud_correction(prediction, model_type)
+        return [fused_postprocess(prediction[i:i + 1]) for i in range(len(input_tensors))]
+
+
+def predict_scene_indices(source, model_type, out=None, progress=None):
+    """Tiled inference over a (H, W, C) source of any size; returns the raw (H, W) class indices."""
+    batcher = get_batcher(model_type)
+
+    def predict_fn(batch):
+        return apply_thin_cloud_correction(batcher.predict(batch), model_type)
+
+    return predict_tiled(source, predict_fn, out=out, progress=progress)
+
+
+def predict_scene(source, model_type, out=None, progress=None):
+    """
+    Tiled inference over a (H, W, C) source of any size.
+    Returns the remapped (H, W) display mask at full resolution, written into `out` if given.
+    """
+    raw_mask = predict_scene_indices(source, model_type, out=out, progress=progress)
+    if out is None:
+        return remap_class_indices(raw_mask)
+
+    # Remap in place, a block of rows at a time, so a memory-mapped mask is never fully resident
+    for top in range(0, out.shape[0], REMAP_CHUNK_ROWS):
+        out[top:top + REMAP_CHUNK_ROWS] = remap_class_indices(out[top:top + REMAP_CHUNK_ROWS])
+    return out
+
+
+def segment(file_obj, model_type, tiled=False, progress=None):
+    """
+    Shared inference path for PredictView and MitigateView.
+    Returns (input_tensor, processed, cache_hit), where processed is the PostProcessed
+    display mask, grayscale image, heatmap RGB and class counts.
+
+    tiled=True keeps the upload at native resolution and runs sliding-window inference
+    instead of resizing to 256x256. .npy arrays that are not 256x256 are always tiled.
+    progress, if given, receives the completed inference fraction (0-1).
+
+    Results are cached by upload content, model type, model weights and preprocessing version,
+    so the /mitigate/ call that follows /predict/ for the same file skips inference.
+    """
+    with model_context(model_type):
+        return _segment(file_obj, model_type, tiled, progress)
+
+
+def segment_cache_key(file_obj, model_type, tiled=False):
+    """
+    Prediction cache key of an upload: content digest, model variant, the fingerprint of the
+    served weights and preprocessing version.
+    """
+    variant = f"{model_type}:tiled" if tiled else model_type
+    return PredictionCache.make_key(upload_digest(file_obj), variant, model_fingerprint(model_type),
+                                    PREPROCESS_VERSION)
+
+
+def _segment(file_obj, model_type, tiled, progress):
+    key = segment_cache_key(file_obj, model_type, tiled)
+    cached = prediction_cache.get(key)
+    if cached is not None:
+        input_tensor, processed = cached
+        segmentations_total.inc(model_type, 'hit')
+        _last_segment.set((key, processed, False))
+        return input_tensor, processed, True
+
+    # Another worker (or an earlier run) may have analyzed this upload already
+    stored = result_store.load(key)
+    segmentations_total.inc(model_type, 'miss' if stored is None else 'store')
+
+    processed = stored
+    if tiled:
+        with stage_timer('preprocess'):
+            scene = load_full_resolution(file_obj)
+        input_tensor = np.expand_dims(scene, axis=0)
+        if stored is None:
+            source = ImageTileSource(scene) if scene.shape[-1] == 3 else scene
+            raw_mask = predict_scene_indices(source, model_type, progress=progress)
+            with stage_timer('postprocess'):
+                processed = postprocess_indices(raw_mask)
+    else:
+        with stage_timer('preprocess'):
+            input_tensor = preprocess_for_model(file_obj, model_type)
+        if stored is None and input_tensor.shape[1:3] != (TILE_SIZE, TILE_SIZE):
+            raw_mask = predict_scene_indices(input_tensor[0], model_type, progress=progress)
+            with stage_timer('postprocess'):
+                processed = postprocess_indices(raw_mask)
+        elif stored is None:
+            processed = predict_mask(input_tensor, model_type)
+
+    if stored is None:
+        result_store.save(key, processed, class_percentages(processed.counts), model_type, tiled,
+                          getattr(file_obj, 'name', ''))
+    if progress is not None:
+        progress(1.0)
+
+    prediction_cache.put(key, (input_tensor, processed))
+    _last_segment.set((key, processed, stored is None))
+    return input_tensor, processed, stored is not None
+
+
+def _stored_analysis(processed):
+    """(store key, fresh) if processed came from the last segment() in this context, else (None, False)."""
+    key, last, fresh = _last_segment.get()
+    return (key, fresh) if last is processed else (None, False)
+
+
+def class_percentages(counts):
+    """Percentages of the 4 display classes from their pixel counts."""
+    total_pixels = max(int(np.sum(counts)), 1)
+    return {
+        "Clear": float(counts[0] / total_pixels) * 100,
+        "Shadow": float(counts[1] / total_pixels) * 100,
+        "Thin Cloud": float(counts[2] / total_pixels) * 100,
+        "Thick Cloud": float(counts[3] / total_pixels) * 100
+    }
+
+
+def encode_outputs(input_tensor, processed, model_type):
+    """Encodes the mask, preview and heatmap images concurrently. Returns {name: (bytes, mime)}."""
+    with stage_timer('encode', model_type):
+        return encode_parallel({
+            'mask': lambda: encode_mask(processed.mask, processed.gray),
+            # Generate Preview Image (Fix for broken .npy preview)
+            'original_image': lambda: encode_image(preview_rgb(input_tensor), 'preview'),
+            'solar_heatmap': lambda: encode_image(processed.heatmap, 'heatmap'),
+        })
+
+
+def build_predict_result(input_tensor, processed, model_type, key=None, fresh=False):
+    """
+    The /predict/ response body: mask, percentages, preview and solar heatmap.
+    Images of previously stored analyses are served from the result store instead of re-encoded.
+    key / fresh name the store entry (and whether it was just inferred) for callers that do
+    not go through segment(); by default they come from the last segment() in this context.
+    """
+    if key is None:
+        key, fresh = _stored_analysis(processed)
+    images = result_store.images(key) if key and not fresh else None
+    if images is None:
+        images = encode_outputs(input_tensor, processed, model_type)
+        if key:
+            result_store.attach_images(key, images)
+    # Percentages come straight from the fused post-processing counts
+    return predict_body(images, class_percentages(processed.counts), model_type)
+
+
+def predict_body(images, percentages, model_type):
+    """Assembles the /predict/ JSON from encoded images ({name: (bytes, mime)}) and class percentages."""
+    preview_bytes, preview_mime = images['original_image']
+    return {
+        # Grayscale mask image
+        'mask': to_base64(images['mask'][0]),
+        'percentages': percentages,
+        'has_shadow': percentages["Shadow"] > 1.0,
+        'model_used': model_type,
+        'original_image_url': f"data:{preview_mime};base64,{to_base64(preview_bytes)}",
+        # Solar Heatmap
+        'solar_heatmap': to_base64(images['solar_heatmap'][0]),
+        'image_format': preview_mime,
+        # The palette mask stays PNG whatever IMAGE_CODEC is
+        'mask_format': images['mask'][1],
+    }
+
+
+def build_mitigate_result(input_tensor, processed, model_type=None):
+    """The /mitigate/ response body: the shadow-mitigated RGB image and its mime type."""
+    with stage_timer('mitigate', model_type):
+        mitigated_img = mitigate_shadows(input_tensor, processed.mask)
+    with stage_timer('encode', model_type):
+        payload, mime = encode_image(mitigated_img, 'mitigated')
+    return {'mitigated_image': to_base64(payload), 'image_format': mime}
@@ -0,0 +1,259 @@
+import contextlib
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+import zipfile
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+# --- PROFILING CONFIGURATION ---
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+# Fraction of /api/ requests profiled without being asked (0 = only on the header)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_HEADER = 'HTTP_X_PROFILE'  # X-Profile: 1 (staff users) or X-Profile: <PROFILE_SECRET>
+# Shared secret that lets clients without a staff session request a profile (empty = staff only)
+PROFILE_SECRET = os.getenv('PROFILE_SECRET', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(settings.BASE_DIR, 'media', 'profiles'))
+# Ring buffer size: the oldest profiles are deleted beyond this many
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))
+# Also capture a TensorFlow profiler trace around model.predict for profiled requests
+PROFILE_TF_TRACE = os.getenv('PROFILE_TF_TRACE', 'False') == 'True'
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+
+# The profiling session of the request being served; the micro-batcher reads it when enqueueing
+active_session = contextvars.ContextVar('active_profile_session', default=None)
+
+_ring_lock = threading.Lock()
+_tf_trace_lock = threading.Lock()
+
+
+class ProfileSession:
+    """One profiled request: its cProfile data plus profiles of the batcher work done for it."""
+
+    def __init__(self, method, path, reason):
+        self.id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.profiler = cProfile.Profile()
+        self.started = time.time()
+        self.duration = 0.0
+        self._extra = []
+        self._extra_lock = threading.Lock()
+        self.trace_dir = os.path.join(PROFILE_DIR, f"{self.id}-tf") if PROFILE_TF_TRACE else None
+
+    def add_profile(self, profile):
+        with self._extra_lock:
+            self._extra.append(profile)
+
+    def save(self, status_code):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stats = pstats.Stats(self.profiler)
+        with self._extra_lock:
+            for profile in self._extra:
+                stats.add(profile)
+        stats.dump_stats(os.path.join(PROFILE_DIR, f"{self.id}.prof"))
+
+        with open(os.path.join(PROFILE_DIR, f"{self.id}.json"), 'w') as f:
+            json.dump({
+                'id': self.id,
+                'method': self.method,
+                'path': self.path,
+                'reason': self.reason,
+                'status': status_code,
+                'started_at': self.started,
+                'duration_ms': self.duration * 1000.0,
+                'has_tf_trace': bool(self.trace_dir and os.path.isdir(self.trace_dir)),
+            }, f)
+        trim_profiles()
+
+
+def _enable(profile):
+    # Python 3.12+ allows a single active cProfile per process; concurrent profiles are skipped
+    try:
+        profile.enable()
+        return True
+    except ValueError:
+        return False
+
+
+@contextlib.contextmanager
+def suspend_profile(session):
+    """
+    Pauses a request's profiler while it waits on the batcher. From Python 3.12 only one
+    cProfile can be active per process, so otherwise profile_call could never profile the
+    forward pass. Older versions profile per thread and need no pause.
+    """
+    if session is None or sys.version_info < (3, 12):
+        yield
+        return
+    session.profiler.disable()
+    try:
+        yield
+    finally:
+        _enable(session.profiler)
+
+
+def profile_call(sessions, fn, *args):
+    """
+    Runs fn (the batcher's forward pass, on the batcher thread) under cProfile and, with
+    PROFILE_TF_TRACE, the TensorFlow profiler. The result is attached to every session.
+    """
+    trace_dir = next((s.trace_dir for s in sessions if s.trace_dir), None)
+    # The TF profiler is process-wide; skip the trace if another one is running
+    tracing = trace_dir is not None and _tf_trace_lock.acquire(blocking=False)
+    if tracing:
+        import tensorflow as tf
+        tf.profiler.experimental.start(trace_dir)
+
+    profile = cProfile.Profile()
+    profiling = _enable(profile)
+    try:
+        return fn(*args)
+    finally:
+        if profiling:
+            profile.disable()
+            for session in sessions:
+                session.add_profile(profile)
+        if tracing:
+            tf.profiler.experimental.stop()
+            _tf_trace_lock.release()
+
+
+def trim_profiles():
+    """Deletes the oldest profiles so at most PROFILE_MAX_FILES remain."""
+    with _ring_lock:
+        ids = list_profile_ids()
+        for profile_id in ids[:max(0, len(ids) - PROFILE_MAX_FILES)]:
+            for suffix in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, profile_id + suffix))
+                except OSError:
+                    pass
+            shutil.rmtree(os.path.join(PROFILE_DIR, f"{profile_id}-tf"), ignore_errors=True)
+
+
+def list_profile_ids():
+    """Stored profile ids, oldest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    stored = []
+    for name in os.listdir(PROFILE_DIR):
+        if name.endswith('.prof') and PROFILE_ID_PATTERN.match(name[:-5]):
+            try:
+                stored.append((os.stat(os.path.join(PROFILE_DIR, name)).st_mtime_ns, name[:-5]))
+            except OSError:
+                pass  # Trimmed concurrently
+    return [profile_id for _, profile_id in sorted(stored)]
+
+
+def list_profiles():
+    profiles = []
+    for profile_id in reversed(list_profile_ids()):
+        try:
+            with open(os.path.join(PROFILE_DIR, f"{profile_id}.json")) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            profiles.append({'id': profile_id})
+    return profiles
+
+
+def profile_path(profile_id):
+    """Path of a stored .prof file, or None for unknown/malformed ids."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.prof")
+    return path if os.path.exists(path) else None
+
+
+def trace_archive(profile_id):
+    """The TensorFlow trace directory of a profile as zip bytes, or None."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    trace_dir = os.path.join(PROFILE_DIR, f"{profile_id}-tf")
+    if not os.path.isdir(trace_dir):
+        return None
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for root, _, files in os.walk(trace_dir):
+            for name in files:
+                full_path = os.path.join(root, name)
+                archive.write(full_path, os.path.relpath(full_path, trace_dir))
+    return buffer.getvalue()
+
+
+class ProfilingMiddleware:
+    """
+    Profiles /api/ requests that send X-Profile: 1 from a staff session or X-Profile:
+    <PROFILE_SECRET>, plus a PROFILE_SAMPLE_RATE sample of the rest. Only installed when
+    PROFILING_ENABLED=True. The profile id is returned in the X-Profile-Id response header.
+
+    cProfile follows the request thread, so this covers the sync views; work the async
+    views hand to their executor is only captured inside the micro-batcher.
+    """
+
+    def __init__(self, get_response):
+        if not PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def _reason(self, request):
+        if not request.path.startswith('/api/') or request.path.startswith('/api/profiles/'):
+            return None
+        if self._header_allowed(request):
+            return 'header'
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return 'sampled'
+        return None
+
+    @staticmethod
+    def _header_allowed(request):
+        """
+        A profiled request costs several times its normal CPU time, so the header is only
+        honoured from staff sessions or with the shared secret; sampling needs neither.
+        """
+        value = request.META.get(PROFILE_HEADER, '')
+        if not value:
+            return False
+        if PROFILE_SECRET and hmac.compare_digest(value.encode(), PROFILE_SECRET.encode()):
+            return True
+        user = getattr(request, 'user', None)
+        return value == '1' and user is not None and user.is_staff
+
+    def __call__(self, request):
+        reason = self._reason(request)
+        if reason is None:
+            return self.get_response(request)
+
+        session = ProfileSession(request.method, request.path, reason)
+        if not _enable(session.profiler):
+            return self.get_response(request)
+        token = active_session.set(session)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            session.profiler.disable()
+            session.duration = time.perf_counter() - started
+            active_session.reset(token)
+
+        try:
+            session.save(response.status_code)
+            response['X-Profile-Id'] = session.id
+        except Exception as e:
+            print(f"Could not store profile {session.id}: {e}")
+        return response
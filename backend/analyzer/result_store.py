@@ -0,0 +1,271 @@
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import AnalysisResult
+from .utils import postprocess_display
+
+
+# --- RESULT STORE CONFIGURATION ---
+RESULT_STORE_ENABLED = os.getenv('RESULT_STORE_ENABLED', 'True') == 'True'
+RESULT_STORE_DIR = os.getenv('RESULT_STORE_DIR', os.path.join(settings.BASE_DIR, 'media', 'results'))
+RESULT_STORE_MAX_BYTES = int(os.getenv('RESULT_STORE_MAX_MB', '1024')) * 1024 * 1024
+# Garbage collection removes least recently used entries until the store is below this fraction of the limit
+RESULT_STORE_GC_TARGET = 0.9
+# Garbage collection runs after every this many writes (saves and image attachments) of a process
+RESULT_STORE_GC_EVERY = int(os.getenv('RESULT_STORE_GC_EVERY', '50'))
+
+MASK_FILE = 'mask.npz'
+IMAGE_NAMES = ('mask', 'original_image', 'solar_heatmap')
+# Each image keeps its own codec (the palette mask stays PNG under IMAGE_CODEC=webp)
+IMAGE_EXTENSIONS = {'image/png': 'png', 'image/webp': 'webp'}
+
+
+def _write_atomic(path, payload):
+    """Writes via a temporary file and os.replace, so concurrent workers never see partial files."""
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'wb') as f:
+        if callable(payload):
+            payload(f)
+        else:
+            f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def _directory_size(path):
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return total
+
+
+class ResultStore:
+    """
+    Content-addressed store of segmentation results that survives restarts and is shared by
+    all workers. The display mask is kept as a compressed .npz and the /predict/ images as
+    the encoded files, under <root>/<digest[:2]>/<digest>/<variant>/<fingerprint>/<version>/,
+    indexed by AnalysisResult rows. Keys are the prediction cache keys, so the store sits
+    between the in-process cache and inference. The model fingerprint in the key changes
+    with the served weights file and backend, so a new model never gets old results.
+
+    The store never fails a request: errors (e.g. missing migrations) are logged and
+    treated as a miss.
+    """
+
+    def __init__(self, root=RESULT_STORE_DIR, max_bytes=RESULT_STORE_MAX_BYTES, enabled=RESULT_STORE_ENABLED,
+                 gc_every=RESULT_STORE_GC_EVERY):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.gc_every = max(1, gc_every)
+        self._lock = threading.Lock()
+        self._writes_since_gc = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.collected = 0
+        self.errors = 0
+
+    @staticmethod
+    def relative_path(key):
+        digest = key.split(':', 1)[0]
+        return os.path.join(digest[:2], *key.split(':'))
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _written(self):
+        """Counts a write and collects garbage every gc_every writes."""
+        with self._lock:
+            self._writes_since_gc += 1
+            due = self._writes_since_gc >= self.gc_every
+            if due:
+                self._writes_since_gc = 0
+        if due:
+            self.collect_garbage()
+
+    def _error(self, action, key, e):
+        self._count('errors')
+        print(f"Result store {action} failed for {key}: {e}")
+
+    def load(self, key):
+        """The stored PostProcessed outputs for a key, or None."""
+        if not self.enabled:
+            return None
+        try:
+            entry = AnalysisResult.objects.filter(key=key).first()
+            if entry is None:
+                self._count('misses')
+                return None
+            with np.load(os.path.join(self.root, entry.path, MASK_FILE)) as stored:
+                processed = postprocess_display(stored['mask'])
+            AnalysisResult.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+        except FileNotFoundError:
+            # Collected by another worker between the lookup and the read
+            self._count('misses')
+            return None
+        except (DatabaseError, OSError, ValueError, KeyError) as e:
+            self._error('load', key, e)
+            return None
+        self._count('hits')
+        return processed
+
+    def save(self, key, processed, percentages, model_type, tiled=False, input_name=''):
+        """Stores the display mask and analysis metadata (images are added by attach_images)."""
+        if not self.enabled:
+            return
+        relative = self.relative_path(key)
+        directory = os.path.join(self.root, relative)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _write_atomic(os.path.join(directory, MASK_FILE),
+                          lambda f: np.savez_compressed(f, mask=np.asarray(processed.mask, dtype=np.uint8)))
+            height, width = processed.mask.shape
+            fields = {
+                'digest': key.split(':', 1)[0],
+                'model_type': model_type,
+                'tiled': tiled,
+                'input_name': os.path.basename(input_name or '')[:255],
+                'height': height,
+                'width': width,
+                'percentages': percentages,
+                'has_shadow': percentages.get('Shadow', 0.0) > 1.0,
+                'path': relative,
+                'size_bytes': _directory_size(directory),
+                'last_used_at': timezone.now(),
+            }
+            # One INSERT ... ON CONFLICT statement: a read-then-write transaction cannot take
+            # SQLite's write lock while another worker holds it and fails with "database is locked".
+            # A worker storing the same upload concurrently writes the same files and values.
+            AnalysisResult.objects.bulk_create([AnalysisResult(key=key, **fields)], update_conflicts=True,
+                                               unique_fields=['key'], update_fields=list(fields))
+        except (DatabaseError, OSError) as e:
+            self._error('save', key, e)
+            return
+        self._count('writes')
+        self._written()
+
+    def attach_images(self, key, images):
+        """Adds the encoded /predict/ images ({name: (bytes, mime)}) to a stored entry."""
+        if not self.enabled:
+            return
+        try:
+            entry = AnalysisResult.objects.filter(key=key).first()
+            if entry is None or entry.image_format:
+                return
+            directory = os.path.join(self.root, entry.path)
+            for name in IMAGE_NAMES:
+                payload, mime = images[name]
+                _write_atomic(os.path.join(directory, f"{name}.{IMAGE_EXTENSIONS[mime]}"), payload)
+            # The row records the preview's type, like the image_format field of /predict/
+            AnalysisResult.objects.filter(pk=entry.pk).update(image_format=images['original_image'][1],
+                                                              size_bytes=_directory_size(directory))
+        except FileNotFoundError:
+            return
+        except (DatabaseError, OSError, KeyError) as e:
+            self._error('image write', key, e)
+            return
+        self._written()
+
+    def entry_images(self, entry):
+        """{name: (bytes, mime)} of a stored entry, or None if it has no (readable) images."""
+        if not entry.image_format:
+            return None
+        directory = os.path.join(self.root, entry.path)
+        images = {}
+        for name in IMAGE_NAMES:
+            for mime, extension in IMAGE_EXTENSIONS.items():
+                try:
+                    with open(os.path.join(directory, f"{name}.{extension}"), 'rb') as f:
+                        images[name] = (f.read(), mime)
+                    break
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    return None
+            else:
+                return None
+        return images
+
+    def images(self, key):
+        if not self.enabled:
+            return None
+        try:
+            entry = AnalysisResult.objects.filter(key=key).first()
+        except DatabaseError as e:
+            self._error('lookup', key, e)
+            return None
+        return self.entry_images(entry) if entry is not None else None
+
+    def entry_mask(self, entry):
+        with np.load(os.path.join(self.root, entry.path, MASK_FILE)) as stored:
+            return stored['mask']
+
+    def _remove_files(self, relative):
+        directory = os.path.join(self.root, relative)
+        shutil.rmtree(directory, ignore_errors=True)
+        # Drop the now-empty digest directories above the entry
+        parent = os.path.dirname(directory)
+        while os.path.abspath(parent) != os.path.abspath(self.root):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def collect_garbage(self):
+        """Deletes least recently used entries once the store exceeds max_bytes."""
+        try:
+            total = AnalysisResult.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+            if total <= self.max_bytes:
+                return 0
+            target = self.max_bytes * RESULT_STORE_GC_TARGET
+            removed = 0
+            for entry in AnalysisResult.objects.order_by('last_used_at').iterator():
+                if total <= target:
+                    break
+                AnalysisResult.objects.filter(pk=entry.pk).delete()
+                self._remove_files(entry.path)
+                total -= entry.size_bytes
+                removed += 1
+        except DatabaseError as e:
+            self._error('garbage collection', '-', e)
+            return 0
+        with self._lock:
+            self.collected += removed
+        return removed
+
+    def stats(self):
+        try:
+            usage = AnalysisResult.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+            entries = AnalysisResult.objects.count()
+        except DatabaseError:
+            usage = entries = None
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': entries,
+                'bytes': usage,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'writes': self.writes,
+                'collected': self.collected,
+                'errors': self.errors,
+            }
+
+
+result_store = ResultStore()
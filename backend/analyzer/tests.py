@@ -1,3 +1,1452 @@
-from django.test import TestCase
+import asyncio
+import base64
+import email
+import importlib.util
+import io
+import json
+import os
+import pstats
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import cv2
+import numpy as np
+from PIL import Image
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+
+from . import (
+    async_views, batch_predict, benchmarking, encoding, formats, geotiff, inference_server, jobs, llm, metrics,
+    mitigation, model_loader, pipeline, profiling, tf_runtime, tflite_backend, utils, views, warmup,
+)
+from .batching import MicroBatcher
+from .cache import PredictionCache, prediction_cache
+from .benchmarking import StubSegmentationModel, synthetic_upload
+from .inference_server import InferenceClient, InferenceServer, InferenceServerError
+from .model_loader import ModelLoader, model_fingerprint
+from .models import AnalysisJob, AnalysisResult
+from .result_store import IMAGE_NAMES, ResultStore
+from .tiling import predict_tiled
+
+
+@mock.patch.object(llm, 'GEMINI_STUB', True)
+class ReportCacheTests(SimpleTestCase):
+    """Gemini report cache, run against the local stub model (no network)."""
+
+    def setUp(self):
+        llm.stub_model.calls = 0
+        self.cache = llm.ReportCache(ttl=60, max_entries=2, precision=0, path='')
+
+    def test_nearby_percentages_share_a_report(self):
+        first = llm.generate_report({'Clear': 95.2, 'Shadow': 0.1}, cache=self.cache)
+        second = llm.generate_report({'Clear': 94.9, 'Shadow': 0.3}, cache=self.cache)
+
+        self.assertEqual(first, second)
+        self.assertEqual(llm.stub_model.calls, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_different_percentages_miss(self):
+        llm.generate_report({'Clear': 95, 'Shadow': 0}, cache=self.cache)
+        llm.generate_report({'Clear': 60, 'Shadow': 35}, cache=self.cache)
+        self.assertEqual(llm.stub_model.calls, 2)
+
+    def test_expired_entries_are_regenerated(self):
+        self.cache.ttl = -1
+        llm.generate_report({'Clear': 95}, cache=self.cache)
+        llm.generate_report({'Clear': 95}, cache=self.cache)
+        self.assertEqual(llm.stub_model.calls, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for clear in (10, 20, 10, 30):
+            llm.generate_report({'Clear': clear}, cache=self.cache)
+
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertIsNotNone(self.cache.get(self.cache.make_key({'Clear': 10})))
+        self.assertIsNone(self.cache.get(self.cache.make_key({'Clear': 20})))
+
+    def test_async_path_uses_the_same_cache(self):
+        llm.generate_report({'Clear': 80}, cache=self.cache)
+        report = asyncio.run(llm.agenerate_report({'Clear': 80.2}, cache=self.cache))
+
+        self.assertTrue(report.startswith('[stub]'))
+        self.assertEqual(llm.stub_model.calls, 1)
+
+    def test_cache_persists_to_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'gemini_cache.json')
+            cache = llm.ReportCache(ttl=60, max_entries=8, precision=0, path=path)
+            report = llm.generate_report({'Clear': 50, 'Shadow': 50}, cache=cache)
+
+            reloaded = llm.ReportCache(ttl=60, max_entries=8, precision=0, path=path)
+            self.assertEqual(reloaded.get(reloaded.make_key({'Clear': 50, 'Shadow': 50})), report)
+            self.assertEqual(llm.stub_model.calls, 1)
+
+    def test_workers_sharing_the_file_never_collide(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'gemini_cache.json')
+            caches = [llm.ReportCache(ttl=60, max_entries=64, precision=0, path=path) for _ in range(4)]
+            errors = []
+
+            def fill(cache, worker):
+                try:
+                    for i in range(20):
+                        cache.put(cache.make_key({'Clear': worker * 100 + i}), 'report')
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=fill, args=(cache, i)) for i, cache in enumerate(caches)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(tmp), ['gemini_cache.json'])
+            self.assertEqual(llm.ReportCache(ttl=60, max_entries=64, precision=0, path=path).stats()['entries'], 20)
+
+    def test_async_path_saves_off_the_event_loop(self):
+        threads = []
+        put = self.cache.put
+
+        def recording_put(key, text):
+            threads.append(threading.current_thread())
+            put(key, text)
+
+        with mock.patch.object(self.cache, 'put', recording_put):
+            asyncio.run(llm.agenerate_report({'Clear': 80}, cache=self.cache))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_non_object_percentages_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.cache.make_key([['Clear', 80]])
+        self.assertEqual(self.client.post('/api/gemini-analysis/', {'percentages': [80, 20]},
+                                          content_type='application/json').status_code, 400)
+        request = AsyncRequestFactory().post('/api/gemini-analysis/', {'percentages': 'Clear'},
+                                             content_type='application/json')
+        response = asyncio.run(async_views.AsyncGeminiAnalysisView.as_view()(request))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(llm.stub_model.calls, 0)
+
+
+def _named(name, payload):
+    file_obj = io.BytesIO(payload)
+    file_obj.name = name
+    return file_obj
+
+
+class _CountingModel(StubSegmentationModel):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def predict(self, batch, verbose=0):
+        self.calls += 1
+        return super().predict(batch, verbose)
+
+
+class _StubModelMixin:
+    """Serves a _CountingModel as 'view-stub' through the real views, with results kept out of the store."""
+
+    model_key = 'view-stub'
+
+    def setUp(self):
+        super().setUp()
+        self.model = _CountingModel()
+        ModelLoader().install_model(self.model_key, self.model, backend='stub')
+        self.addCleanup(ModelLoader().unload_model, self.model_key)
+        for module in (pipeline, batch_predict):
+            patcher = mock.patch.object(module, 'result_store', ResultStore(enabled=False))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        prediction_cache.clear()
+        self.addCleanup(prediction_cache.clear)
+
+    def upload(self, fmt='png', size=64, seed=0):
+        filename, payload, content_type = synthetic_upload(fmt, size, seed=seed)
+        return SimpleUploadedFile(filename, payload, content_type)
+
+
+class BatchUploadTests(SimpleTestCase):
+    """Expansion of /predict/batch/ uploads into individual files."""
+
+    def test_archives_are_expanded_in_order(self):
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, 'w') as archive:
+            archive.writestr('a.png', b'a')
+            archive.writestr('readme.txt', b'skipped')
+            archive.writestr('__MACOSX/._a.png', b'skipped')
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode='w:gz') as archive:
+            info = tarfile.TarInfo('scenes/b.npy')
+            info.size = 1
+            archive.addfile(info, io.BytesIO(b'b'))
+        zipped.seek(0)
+        tarred.seek(0)
+
+        files = list(batch_predict.iter_files([
+            _named('first.jpg', b'x'), _named('set.zip', zipped.getvalue()), _named('set.tar.gz', tarred.getvalue()),
+        ]))
+        self.assertEqual([name for name, _ in files], ['first.jpg', 'a.png', 'scenes/b.npy'])
+        self.assertEqual(files[2][1].read(), b'b')
+
+    def test_bad_archive_and_file_limit_are_reported_per_file(self):
+        with mock.patch.object(batch_predict, 'BATCH_MAX_FILES', 2):
+            files = list(batch_predict.iter_files([
+                _named('broken.zip', b'not a zip'), _named('1.png', b''), _named('2.png', b''), _named('3.png', b''),
+            ]))
+
+        self.assertIsInstance(files[0][1], batch_predict.BatchError)
+        self.assertEqual([name for name, _ in files], ['broken.zip', '1.png', '2.png', '3.png'])
+        self.assertIsInstance(files[-1][1], batch_predict.BatchError)
+
+
+class StreamPredictionsTests(_StubModelMixin, SimpleTestCase):
+    """NDJSON output of /predict/batch/: one line per file in order, then the summary."""
+
+    def test_lines_follow_upload_order_with_errors_inline(self):
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, 'w') as archive:
+            archive.writestr('b.png', synthetic_upload('png', 64, seed=1)[1])
+            archive.writestr('broken.png', b'not an image')
+        uploads = [
+            _named('a.png', synthetic_upload('png', 64)[1]),
+            _named('set.zip', zipped.getvalue()),
+            _named('c.npy', synthetic_upload('npy', 64)[1]),
+            _named('bad.zip', b'not a zip'),
+            _named('d.jpeg', synthetic_upload('jpeg', 64, seed=2)[1]),
+        ]
+
+        with mock.patch.object(batch_predict, 'BATCH_CHUNK_SIZE', 2):
+            lines = [json.loads(line) for line in batch_predict.stream_predictions(uploads, self.model_key, 'rle')]
+
+        results, summary = lines[:-1], lines[-1]
+        self.assertEqual([r['index'] for r in results], list(range(6)))
+        self.assertEqual([r['filename'] for r in results],
+                         ['a.png', 'b.png', 'broken.png', 'c.npy', 'bad.zip', 'd.jpeg'])
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok', 'error', 'ok', 'error', 'ok'])
+        self.assertIn('Unreadable archive', results[4]['error'])
+        self.assertTrue(results[2]['error'])
+        for result in results:
+            if result['status'] == 'ok':
+                self.assertEqual(result['model_used'], self.model_key)
+                self.assertIn('mask_rle', result)
+        self.assertEqual({k: summary[k] for k in ('done', 'files', 'succeeded', 'failed')},
+                         {'done': True, 'files': 6, 'succeeded': 4, 'failed': 2})
+        self.assertGreaterEqual(summary['elapsed_ms'], 0)
+
+    def test_preprocessing_threads_close_their_database_connections(self):
+        calls = []
+
+        def record_close():
+            calls.append(threading.current_thread().name)
+
+        uploads = [_named(f'{i}.png', synthetic_upload('png', 64, seed=i)[1]) for i in range(3)]
+        with mock.patch.object(batch_predict, 'close_old_connections', record_close):
+            list(batch_predict.stream_predictions(uploads, self.model_key, 'summary'))
+
+        # Before and after each file, on the preprocessing pool
+        self.assertEqual(len(calls), 6)
+        self.assertTrue(all(name.startswith('batch-preprocess') for name in calls))
+
+
+class MitigationTests(SimpleTestCase):
+    """The histogram-LUT engine against the original np.unique implementation."""
+
+    def test_matches_legacy_output(self):
+        rng = np.random.default_rng(0)
+        for size, channels, classes in ((256, 8, 4), (256, 3, 2), (97, 8, 4), (64, 3, 1)):
+            tensor = rng.random((1, size, size, channels), dtype=np.float32)
+            mask = rng.integers(0, classes, (size, size)).astype(np.uint8)
+            expected = utils.mitigate_shadows_legacy(tensor, mask)
+            for block_rows in (7, 512):
+                np.testing.assert_array_equal(mitigation.mitigate_shadows(tensor, mask, block_rows=block_rows), expected)
+
+    def test_integer_memmaps_match_float_inputs(self):
+        rng = np.random.default_rng(3)
+        scene = rng.integers(-2000, 30000, (1, 300, 300, 8)).astype(np.int16)
+        mask = rng.integers(0, 4, (300, 300)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'scene.npy')
+            np.save(path, scene)
+            mapped = np.load(path, mmap_mode='r')
+
+            np.testing.assert_array_equal(mitigation.mitigate_shadows(mapped, mask, block_rows=64),
+                                          utils.mitigate_shadows_legacy(scene, mask))
+            np.testing.assert_array_equal(mitigation.mitigate_bands(mapped[0], mask, block_rows=64),
+                                          mitigation.mitigate_bands(scene[0].astype(np.float64), mask))
+            del mapped
+
+    def test_bands_only_change_clear_pixels(self):
+        rng = np.random.default_rng(1)
+        scene = rng.random((64, 48, 8), dtype=np.float32)
+        mask = rng.integers(0, 4, (64, 48)).astype(np.uint8)
+        out = mitigation.mitigate_bands(scene, mask, block_rows=16)
+
+        self.assertEqual(out.shape, (64, 48, 8))
+        np.testing.assert_array_equal(out[mask != 0], scene[mask != 0])
+        self.assertFalse(np.array_equal(out[mask == 0], scene[mask == 0]))
+
+
+def _jpeg(width, height):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)
+    image[..., 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+    return _named('scene.jpg', cv2.imencode('.jpg', image)[1].tobytes())
+
+
+class DraftDecodeTests(SimpleTestCase):
+
+    def decode(self, upload):
+        opened = []
+        open_image = utils._open_image
+
+        def recording_open(file_obj):
+            opened.append(open_image(file_obj))
+            return opened[-1]
+
+        with mock.patch.object(utils, '_open_image', recording_open):
+            decoded = np.asarray(utils.decode_resized(upload))
+        return decoded, opened[0].size
+
+    def test_large_jpegs_decode_at_the_smallest_scale_that_covers_the_output(self):
+        # 1/8 would leave the short side at 192px, so the decoder stops at 1/4
+        decoded, drafted = self.decode(_jpeg(2048, 1536))
+        self.assertEqual(drafted, (512, 384))
+        self.assertEqual(decoded.shape, (256, 256, 3))
+
+        full = Image.open(_jpeg(2048, 1536)).convert('RGB').resize((256, 256))
+        self.assertLess(np.abs(decoded.astype(np.int16) - np.asarray(full)).mean(), 3.0)
+
+    def test_small_jpegs_are_not_reduced_below_the_output(self):
+        decoded, drafted = self.decode(_jpeg(400, 300))
+        self.assertEqual(drafted, (400, 300))
+        self.assertEqual(decoded.shape, (256, 256, 3))
+
+
+class PostprocessTests(SimpleTestCase):
+    """The fused lookup-table post-processing against the original per-class masking."""
+
+    @staticmethod
+    def _legacy(prediction):
+        pred_mask = np.argmax(prediction, axis=-1)[0]
+        mask = np.zeros_like(pred_mask)
+        mask[pred_mask == 2] = 1
+        mask[pred_mask == 3] = 2
+        mask[pred_mask == 4] = 3
+
+        gray = np.zeros(mask.shape, dtype=np.uint8)
+        intensity = np.zeros(mask.shape, dtype=np.uint8)
+        for cls, gray_value, solar_value in ((0, 0, 255), (1, 85, 25), (2, 170, 127), (3, 255, 25)):
+            gray[mask == cls] = gray_value
+            intensity[mask == cls] = solar_value
+        heatmap = cv2.cvtColor(cv2.applyColorMap(intensity, cv2.COLORMAP_JET), cv2.COLOR_BGR2RGB)
+        return mask, gray, heatmap
+
+    def test_matches_legacy_remap_gray_and_heatmap(self):
+        rng = np.random.default_rng(4)
+        for height, width, classes in ((256, 256, 5), (37, 301, 6)):
+            prediction = rng.random((1, height, width, classes), dtype=np.float32)
+            mask, gray, heatmap = self._legacy(prediction)
+            processed = utils.fused_postprocess(prediction)
+
+            np.testing.assert_array_equal(processed.mask, mask)
+            np.testing.assert_array_equal(processed.gray, gray)
+            np.testing.assert_array_equal(processed.heatmap, heatmap)
+            np.testing.assert_array_equal(processed.counts, np.bincount(mask.ravel(), minlength=4))
+            np.testing.assert_array_equal(utils.remap_classes(prediction), mask)
+
+            # Rebuilding from the stored display mask gives the same outputs
+            for rebuilt, original in zip(utils.postprocess_display(processed.mask), processed):
+                np.testing.assert_array_equal(rebuilt, original)
+
+
+class ResponseFormatTests(_StubModelMixin, SimpleTestCase):
+    def _predict(self, upload, query='', **extra):
+        upload.seek(0)
+        return self.client.post(f'/api/predict/{query}', {'file': upload, 'model_type': self.model_key}, **extra)
+
+    def test_rle_round_trip(self):
+        rng = np.random.default_rng(5)
+        for mask in (rng.integers(0, 4, (37, 53)).astype(np.uint8), np.zeros((0, 4), dtype=np.uint8),
+                     np.full((8, 8), 3, dtype=np.uint8)):
+            rle = formats.rle_encode(mask)
+            self.assertEqual(sum(rle['lengths']), mask.size)
+            np.testing.assert_array_equal(formats.rle_decode(rle), mask)
+
+    @mock.patch.object(encoding, 'IMAGE_CODEC', 'webp')
+    def test_image_formats_name_the_encoded_payloads(self):
+        upload = self.upload()
+        body = self._predict(upload).json()
+        self.assertEqual((body['image_format'], body['mask_format']), ('image/webp', 'image/webp'))
+        self.assertTrue(body['original_image_url'].startswith('data:image/webp;base64,'))
+        for name in ('mask', 'solar_heatmap'):
+            self.assertEqual(base64.b64decode(body[name])[8:12], b'WEBP')
+
+        upload.seek(0)
+        body = self.client.post('/api/mitigate/', {'file': upload, 'model_type': self.model_key}).json()
+        self.assertEqual(body['image_format'], 'image/webp')
+        self.assertEqual(base64.b64decode(body['mitigated_image'])[8:12], b'WEBP')
+
+    def test_raw_rle_and_multipart_carry_the_same_mask(self):
+        upload = self.upload()
+        raw = self._predict(upload, '?output=raw')
+        self.assertEqual(raw['Content-Type'], 'application/octet-stream')
+        shape = tuple(int(d) for d in raw['X-Mask-Shape'].split(','))
+        mask = np.frombuffer(raw.content, dtype=np.uint8).reshape(shape)
+
+        # Accept header negotiation, answered from the prediction cache
+        rle = self._predict(upload, HTTP_ACCEPT='application/vnd.cloudvision.rle+json')
+        body = json.loads(rle.content)
+        np.testing.assert_array_equal(formats.rle_decode(body['mask_rle']), mask)
+        self.assertEqual(json.loads(raw['X-Percentages']), body['percentages'])
+
+        multipart = self._predict(upload, '?output=multipart')
+        message = email.message_from_bytes(
+            f"Content-Type: {multipart['Content-Type']}\r\n\r\n".encode() + multipart.content)
+        parts = {part.get_param('name', header='Content-Disposition'): part for part in message.get_payload()}
+        self.assertEqual(list(parts), ['metadata', 'mask', 'original_image', 'solar_heatmap'])
+        self.assertEqual(json.loads(parts['metadata'].get_payload(decode=True))['shape'], list(shape))
+        self.assertEqual(parts['mask'].get_payload(decode=True)[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(self.model.calls, 1)
+
+    def test_unknown_output_is_rejected(self):
+        self.assertEqual(self._predict(self.upload(), '?output=bmp').status_code, 400)
+
+
+@mock.patch.object(llm, 'GEMINI_STUB', True)
+class AsyncViewTests(_StubModelMixin, SimpleTestCase):
+    """The ASGI views, called directly (the URLs only route to them with ASYNC_VIEWS=True)."""
+
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+        patcher = mock.patch.object(llm, 'report_cache', llm.ReportCache(path=''))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _call(self, view, path, data, **extra):
+        return asyncio.run(view.as_view()(self.factory.post(path, data, **extra)))
+
+    def _post_json(self, view, path, body):
+        return self._call(view, path, json.dumps(body), content_type='application/json')
+
+    def test_predict_and_mitigate_run_off_the_event_loop(self):
+        threads = []
+        segment = async_views.segment
+
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return segment(*args, **kwargs)
+
+        upload = self.upload()
+        with mock.patch.object(async_views, 'segment', record_thread):
+            response = self._call(async_views.AsyncPredictView, '/api/predict/',
+                                  {'file': upload, 'model_type': self.model_key})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('percentages', json.loads(response.content))
+
+            upload.seek(0)
+            response = self._call(async_views.AsyncMitigateView, '/api/mitigate/',
+                                  {'file': upload, 'model_type': self.model_key})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('mitigated_image', json.loads(response.content))
+
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('inference') for name in threads))
+        self.assertEqual(self.model.calls, 1)  # /mitigate/ reused the prediction
+
+    def test_executor_threads_close_their_database_connections(self):
+        calls = []
+
+        def record_close():
+            calls.append(threading.current_thread().name)
+
+        with mock.patch.object(async_views, 'close_old_connections', record_close), \
+                mock.patch.object(async_views, 'segment', side_effect=RuntimeError('bad upload')):
+            response = self._call(async_views.AsyncPredictView, '/api/predict/',
+                                  {'file': self.upload(), 'model_type': self.model_key})
+
+        self.assertEqual(response.status_code, 500)
+        # Before and after the request, on the executor thread, also when it fails
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(all(name.startswith('inference') for name in calls))
+
+    def test_missing_file_is_rejected(self):
+        response = self._call(async_views.AsyncPredictView, '/api/predict/', {'model_type': self.model_key})
+        self.assertEqual(response.status_code, 400)
+
+    def test_gemini_analysis_and_chat(self):
+        response = self._post_json(async_views.AsyncGeminiAnalysisView, '/api/gemini-analysis/',
+                                   {'percentages': {'Clear': 80.0, 'Shadow': 20.0}})
+        self.assertTrue(json.loads(response.content)['analysis'].startswith('[stub]'))
+        self.assertEqual(self._post_json(async_views.AsyncGeminiAnalysisView, '/api/gemini-analysis/', {}).status_code, 400)
+
+        response = self._post_json(async_views.AsyncChatView, '/api/chat/', {'message': 'Is it cloudy?'})
+        self.assertTrue(json.loads(response.content)['reply'].startswith('[stub]'))
+
+        with mock.patch.object(async_views, 'agenerate', side_effect=RuntimeError('quota')):
+            response = self._post_json(async_views.AsyncChatView, '/api/chat/', {'message': 'Is it cloudy?'})
+        self.assertEqual(json.loads(response.content), {'reply': views.CHAT_ERROR_REPLY})
+
+
+class _BrokenStreamModel:
+    """Streams one chunk, then fails like a dropped Gemini connection."""
+
+    def __init__(self):
+        self.closed = False
+
+    def _chunks(self):
+        try:
+            yield llm._StubResponse('Partly ')
+            raise ConnectionError('stream reset')
+        finally:
+            self.closed = True
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return self._chunks()
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        async def chunks():
+            for chunk in self._chunks():
+                yield chunk
+        return chunks()
+
+
+def _sse_events(payload):
+    """[(event, data)] of a text/event-stream body."""
+    events = []
+    for block in payload.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+@mock.patch.object(llm, 'GEMINI_STUB', True)
+class ChatStreamTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(llm, 'stream_stats', llm.StreamStats())
+        self.stats = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stream(self, path='/api/chat/stream/', message='Will it rain?'):
+        response = self.client.post(path, {'message': message}, content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return _sse_events(b''.join(response.streaming_content).decode())
+
+    def _astream(self, model=None):
+        request = AsyncRequestFactory().post('/api/chat/stream/', json.dumps({'message': 'Will it rain?'}),
+                                             content_type='application/json')
+
+        async def run():
+            response = await async_views.AsyncChatStreamView.as_view()(request)
+            return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        with mock.patch.object(async_views, 'get_model', return_value=model or llm.stub_model):
+            return _sse_events(asyncio.run(run()))
+
+    def test_tokens_then_done(self):
+        for events in (self._stream(), self._astream()):
+            self.assertEqual(events[-1], ('done', {}))
+            self.assertTrue(all(event == 'token' for event, _ in events[:-1]))
+            reply = ''.join(data['text'] for _, data in events[:-1])
+            self.assertTrue(reply.startswith('[stub] '))
+        self.assertEqual((self.stats.started, self.stats.completed, self.stats.ttft_count), (2, 2, 2))
+
+    def test_failed_stream_ends_with_an_error_event(self):
+        model = _BrokenStreamModel()
+        with mock.patch.object(views, 'get_model', return_value=model):
+            events = self._stream()
+        self.assertEqual(events, [('token', {'text': 'Partly '}), ('error', {'reply': views.CHAT_ERROR_REPLY})])
+        self.assertTrue(model.closed)
+
+        self.assertEqual(self._astream(_BrokenStreamModel())[-1], ('error', {'reply': views.CHAT_ERROR_REPLY}))
+        self.assertEqual(self.stats.failed, 2)
+
+    def test_client_disconnect_closes_the_gemini_stream(self):
+        events = views._chat_events(llm.stream_chat('Will it rain?', llm.stub_model))
+        next(events)
+        events.close()
+        self.assertEqual((self.stats.disconnected, self.stats.completed), (1, 0))
+
+    def test_missing_message_is_rejected(self):
+        self.assertEqual(self.client.post('/api/chat/stream/', {}, content_type='application/json').status_code, 400)
+
+
+class MetricsTests(_StubModelMixin, SimpleTestCase):
+    SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_]+="([^"\\]|\\.)*",?)*\})? -?[0-9.e+-]+$')
+
+    def test_exposition_format(self):
+        registry = metrics.Registry()
+        summary = registry.summary('test_seconds', 'Test timings.', ('stage',))
+        for value in (1.0, 2.0, 3.0, 4.0):
+            summary.observe(value, 'decode')
+        registry.counter('test_total', 'Test counter.', ('path',)).inc('a"b\\c\n')
+        registry.collector(lambda: [('test_depth', 'gauge', 'Test gauge.', [({'model': 'v2'}, 3)])])
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_seconds Test timings.',
+            '# TYPE test_seconds summary',
+            'test_seconds{stage="decode",quantile="0.5"} 3.0',
+            'test_seconds{stage="decode",quantile="0.95"} 4.0',
+            'test_seconds{stage="decode",quantile="0.99"} 4.0',
+            'test_seconds_sum{stage="decode"} 10.0',
+            'test_seconds_count{stage="decode"} 4',
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{path="a\\"b\\\\c\\n"} 1',
+            '# HELP test_depth Test gauge.',
+            '# TYPE test_depth gauge',
+            'test_depth{model="v2"} 3',
+        ])
+
+    def test_nested_stages_are_not_double_counted(self):
+        summary = metrics.Registry().summary('stage_seconds', 'Stages.', ('stage', 'model'))
+        with mock.patch.object(metrics, 'stage_seconds', summary):
+            with metrics.model_context('v9'):
+                with metrics.stage_timer('preprocess'):
+                    time.sleep(0.02)
+                    with metrics.stage_timer('decode'):
+                        time.sleep(0.05)
+
+        _, outer_count, outer = summary._series[('preprocess', 'v9')]
+        _, inner_count, inner = summary._series[('decode', 'v9')]
+        self.assertEqual((outer_count, inner_count), (1, 1))
+        self.assertGreaterEqual(inner, 0.05)
+        self.assertLess(outer, 0.045)
+
+    def test_endpoint_reports_request_stages(self):
+        self.client.post('/api/predict/', {'file': self.upload(), 'model_type': self.model_key})
+        response = self.client.get('/api/metrics/')
+
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        lines = response.content.decode().splitlines()
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertRegex(line, self.SAMPLE)
+        for stage in ('preprocess', 'inference', 'postprocess', 'encode'):
+            series = f'cloudvision_stage_seconds_count{{stage="{stage}",model="{self.model_key}"}} '
+            self.assertTrue(any(line.startswith(series) for line in lines), stage)
+
+
+class ResultStoreTests(TestCase):
+    """Persistent result store, on a temporary directory."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ResultStore(root=self.tmp.name, max_bytes=10 * 1024 * 1024, enabled=True)
+        raw = np.random.default_rng(0).integers(0, 5, (64, 64)).astype(np.uint8)
+        self.processed = utils.postprocess_indices(raw)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _save(self, digest):
+        key = f"{digest}:v2:stub:{utils.PREPROCESS_VERSION}"
+        self.store.save(key, self.processed, {'Clear': 50.0, 'Shadow': 20.0}, 'v2', input_name='/tmp/scene.png')
+        return key
+
+    def test_round_trip(self):
+        key = self._save('a' * 64)
+        loaded = ResultStore(root=self.tmp.name, enabled=True).load(key)
+
+        for stored, original in zip(loaded, self.processed):
+            np.testing.assert_array_equal(stored, original)
+        entry = AnalysisResult.objects.get(key=key)
+        self.assertEqual((entry.input_name, entry.hits, entry.has_shadow), ('scene.png', 1, True))
+        self.assertIsNone(self.store.load(f"{'b' * 64}:v2:stub:1"))
+
+    def test_images_are_attached_once(self):
+        key = self._save('a' * 64)
+        self.assertIsNone(self.store.images(key))
+        # A palette mask stays PNG while the other images follow IMAGE_CODEC=webp
+        images = {'mask': (b'mask', 'image/png'), 'original_image': (b'preview', 'image/webp'),
+                  'solar_heatmap': (b'heatmap', 'image/webp')}
+        self.store.attach_images(key, images)
+        self.store.attach_images(key, {name: (b'other', 'image/png') for name in images})
+        self.assertEqual(self.store.images(key), images)
+        self.assertEqual(AnalysisResult.objects.get(key=key).image_format, 'image/webp')
+
+    def test_garbage_collection_removes_least_recently_used(self):
+        first, second = self._save('a' * 64), self._save('b' * 64)
+        self.store.load(first)
+        self.store.max_bytes = int(AnalysisResult.objects.get(key=first).size_bytes * 1.5)
+
+        self.assertEqual(self.store.collect_garbage(), 1)
+        self.assertTrue(AnalysisResult.objects.filter(key=first).exists())
+        self.assertFalse(AnalysisResult.objects.filter(key=second).exists())
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'bb')))
+
+    def test_garbage_collection_runs_every_gc_every_writes(self):
+        self.store.gc_every = 2
+        self.store.max_bytes = 1
+        first = self._save('a' * 64)
+        self.assertTrue(AnalysisResult.objects.filter(key=first).exists())
+        self._save('b' * 64)
+        self.assertEqual(self.store.collected, 2)
+
+    def test_saving_again_keeps_images_and_hits(self):
+        key = self._save('a' * 64)
+        self.store.attach_images(key, {name: (b'img', 'image/png') for name in IMAGE_NAMES})
+        self.store.load(key)
+        self._save('a' * 64)
+
+        entry = AnalysisResult.objects.get(key=key)
+        self.assertEqual((entry.image_format, entry.hits), ('image/png', 1))
+
+
+class HistoryViewTests(TestCase):
+    """/api/history/ filters and paging over stored analyses, and the detail view."""
+
+    def setUp(self):
+        for i, (model_type, shadow) in enumerate([('v1', 0.0), ('v2', 5.0), ('v2', 0.5), ('v3', 9.0), ('v2', 2.0)]):
+            entry = AnalysisResult.objects.create(
+                key=f"{i:064x}:{model_type}:stub:1", digest=f"{i:064x}", model_type=model_type, height=8, width=8,
+                percentages={'Clear': 100 - shadow, 'Shadow': shadow}, has_shadow=shadow > 1.0, path=f"{i:02x}",
+            )
+            AnalysisResult.objects.filter(pk=entry.pk).update(created_at=entry.created_at.replace(year=2000 + i))
+
+    def history(self, **params):
+        response = self.client.get('/api/history/', params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        return body['count'], [entry['digest'][-1] for entry in body['results']]
+
+    def test_newest_first_with_paging(self):
+        self.assertEqual(self.history(), (5, ['4', '3', '2', '1', '0']))
+        self.assertEqual(self.history(limit=2, offset=1), (5, ['3', '2']))
+        self.assertEqual(self.history(offset=10), (5, []))
+        self.assertEqual(self.client.get('/api/history/', {'limit': 'all'}).status_code, 400)
+
+    def test_filters_combine(self):
+        self.assertEqual(self.history(model_type='v2'), (3, ['4', '2', '1']))
+        self.assertEqual(self.history(model_type='v2', has_shadow='true'), (2, ['4', '1']))
+        self.assertEqual(self.history(has_shadow='false'), (2, ['2', '0']))
+        self.assertEqual(self.history(digest=f"{3:064x}"), (1, ['3']))
+
+    def test_detail_without_images_returns_the_stored_mask(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ResultStore(root=tmp, enabled=True)
+            key = f"{'f' * 64}:v2:stub:1"
+            store.save(key, utils.postprocess_indices(np.zeros((4, 6), dtype=np.uint8)), {'Clear': 100.0}, 'v2')
+            entry = AnalysisResult.objects.get(key=key)
+
+            with mock.patch.object(views, 'result_store', store):
+                body = self.client.get(f'/api/history/{entry.pk}/').json()
+                self.assertEqual(body['shape'], [4, 6])
+                self.assertIn('mask_rle', body)
+                store._remove_files(entry.path)
+                self.assertEqual(self.client.get(f'/api/history/{entry.pk}/').status_code, 410)
+        self.assertEqual(self.client.get('/api/history/999999/').status_code, 404)
+
+
+class BatchResultStoreTests(TransactionTestCase):
+    """/predict/batch/ through the result store (a TransactionTestCase: files are prepared on other threads)."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ResultStore(root=self.tmp.name, enabled=True)
+        ModelLoader().install_model('batch-stub', StubSegmentationModel(), backend='stub')
+
+    def tearDown(self):
+        ModelLoader().unload_model('batch-stub')
+        self.tmp.cleanup()
+
+    def test_batch_results_go_through_the_store(self):
+        filename, payload, _ = synthetic_upload('png', 64, seed=3)
+
+        def run(output):
+            prediction_cache.clear()
+            lines = list(batch_predict.stream_predictions([_named(filename, payload)], 'batch-stub', output))
+            return json.loads(lines[0])
+
+        with mock.patch.object(batch_predict, 'result_store', self.store), \
+                mock.patch.object(pipeline, 'result_store', self.store):
+            self.assertEqual(run('json')['status'], 'ok')
+            self.assertTrue(AnalysisResult.objects.get().as_history_dict()['has_images'])
+
+            # A store hit needs no preprocessing when the output does not include the preview
+            with mock.patch.object(batch_predict, 'preprocess_for_model') as preprocess:
+                self.assertEqual(run('summary')['status'], 'ok')
+            preprocess.assert_not_called()
+
+
+class _FailingModel:
+    def predict(self, batch, verbose=0):
+        raise ValueError("bad input")
+
+
+class InferenceServerTests(SimpleTestCase):
+    """Worker/server round trips over a temporary Unix socket, with stub models."""
+
+    def setUp(self):
+        # Worker and server share this process and its resource tracker, so the unlink already
+        # unregisters each segment; untracking it again makes the tracker print KeyErrors
+        untrack = mock.patch.object(inference_server, '_untrack', lambda shm: None)
+        untrack.start()
+        self.addCleanup(untrack.stop)
+        self.tmp = tempfile.TemporaryDirectory()
+        ModelLoader().install_model('ipc-stub', StubSegmentationModel(), backend='stub')
+        ModelLoader().install_model('ipc-fail', _FailingModel(), backend='stub')
+        self.server = InferenceServer(os.path.join(self.tmp.name, 'inference.sock'))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = InferenceClient(self.server.socket_path, timeout=10)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        ModelLoader().unload_model('ipc-stub')
+        ModelLoader().unload_model('ipc-fail')
+        self.tmp.cleanup()
+
+    def test_predict_inline_and_shared_memory(self):
+        # 8x8 inputs fit inline, 256x256 ones go through shared memory
+        for size in (8, 256):
+            output = self.client.predict('ipc-stub', np.zeros((2, size, size, 8), dtype=np.float32))
+            self.assertEqual((output.shape, output.dtype), ((2, size, size, 5), np.float32))
+
+        health = self.client.health()
+        self.assertEqual((health['status'], health['requests']['predict'], health['rows_served']), ('ok', 2, 4))
+
+    def test_errors_are_returned_to_the_worker(self):
+        with self.assertRaisesRegex(InferenceServerError, 'bad input'):
+            self.client.predict('ipc-fail', np.zeros((1, 8, 8, 8), dtype=np.float32))
+        # The connection stays usable after a failed request
+        self.assertEqual(self.client.predict('ipc-stub', np.zeros((1, 8, 8, 8), dtype=np.float32)).shape, (1, 8, 8, 5))
+
+
+class _WeightsModel:
+    def __init__(self, nbytes):
+        self.weights = [np.zeros(nbytes, dtype=np.uint8)]
+
+    def get_weights(self):
+        return self.weights
+
+
+class ModelLoaderTests(SimpleTestCase):
+    """Loading through a fake tf.keras.models.load_model, from a temporary weights file."""
+
+    keys = ('loader-a', 'loader-b')
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'model.keras')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1000)
+        self.loads = []
+
+        def load_model(model_path, custom_objects=None):
+            self.loads.append(model_path)
+            time.sleep(0.05)
+            return _WeightsModel(1000)
+
+        tf = mock.Mock()
+        tf.keras.models.load_model = load_model
+        for patcher in (mock.patch.dict(os.environ, {'MODEL_PATH_V1': path, 'MODEL_BACKEND': 'keras'}),
+                        mock.patch.object(model_loader, '_model_config', lambda key: (path, {})),
+                        mock.patch.object(model_loader, 'import_tensorflow', lambda: tf)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for key in self.keys:
+            ModelLoader().unload_model(key)
+            ModelLoader._model_info.pop(key, None)
+        self.tmp.cleanup()
+
+    def test_concurrent_first_requests_load_once(self):
+        models = []
+        threads = [threading.Thread(target=lambda: models.append(ModelLoader().load_model('loader-a'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(len(models), 4)
+        self.assertTrue(all(model is models[0] for model in models))
+
+    def test_least_recently_used_model_is_evicted_over_budget(self):
+        with mock.patch.object(model_loader, 'MODEL_MEMORY_BUDGET_BYTES', 1500):
+            first = ModelLoader().load_model('loader-a')
+            ModelLoader().load_model('loader-b')
+
+            stats = ModelLoader().stats()
+            self.assertEqual([key for key in stats['lru_order'] if key in self.keys], ['loader-b'])
+            self.assertEqual(stats['models']['loader-a']['evictions'], 1)
+            # An evicted model is loaded again on its next use
+            self.assertIsNot(ModelLoader().load_model('loader-a'), first)
+        self.assertEqual(len(self.loads), 3)
+
+
+class WarmupTests(_StubModelMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.state = warmup.WarmupState()
+        for module in (warmup, views):
+            patcher = mock.patch.object(module, 'warmup_state', self.state)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_ready_only_after_warmup_finishes(self):
+        self.assertEqual(self.client.get('/api/ready/').status_code, 200)  # Warm-up disabled
+
+        self.state.enabled = True
+        self.assertEqual(self.client.get('/api/ready/').status_code, 503)
+
+        warmup.run_warmup([self.model_key], batch_sizes=[1, 4])
+        response = self.client.get('/api/ready/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.json()['models'][self.model_key]['batches']), ['1', '4'])
+        self.assertEqual(self.model.calls, 2)
+
+    def test_failed_warmup_stays_unready(self):
+        ModelLoader().install_model('warmup-fail', _FailingModel(), backend='stub')
+        self.addCleanup(ModelLoader().unload_model, 'warmup-fail')
+        warmup.run_warmup([self.model_key, 'warmup-fail'], batch_sizes=[1])
+
+        response = self.client.get('/api/ready/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(list(response.json()['errors']), ['warmup-fail'])
+
+    @mock.patch.dict(os.environ, {'MODEL_PRELOAD': 'v2', 'RUN_MAIN': 'true'})
+    @mock.patch('sys.argv', ['manage.py', 'runserver'])
+    def test_preload_starts_in_the_web_process_only(self):
+        config = apps.get_app_config('analyzer')
+        with mock.patch.object(warmup, 'start_warmup') as start:
+            config.ready()
+            start.assert_called_once()
+
+            start.reset_mock()
+            # A spawned job pool worker re-runs ready() with the same argv and environment
+            with mock.patch('multiprocessing.parent_process', return_value=object()):
+                config.ready()
+            start.assert_not_called()
+
+
+class _FakeInterpreter:
+    """Identity int8 model (scale 0.5) that fails if two threads use it at once."""
+
+    created = 0
+
+    def __init__(self, model_content, num_threads=None):
+        type(self).created += 1
+        self.busy = threading.Lock()
+        self.shape = (1, 4, 4, 8)
+        self.tensor = None
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.shape), 'dtype': np.int8, 'quantization': (0.5, 0)}]
+
+    def get_output_details(self):
+        return [{'index': 1, 'dtype': np.int8, 'quantization': (0.5, 0)}]
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = tuple(shape)
+
+    def set_tensor(self, index, value):
+        if not self.busy.acquire(blocking=False):
+            raise AssertionError("Interpreter used by two threads at once")
+        self.tensor = value
+
+    def invoke(self):
+        time.sleep(0.01)
+
+    def get_tensor(self, index):
+        self.busy.release()
+        return self.tensor
+
+
+class TFLiteBackendTests(SimpleTestCase):
+    def setUp(self):
+        _FakeInterpreter.created = 0
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'model.int8.tflite')
+        with open(self.path, 'wb') as f:
+            f.write(b'tflite')
+        tf = mock.Mock()
+        tf.lite.Interpreter = _FakeInterpreter
+        patcher = mock.patch.object(tf_runtime, 'import_tensorflow', lambda: tf)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_int8_inputs_and_outputs_are_quantized_at_the_boundary(self):
+        model = tflite_backend.TFLiteModel(self.path, pool_size=1)
+        batch = np.array([0.26, -1.0, 3.9, 100.0], dtype=np.float32).reshape(1, 1, 1, 4)
+        output = model.predict(batch)
+        self.assertEqual(output.dtype, np.float32)
+        np.testing.assert_array_equal(output.ravel(), [0.5, -1.0, 4.0, 63.5])  # 100 saturates at int8
+
+    def test_concurrent_calls_share_the_interpreter_pool(self):
+        model = tflite_backend.TFLiteModel(self.path, pool_size=2)
+        batch = np.ones((2, 4, 4, 8), dtype=np.float32)
+        errors = []
+
+        def call():
+            try:
+                np.testing.assert_array_equal(model.predict(batch), batch)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertEqual(errors, [])
+        self.assertEqual(_FakeInterpreter.created, 2)
+        self.assertEqual(model.size_bytes, 6)
+
+    def test_backend_is_selected_per_model_key(self):
+        with mock.patch.dict(os.environ, {'MODEL_BACKEND': 'tflite-dynamic', 'MODEL_BACKEND_V3': 'keras',
+                                          'MODEL_PATH_V2': '/models/v2.keras'}):
+            self.assertEqual(tflite_backend.model_backend('v2'), 'tflite-dynamic')
+            self.assertEqual(tflite_backend.model_backend('v3'), 'keras')
+            self.assertEqual(model_loader.served_path('v2'), '/models/v2.dynamic.tflite')
+
+
+def _geotiff(bands):
+    """GeoTIFF bytes of a (count, H, W) uint16 array."""
+    from rasterio.io import MemoryFile
+
+    count, height, width = bands.shape
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', count=count, height=height, width=width, dtype='uint16') as dataset:
+            dataset.write(bands)
+        return memfile.read()
+
+
+@skipUnless(importlib.util.find_spec('rasterio'), "GeoTIFF support requires rasterio")
+class GeoTiffTests(_StubModelMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # The test rasters have no georeferencing, which rasterio warns about on every open
+        from rasterio.errors import NotGeoreferencedWarning
+
+        catcher = warnings.catch_warnings()
+        catcher.__enter__()
+        self.addCleanup(catcher.__exit__, None, None, None)
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+
+    def _landsat_stack(self, height=40, width=300):
+        # Band n holds n * 1000, band 11 is above the clip range
+        bands = np.stack([np.full((height, width), n * 1000, dtype=np.uint16) for n in range(1, 12)])
+        bands[10] = 50000
+        return bands
+
+    def test_full_stack_bands_are_selected_and_normalized(self):
+        with ExitStack() as stack:
+            readers = geotiff.open_band_readers([_named('scene.tif', _geotiff(self._landsat_stack()))], stack)
+            window = geotiff.RasterioSource(readers)[5:7, 290:300]
+
+        self.assertEqual(window.shape, (2, 10, 8))
+        expected = [n * 1000 / geotiff.MAX_VAL for n in geotiff.BANDS_TO_USE[:-1]] + [1.0]
+        np.testing.assert_allclose(window[0, 0], expected)
+
+    def test_per_band_files_are_analyzed(self):
+        stack = self._landsat_stack()
+        files = [SimpleUploadedFile(f'LC08_scene_B{n}.TIF', _geotiff(stack[n - 1:n])) for n in geotiff.BANDS_TO_USE]
+        response = self.client.post('/api/predict/geotiff/', {'file': files, 'model_type': self.model_key})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['scene_size'], {'height': 40, 'width': 300})
+        self.assertAlmostEqual(sum(body['percentages'].values()), 100.0, places=1)
+
+        response = self.client.post('/api/predict/geotiff/', {'file': files[:-1], 'model_type': self.model_key})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('[11]', response.json()['error'])
+
+
+class _QueuedExecutor:
+    """Holds submitted jobs until run_all(), in the test process."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.submitted.append((future, fn, args))
+        return future
+
+    def run_all(self):
+        for future, fn, args in self.submitted:
+            if future.set_running_or_notify_cancel():
+                future.set_result(fn(*args))
+
+
+class JobApiTests(_StubModelMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.executor = _QueuedExecutor()
+        for patcher in (mock.patch.object(jobs, 'JOB_STORAGE_DIR', self.tmp.name),
+                        mock.patch.object(jobs, 'get_executor', lambda: self.executor)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _submit(self, kind='predict'):
+        response = self.client.post('/api/jobs/', {'file': self.upload(), 'model_type': self.model_key, 'kind': kind})
+        self.assertEqual(response.status_code, 202)
+        return response.json()['id']
+
+    def test_job_lifecycle(self):
+        job_id = self._submit()
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/').json()['status'], 'queued')
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/result/').status_code, 202)
+
+        self.executor.run_all()
+
+        status = self.client.get(f'/api/jobs/{job_id}/').json()
+        self.assertEqual((status['status'], status['progress']), ('succeeded', 1.0))
+        result = self.client.get(f'/api/jobs/{job_id}/result/')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('percentages', result.json())
+        self.assertEqual(os.listdir(self.tmp.name), [])  # The stored upload is removed
+        self.assertEqual(self.client.post(f'/api/jobs/{job_id}/cancel/').status_code, 409)
+
+    def test_queued_job_is_cancelled_before_it_runs(self):
+        job_id = self._submit(kind='mitigate')
+        response = self.client.post(f'/api/jobs/{job_id}/cancel/')
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'cancelled'))
+
+        self.executor.run_all()
+        self.assertEqual(self.model.calls, 0)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/result/').status_code, 409)
+
+    def test_running_job_stops_at_its_next_progress_update(self):
+        job_id = self._submit()
+        AnalysisJob.objects.filter(pk=job_id).update(status=AnalysisJob.STATUS_RUNNING)
+        report = jobs._progress_reporter(job_id)
+        report(0.5)
+        self.assertEqual(AnalysisJob.objects.get(pk=job_id).progress, 0.45)
+
+        self.client.post(f'/api/jobs/{job_id}/cancel/')
+        with self.assertRaises(jobs.JobCancelled):
+            report(1.0)
+
+    def test_failed_submit_marks_the_job_failed(self):
+        self.executor.submit = mock.Mock(side_effect=RuntimeError('cannot schedule new futures after shutdown'))
+        response = self.client.post('/api/jobs/', {'file': self.upload(), 'model_type': self.model_key})
+
+        self.assertEqual(response.status_code, 500)
+        job = AnalysisJob.objects.get()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('shutdown', job.error)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_jobs_of_a_dead_worker_are_failed_on_lookup(self):
+        job_id = self._submit()
+        self.assertEqual(AnalysisJob.objects.get(pk=job_id).owner, jobs._owner())
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/').json()['status'], 'queued')
+
+        # The submitting web process restarted: its pool and the queued job are gone
+        jobs._futures.pop(job_id)
+        AnalysisJob.objects.filter(pk=job_id).update(owner=f"{jobs.socket.gethostname()}:4194304")
+        with mock.patch('os.kill', side_effect=ProcessLookupError):
+            status = self.client.get(f'/api/jobs/{job_id}/').json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/result/').status_code, 409)
+
+    def test_jobs_of_live_or_remote_workers_are_left_alone(self):
+        job_id = self._submit()
+        jobs._futures.pop(job_id)
+        for owner in ('other-host:1', f"{jobs.socket.gethostname()}:1"):
+            AnalysisJob.objects.filter(pk=job_id).update(owner=owner)
+            with mock.patch('os.kill'):
+                self.assertEqual(self.client.get(f'/api/jobs/{job_id}/').json()['status'], 'queued')
+
+    def test_dead_pool_worker_fails_its_job(self):
+        job_id = self._submit()
+        future = self.executor.submitted[0][0]
+        future.set_running_or_notify_cancel()
+        future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+
+        job = AnalysisJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('BrokenProcessPool', job.error)
+        self.assertNotIn(job_id, jobs._futures)
+
+    def test_unknown_kind_and_job_are_rejected(self):
+        response = self.client.post('/api/jobs/', {'file': self.upload(), 'kind': 'explode'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(f'/api/jobs/{uuid.uuid4()}/').status_code, 404)
+
+
+class ModelFingerprintTests(SimpleTestCase):
+    def test_changes_with_the_weights_file_and_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'model.keras')
+            with open(path, 'wb') as f:
+                f.write(b'weights')
+            with mock.patch.dict(os.environ, {'MODEL_PATH_V2': path, 'MODEL_BACKEND': 'keras'}):
+                original = model_fingerprint('v2')
+                self.assertEqual(model_fingerprint('v2'), original)
+
+                with open(path, 'wb') as f:
+                    f.write(b'retrained weights')
+                retrained = model_fingerprint('v2')
+                self.assertNotEqual(retrained, original)
+
+                with mock.patch.dict(os.environ, {'MODEL_BACKEND': 'tflite-int8'}):
+                    self.assertTrue(model_fingerprint('v2').startswith('tflite-int8-'))
+
+    def test_installed_models_use_their_backend(self):
+        ModelLoader().install_model('fingerprint-stub', StubSegmentationModel(), backend='stub')
+        try:
+            self.assertEqual(model_fingerprint('fingerprint-stub'), 'stub')
+        finally:
+            ModelLoader().unload_model('fingerprint-stub')
+
+
+class CpuPinningTests(SimpleTestCase):
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(tf_runtime.parse_cpu_list('0-3, 8,10-11'), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_processes_claim_separate_core_blocks(self):
+        with tempfile.TemporaryDirectory() as slot_dir, \
+                mock.patch.object(tf_runtime, 'CPU_SLOT_DIR', slot_dir), \
+                mock.patch.dict(tf_runtime._state, slot=None):
+            first_handle, blocks = None, []
+            try:
+                # Each call opens its own lock file handle, like a separate worker process would
+                for _ in range(3):
+                    blocks.append(tf_runtime._claim_slot(2, list(range(4))))
+                    first_handle = first_handle or tf_runtime._slot_file
+            finally:
+                if first_handle is not None:
+                    first_handle.close()
+                if tf_runtime._slot_file is not None:
+                    tf_runtime._slot_file.close()
+                tf_runtime._slot_file = None
+
+        self.assertEqual(blocks, [[0, 1], [2, 3], None])
+
+
+class ProfilingTests(SimpleTestCase):
+
+    def test_profiled_predict_includes_the_forward_pass(self):
+        def predict_fn(batch):
+            return batch * 2
+
+        session = profiling.ProfileSession('POST', '/api/predict/', 'header')
+        self.assertTrue(profiling._enable(session.profiler))
+        token = profiling.active_session.set(session)
+        try:
+            MicroBatcher('profiled', predict_fn, max_wait_ms=0).predict(np.ones((1, 4, 4, 8), dtype=np.float32))
+        finally:
+            session.profiler.disable()
+            profiling.active_session.reset(token)
+
+        # The batcher thread's own profile of the forward pass is attached to the session
+        self.assertEqual(len(session._extra), 1)
+        self.assertIn('predict_fn', {name for _, _, name in pstats.Stats(session._extra[0]).stats})
+
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    @mock.patch.object(profiling, 'PROFILE_SAMPLE_RATE', 0)
+    def test_header_needs_a_staff_session_or_the_secret(self):
+        middleware = profiling.ProfilingMiddleware(lambda request: None)
+
+        def reason(header, user=None):
+            request = RequestFactory().post('/api/predict/', HTTP_X_PROFILE=header)
+            request.user = user or AnonymousUser()
+            return middleware._reason(request)
+
+        self.assertIsNone(reason('1'))
+        self.assertEqual(reason('1', mock.Mock(is_staff=True)), 'header')
+        self.assertIsNone(reason('1', mock.Mock(is_staff=False)))
+        with mock.patch.object(profiling, 'PROFILE_SECRET', 's3cret'):
+            self.assertEqual(reason('s3cret'), 'header')
+            self.assertIsNone(reason('guess'))
+        self.assertIsNone(reason(''))
+
+
+class BenchApiTests(_StubModelMixin, SimpleTestCase):
+
+    @mock.patch.object(llm, 'GEMINI_STUB', True)
+    def test_stub_run_reports_every_scenario(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench_api.json')
+            call_command('bench_api', '--stub-models', '--models', self.model_key, '--endpoints', 'predict', 'chat',
+                         '--formats', 'png', '--sizes', '64', '--concurrency', '2', '--requests', '4',
+                         '--output', output, '--compare', output, stdout=io.StringIO())
+            with open(output) as f:
+                report = json.load(f)
+
+        results = {r['endpoint']: r for r in report['results']}
+        self.assertEqual(set(results), {'predict', 'chat'})
+        self.assertEqual(results['predict']['model'], self.model_key)
+        for result in results.values():
+            self.assertEqual((result['requests'], result['errors']), (4, 0))
+            self.assertGreater(result['throughput_rps'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_latency_summary(self):
+        summary = benchmarking.latency_summary([float(i) for i in range(1, 101)])
+        self.assertAlmostEqual(summary['p50_ms'], 50.5)
+        self.assertEqual(summary['max_ms'], 100.0)
+        self.assertEqual(benchmarking.latency_summary([])['p99_ms'], 0.0)
+
+
+class BenchUtilsTests(SimpleTestCase):
+    args = ('bench_utils', '--sizes', '256', '--functions', 'remap_classes', 'mask_to_base64', '--repeat', '1')
+
+    def test_baseline_round_trip_and_regressions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = os.path.join(tmp, 'baseline.json')
+            call_command(*self.args, '--baseline', baseline, '--save-baseline', stdout=io.StringIO())
+            with open(baseline) as f:
+                results = json.load(f)
+            self.assertEqual(set(results), {'remap_classes@256', 'mask_to_base64@256'})
+
+            # A baseline ten times faster than this machine is a regression
+            for result in results.values():
+                result['p50_ms'] /= 10
+            with open(baseline, 'w') as f:
+                json.dump(results, f)
+            with self.assertRaisesRegex(CommandError, '2 benchmark'):
+                call_command(*self.args, '--baseline', baseline, stdout=io.StringIO())
+
+            # and one ten times slower is not
+            for result in results.values():
+                result['p50_ms'] *= 100
+                result['peak_alloc_bytes'] *= 10
+            with open(baseline, 'w') as f:
+                json.dump(results, f)
+            call_command(*self.args, '--baseline', baseline, stdout=io.StringIO())
+
+
+class PredictionCacheTests(SimpleTestCase):
+    def test_memmapped_inputs_are_copied_into_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'upload.npy')
+            np.save(path, np.ones((1, 4, 4, 8), dtype=np.float32))
+            tensor = np.load(path, mmap_mode='r')
+            cache = PredictionCache(max_bytes=1024 * 1024, ttl=60)
+            cache.put('key', (tensor, 'processed'))
+            del tensor
+
+        cached, processed = cache.get('key')
+        self.assertNotIsInstance(cached, np.memmap)
+        self.assertIsNone(cached.base)
+        np.testing.assert_array_equal(cached, 1.0)
+        self.assertEqual((processed, cache.current_bytes), ('processed', 512))
+
+    def test_least_recently_used_entries_are_evicted_past_max_bytes(self):
+        cache = PredictionCache(max_bytes=1024, ttl=60)
+        for key in ('a', 'b'):
+            cache.put(key, (np.zeros(128, dtype=np.float32),))
+        cache.get('a')
+        cache.put('c', (np.zeros(128, dtype=np.float32),))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual((cache.evictions, cache.current_bytes), (1, 1024))
+
+        # Entries larger than the whole budget are not cached at all
+        cache.put('huge', (np.zeros(1024, dtype=np.float32),))
+        self.assertIsNone(cache.get('huge'))
+
+    def test_expired_entries_miss(self):
+        cache = PredictionCache(max_bytes=1024, ttl=60)
+        cache.put('a', (np.zeros(4, dtype=np.float32),))
+        with mock.patch('analyzer.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.expirations, cache.current_bytes), (1, 0))
+
+
+class PredictionCacheViewTests(_StubModelMixin, SimpleTestCase):
+    def test_mitigate_reuses_the_prediction_of_the_same_upload(self):
+        upload = self.upload()
+        self.assertEqual(self.client.post('/api/predict/', {'file': upload, 'model_type': self.model_key}).status_code, 200)
+        upload.seek(0)
+        response = self.client.post('/api/mitigate/', {'file': upload, 'model_type': self.model_key})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('mitigated_image', response.json())
+        self.assertEqual(self.model.calls, 1)
+
+
+class PredictBodyTests(SimpleTestCase):
+    def test_mask_reports_its_own_format(self):
+        images = {'mask': (b'mask', 'image/png'), 'original_image': (b'rgb', 'image/webp'),
+                  'solar_heatmap': (b'heat', 'image/webp')}
+        body = pipeline.predict_body(images, {'Shadow': 0.0}, 'v2')
+        self.assertEqual((body['image_format'], body['mask_format']), ('image/webp', 'image/png'))
+        self.assertTrue(body['original_image_url'].startswith('data:image/webp;base64,'))
+
+
+class MicroBatcherTests(SimpleTestCase):
+    """Concurrent callers share one forward pass and each get their own rows back."""
+
+    def _predict_concurrently(self, batcher, tensors):
+        results = [None] * len(tensors)
+        barrier = threading.Barrier(len(tensors))
+
+        def call(index):
+            barrier.wait()
+            results[index] = batcher.predict(tensors[index])
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(len(tensors))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        return results
+
+    def test_output_is_sliced_back_to_each_caller(self):
+        batcher = MicroBatcher('doubling', lambda x: x * 2, max_batch_size=8, max_wait_ms=500)
+        tensors = [np.full((rows, 4, 4, 8), i + 1, dtype=np.float32) for i, rows in enumerate((1, 3, 2))]
+
+        results = self._predict_concurrently(batcher, tensors)
+
+        for tensor, result in zip(tensors, results):
+            np.testing.assert_array_equal(result, tensor * 2)
+        stats = batcher.stats()
+        self.assertEqual(stats['batches_run'], 1)
+        self.assertEqual(stats['batch_size_histogram'], {6: 1})
+
+    def test_incompatible_shapes_run_in_separate_batches(self):
+        batcher = MicroBatcher('doubling', lambda x: x * 2, max_batch_size=8, max_wait_ms=100)
+        tensors = [np.ones((1, 4, 4, 8), dtype=np.float32), np.ones((2, 6, 6, 8), dtype=np.float32)]
+
+        results = self._predict_concurrently(batcher, tensors)
+
+        for tensor, result in zip(tensors, results):
+            np.testing.assert_array_equal(result, tensor * 2)
+        self.assertEqual(batcher.stats()['batches_run'], 2)
+
+
+class TiledInferenceTests(SimpleTestCase):
+    """Strip accumulation, blending and edge windows of predict_tiled."""
+
+    def test_matches_a_single_full_frame_argmax(self):
+        rng = np.random.default_rng(2)
+        # Per-pixel scores: blending overlapping windows must not change any pixel's argmax
+        for height, width in ((100, 700), (257, 513), (600, 300)):
+            scene = rng.random((height, width, 5), dtype=np.float32)
+            for batch_size in (1, 8):
+                tiled = predict_tiled(scene, lambda batch: batch, batch_size=batch_size)
+                np.testing.assert_array_equal(tiled, np.argmax(scene, axis=-1))
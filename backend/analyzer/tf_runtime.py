@@ -0,0 +1,136 @@
+import os
+import sys
+import tempfile
+import threading
+
+
+# --- TENSORFLOW RUNTIME CONFIGURATION ---
+# Thread pools per process. 0 keeps TensorFlow's default of one thread per core for each
+# pool, which oversubscribes the host as soon as several workers share it.
+TF_INTRA_OP_THREADS = int(os.getenv('TF_INTRA_OP_THREADS', '0'))
+TF_INTER_OP_THREADS = int(os.getenv('TF_INTER_OP_THREADS', '0'))
+# 'True' / 'False' forces oneDNN kernels on or off; empty keeps TensorFlow's default
+TF_ONEDNN = os.getenv('TF_ONEDNN', '')
+# Pins the process to these cores before TensorFlow starts, e.g. '0-3' or '0-3,8-11'
+CPU_AFFINITY = os.getenv('CPU_AFFINITY', '')
+# Or: every process claims its own block of this many cores (0 = no pinning)
+CPU_AFFINITY_CORES = int(os.getenv('CPU_AFFINITY_CORES', '0'))
+# Lock files of the claimed core blocks; processes sharing a host must share this directory
+CPU_SLOT_DIR = os.getenv('CPU_SLOT_DIR', tempfile.gettempdir())
+
+_lock = threading.Lock()
+_state = {'configured': False, 'affinity': None, 'slot': None, 'error': None}
+_slot_file = None  # Held open for the life of the process: its flock marks the slot as taken
+
+
+def parse_cpu_list(spec):
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def _claim_slot(cores, available):
+    """
+    The first free block of `cores` CPUs out of `available`, claimed with a non-blocking flock
+    on CPU_SLOT_DIR/cloudvision-cpu-slot-<n>.lock. None when every block is taken.
+    """
+    global _slot_file
+    import fcntl
+
+    for slot in range(len(available) // cores):
+        handle = open(os.path.join(CPU_SLOT_DIR, f'cloudvision-cpu-slot-{slot}.lock'), 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        _slot_file = handle
+        _state['slot'] = slot
+        return available[slot * cores:(slot + 1) * cores]
+    return None
+
+
+def _set_affinity(cpus):
+    """Applies to every thread of the process; threads started later inherit it."""
+    try:
+        threads = [int(tid) for tid in os.listdir('/proc/self/task')]
+    except OSError:
+        threads = [0]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            pass  # The thread exited meanwhile
+
+
+def pin_cpus():
+    """Pins the process per CPU_AFFINITY / CPU_AFFINITY_CORES. Returns the CPUs, or None."""
+    if not (CPU_AFFINITY or CPU_AFFINITY_CORES > 0):
+        return None
+    if not hasattr(os, 'sched_setaffinity'):
+        print("CPU pinning is only supported on Linux; ignoring CPU_AFFINITY settings.")
+        return None
+
+    if CPU_AFFINITY:
+        cpus = parse_cpu_list(CPU_AFFINITY)
+    else:
+        cpus = _claim_slot(CPU_AFFINITY_CORES, sorted(os.sched_getaffinity(0)))
+        if cpus is None:
+            print(f"No free block of {CPU_AFFINITY_CORES} cores left; process {os.getpid()} stays unpinned.")
+            return None
+    _set_affinity(cpus)
+    print(f"Process {os.getpid()} pinned to CPUs {cpus}.")
+    return cpus
+
+
+def import_tensorflow():
+    """
+    Imports TensorFlow with the runtime settings above applied: CPU pinning and oneDNN
+    before the import, thread pool sizes before the first op runs. Every TensorFlow
+    import in the serving path goes through here.
+    """
+    with _lock:
+        if not _state['configured']:
+            _state['configured'] = True
+            _state['affinity'] = pin_cpus()
+            if TF_ONEDNN:
+                if 'tensorflow' in sys.modules:
+                    print("TensorFlow was imported before TF_ONEDNN could be applied; it has no effect.")
+                os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if TF_ONEDNN == 'True' else '0'
+
+            import tensorflow as tf
+            try:
+                if TF_INTRA_OP_THREADS > 0:
+                    tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+                if TF_INTER_OP_THREADS > 0:
+                    tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+            except RuntimeError as e:
+                # The runtime was already initialized by an earlier TensorFlow call
+                _state['error'] = str(e)
+                print(f"Could not apply TensorFlow thread settings: {e}")
+
+    import tensorflow as tf
+    return tf
+
+
+def runtime_info():
+    """Configured and effective settings, without importing TensorFlow."""
+    info = {
+        'intra_op_threads': TF_INTRA_OP_THREADS,
+        'inter_op_threads': TF_INTER_OP_THREADS,
+        'onednn': os.environ.get('TF_ENABLE_ONEDNN_OPTS', 'default'),
+        'pinned_cpus': _state['affinity'],
+        'cpu_slot': _state['slot'],
+        'error': _state['error'],
+    }
+    tf = sys.modules.get('tensorflow')
+    if _state['configured'] and tf is not None:
+        info['effective_intra_op_threads'] = tf.config.threading.get_intra_op_parallelism_threads()
+        info['effective_inter_op_threads'] = tf.config.threading.get_inter_op_parallelism_threads()
+    return info
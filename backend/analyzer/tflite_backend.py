@@ -0,0 +1,140 @@
+import glob
+import os
+import queue
+
+import numpy as np
+
+
+# --- TFLITE CONFIGURATION ---
+TFLITE_MODES = ('dynamic', 'int8')
+TFLITE_POOL_SIZE = int(os.getenv('TFLITE_POOL_SIZE', '2'))
+TFLITE_NUM_THREADS = int(os.getenv('TFLITE_NUM_THREADS', '0')) or None
+
+
+def model_backend(model_key):
+    """
+    Serving backend for a model key: 'keras' (default), 'tflite-dynamic' or 'tflite-int8'.
+    Set per key with MODEL_BACKEND_V1/V2/V3, or for all keys with MODEL_BACKEND.
+    """
+    return os.getenv(f'MODEL_BACKEND_{model_key.upper()}', os.getenv('MODEL_BACKEND', 'keras'))
+
+
+def tflite_path(model_key, mode, keras_path=None):
+    """TFLITE_PATH_V1/V2/V3 if set, else the .keras path with a .<mode>.tflite suffix."""
+    explicit = os.getenv(f'TFLITE_PATH_{model_key.upper()}')
+    if explicit:
+        return explicit
+    if keras_path is None:
+        from . import model_loader
+        keras_path = model_loader.keras_path(model_key)
+    stem, _ = os.path.splitext(keras_path)
+    return f"{stem}.{mode}.tflite"
+
+
+def load_patches(directory, limit=None):
+    """Loads preprocessed (256, 256, 8) .npy patches, as written by 1_data_preprocessing.py."""
+    paths = sorted(glob.glob(os.path.join(directory, '*.npy')))
+    if limit:
+        paths = paths[:limit]
+    return [np.load(p).astype(np.float32) for p in paths], paths
+
+
+def convert_model(keras_model, mode, calibration_patches=None):
+    """
+    Converts a Keras model to TFLite bytes.
+    'dynamic': weights quantized to int8, activations stay float.
+    'int8': full-integer model (int8 input/output) calibrated on calibration_patches.
+    """
+    import tensorflow as tf
+
+    if mode not in TFLITE_MODES:
+        raise ValueError(f"Unknown TFLite mode '{mode}', expected one of {TFLITE_MODES}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == 'int8':
+        if not calibration_patches:
+            raise ValueError("Full-int8 conversion needs calibration patches")
+
+        def representative_dataset():
+            for patch in calibration_patches:
+                yield [np.expand_dims(patch, axis=0).astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    return converter.convert()
+
+
+class TFLiteModel:
+    """
+    Pool of TFLite interpreters behind a Keras-like predict(batch) call.
+    An interpreter is not thread-safe, so each call checks one out of the pool;
+    int8 models are quantized/dequantized at the boundary.
+    """
+
+    def __init__(self, path, pool_size=TFLITE_POOL_SIZE, num_threads=TFLITE_NUM_THREADS):
+        from .tf_runtime import TF_INTRA_OP_THREADS, import_tensorflow
+        tf = import_tensorflow()
+        # Without TFLITE_NUM_THREADS, interpreters follow TF_INTRA_OP_THREADS
+        num_threads = num_threads or TF_INTRA_OP_THREADS or None
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self._content = f.read()
+
+        self._pool = queue.Queue()
+        for _ in range(max(1, pool_size)):
+            interpreter = tf.lite.Interpreter(model_content=self._content, num_threads=num_threads)
+            interpreter.allocate_tensors()
+            self._pool.put(interpreter)
+
+    @property
+    def size_bytes(self):
+        return len(self._content)
+
+    def _run(self, interpreter, batch):
+        input_detail = interpreter.get_input_details()[0]
+        if tuple(input_detail['shape']) != batch.shape:
+            interpreter.resize_tensor_input(input_detail['index'], batch.shape)
+            interpreter.allocate_tensors()
+            input_detail = interpreter.get_input_details()[0]
+        output_detail = interpreter.get_output_details()[0]
+
+        if input_detail['dtype'] == np.int8:
+            scale, zero_point = input_detail['quantization']
+            batch = np.clip(np.round(batch / scale + zero_point), -128, 127).astype(np.int8)
+
+        interpreter.set_tensor(input_detail['index'], batch)
+        interpreter.invoke()
+        output = interpreter.get_tensor(output_detail['index'])
+
+        if output_detail['dtype'] == np.int8:
+            scale, zero_point = output_detail['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return np.array(output, dtype=np.float32)
+
+    def predict(self, batch, verbose=0):
+        batch = np.asarray(batch, dtype=np.float32)
+        interpreter = self._pool.get()
+        try:
+            return self._run(interpreter, batch)
+        finally:
+            self._pool.put(interpreter)
+
+
+def mean_iou(pred_mask, true_mask, num_classes=5):
+    """Mean IoU over the classes present in either mask."""
+    ious = []
+    for c in range(num_classes):
+        pred_c = pred_mask == c
+        true_c = true_mask == c
+        union = np.logical_or(pred_c, true_c).sum()
+        if union == 0:
+            continue
+        ious.append(np.logical_and(pred_c, true_c).sum() / union)
+    return float(np.mean(ious)) if ious else 1.0
+
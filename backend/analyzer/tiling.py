@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+
+# --- TILED INFERENCE CONFIGURATION ---
+TILE_SIZE = 256
+TILE_OVERLAP = int(os.getenv('TILE_OVERLAP', '32'))
+TILE_BATCH_SIZE = int(os.getenv('TILE_BATCH_SIZE', '8'))
+
+
+def tile_positions(length, tile_size, stride):
+    """Window offsets covering [0, length); the last window is aligned to the end."""
+    if length <= tile_size:
+        return [0]
+    positions = list(range(0, length - tile_size, stride))
+    positions.append(length - tile_size)
+    return positions
+
+
+def blend_window(tile_size, overlap):
+    """
+    2D weights that ramp linearly over `overlap` pixels at each edge, so overlapping
+    predictions cross-fade instead of leaving seams. Never zero, so pixels covered by
+    a single window (the scene borders) still get a prediction.
+    """
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    return np.outer(ramp, ramp)
+
+
+def read_tile(source, y0, x0, tile_size):
+    """Reads a (tile_size, tile_size, C) float32 window, zero-padding past the scene edge."""
+    window = np.asarray(source[y0:y0 + tile_size, x0:x0 + tile_size], dtype=np.float32)
+    h, w = window.shape[:2]
+    if h == tile_size and w == tile_size:
+        return window
+    padded = np.zeros((tile_size, tile_size, window.shape[2]), dtype=np.float32)
+    padded[:h, :w] = window
+    return padded
+
+
+class ImageTileSource:
+    """
+    Full-resolution RGB image exposed as an 8-channel (H, W, 8) source.
+    Only RGB is held in memory; the zero-padded 8-channel tiles are built per window.
+    """
+
+    def __init__(self, rgb):
+        self.rgb = rgb  # (H, W, 3) float32 in [0, 1]
+        self.shape = rgb.shape[:2] + (8,)
+
+    def __getitem__(self, key):
+        rgb = self.rgb[key]
+        tile = np.zeros(rgb.shape[:2] + (8,), dtype=np.float32)
+        tile[:, :, :3] = rgb
+        return tile
+
+
+def predict_tiled(source, predict_fn, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                  batch_size=TILE_BATCH_SIZE, out=None, progress=None):
+    """
+    Sliding-window inference over a scene of any size.
+
+    source     : (H, W, C) array-like supporting 2D slicing (ndarray, np.memmap, lazy reader)
+    predict_fn : callable taking a (N, tile, tile, C) batch and returning (N, tile, tile, K) scores
+    out        : optional (H, W) uint8 array (e.g. a np.memmap) to receive the class indices
+    progress   : optional callable receiving the completed fraction (0-1) after each strip;
+                 it may raise to abort the run
+
+    Windows overlap by `overlap` pixels and are blended with a linear ramp. Work is done
+    one strip of windows at a time: only a (tile_size, W, K) accumulator is kept, and rows
+    are finalized (argmax) as soon as no later strip can touch them. Memory therefore
+    grows with the scene width, never with its height.
+    """
+    height, width = source.shape[:2]
+    stride = max(1, tile_size - overlap)
+    ys = tile_positions(height, tile_size, stride)
+    xs = tile_positions(width, tile_size, stride)
+    weights = blend_window(tile_size, overlap)
+
+    if out is None:
+        out = np.zeros((height, width), dtype=np.uint8)
+
+    # (tile_size, W', K) weighted score sums for rows [acc_top, acc_top + tile_size).
+    # The blended score is acc / sum(weights), but that per-pixel divisor does not change
+    # the argmax, so only the weighted sums are kept.
+    acc = None
+    acc_top = 0
+
+    for strip, y0 in enumerate(ys):
+        # Slide the accumulator down to this strip, finalizing the rows it leaves behind
+        if acc is not None and y0 > acc_top:
+            shift = y0 - acc_top
+            _finalize_rows(out, acc[:shift], acc_top, height, width)
+            acc[:-shift] = acc[shift:]
+            acc[-shift:] = 0
+            acc_top = y0
+
+        for start in range(0, len(xs), batch_size):
+            batch_xs = xs[start:start + batch_size]
+            batch = np.stack([read_tile(source, y0, x0, tile_size) for x0 in batch_xs])
+            scores = np.asarray(predict_fn(batch), dtype=np.float32)
+
+            if acc is None:
+                acc = np.zeros((tile_size, max(width, tile_size), scores.shape[-1]), dtype=np.float32)
+            for x0, tile_scores in zip(batch_xs, scores):
+                acc[:, x0:x0 + tile_size] += tile_scores * weights[:, :, None]
+
+        if progress is not None:
+            progress((strip + 1) / len(ys))
+
+    if acc is not None:
+        _finalize_rows(out, acc, acc_top, height, width)
+    return out
+
+
+def _finalize_rows(out, acc_rows, top, height, width):
+    rows = min(acc_rows.shape[0], height - top)
+    if rows > 0:
+        out[top:top + rows] = np.argmax(acc_rows[:rows, :width], axis=-1).astype(np.uint8)
@@ -1,9 +1,34 @@
+import os
+
 from django.urls import path
-from .views import PredictView, MitigateView, GeminiAnalysisView, ChatView
+from .views import PredictView, BatchPredictView, GeoTiffPredictView, MitigateView, GeminiAnalysisView, ChatView, ChatStreamView, StatsView, MetricsView, ReadinessView
+from .views import JobSubmitView, JobStatusView, JobResultView, JobCancelView, ProfileListView, ProfileDownloadView
+from .views import HistoryListView, HistoryDetailView
+from .async_views import AsyncPredictView, AsyncMitigateView, AsyncGeminiAnalysisView, AsyncChatView, AsyncChatStreamView
+
+# Serve predict/mitigate/gemini/chat (and chat streaming) from the async views (run under ASGI, e.g. uvicorn)
+if os.getenv('ASYNC_VIEWS', 'False') == 'True':
+    PredictView, MitigateView = AsyncPredictView, AsyncMitigateView
+    GeminiAnalysisView, ChatView = AsyncGeminiAnalysisView, AsyncChatView
+    ChatStreamView = AsyncChatStreamView
 
 urlpatterns = [
     path('predict/', PredictView.as_view(), name='predict'),
+    path('predict/batch/', BatchPredictView.as_view(), name='predict-batch'),
+    path('predict/geotiff/', GeoTiffPredictView.as_view(), name='predict-geotiff'),
     path('mitigate/', MitigateView.as_view(), name='mitigate'),
     path('gemini-analysis/', GeminiAnalysisView.as_view(), name='gemini-analysis'),
     path('chat/', ChatView.as_view(), name='chat'),
+    path('chat/stream/', ChatStreamView.as_view(), name='chat-stream'),
+    path('stats/', StatsView.as_view(), name='stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('ready/', ReadinessView.as_view(), name='ready'),
+    path('jobs/', JobSubmitView.as_view(), name='job-submit'),
+    path('jobs/<uuid:job_id>/', JobStatusView.as_view(), name='job-status'),
+    path('jobs/<uuid:job_id>/result/', JobResultView.as_view(), name='job-result'),
+    path('jobs/<uuid:job_id>/cancel/', JobCancelView.as_view(), name='job-cancel'),
+    path('history/', HistoryListView.as_view(), name='history'),
+    path('history/<int:result_id>/', HistoryDetailView.as_view(), name='history-detail'),
+    path('profiles/', ProfileListView.as_view(), name='profile-list'),
+    path('profiles/<str:profile_id>/', ProfileDownloadView.as_view(), name='profile-download'),
 ]
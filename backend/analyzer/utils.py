@@ -2,7 +2,105 @@ import numpy as np
 from PIL import Image
 from skimage.exposure import match_histograms
 import io
+import os
 import base64
+from collections import namedtuple
+
+from .metrics import stage_timer
+
+# Bump whenever preprocessing output changes so cached predictions are invalidated
+PREPROCESS_VERSION = 2
+
+# Decompression-bomb guard: uploads with more pixels than this are rejected before decoding
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', str(100_000_000)))
+# Resize in two steps (integer reduce(), then resample) once the image is 3x+ the target
+RESIZE_REDUCING_GAP = 3.0
+
+def _open_image(file_obj):
+    """Opens an upload (header only) and enforces the MAX_IMAGE_PIXELS guard."""
+    try:
+        img = Image.open(file_obj)
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e))
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image of {width}x{height} pixels exceeds the {MAX_IMAGE_PIXELS} pixel limit")
+    return img
+
+def decode_image(file_obj):
+    """Decodes an uploaded image to RGB at full resolution (timed as the 'decode' stage)."""
+    with stage_timer('decode'):
+        return _open_image(file_obj).convert('RGB')
+
+def decode_resized(file_obj, size=256):
+    """
+    Decodes an uploaded image straight to (size, size) RGB (timed as the 'decode' stage).
+    JPEGs are decoded at the smallest DCT scale (1/2, 1/4, 1/8) that keeps both sides
+    >= size, so large photos are never fully decoded; every format then shrinks by an
+    integer factor before the final resample.
+    """
+    with stage_timer('decode'):
+        img = _open_image(file_obj)
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        return img.convert('RGB').resize((size, size), reducing_gap=RESIZE_REDUCING_GAP)
+
+def load_npy(file_obj):
+    """
+    Reads an uploaded (H, W, 8) .npy array (timed as the 'decode' stage).
+    The header is validated before any array data is read. Uploads Django spooled to
+    disk (TemporaryUploadedFile) and job input files are memory-mapped read-only
+    instead of being copied into RAM.
+    """
+    with stage_timer('decode'):
+        if hasattr(file_obj, 'seek'):
+            file_obj.seek(0)
+        shape, fortran_order, dtype, offset = _read_npy_header(file_obj)
+
+        path = _disk_path(file_obj)
+        size = os.path.getsize(path) if path else getattr(file_obj, 'size', None)
+        if size is not None and offset + int(np.prod(shape)) * dtype.itemsize > size:
+            raise ValueError("File is truncated")
+
+        if path:
+            # On POSIX the mapping stays valid after Django deletes the temp file
+            return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                             order='F' if fortran_order else 'C')
+        file_obj.seek(0)
+        return np.load(file_obj)
+
+def _read_npy_header(file_obj):
+    """Parses and checks the .npy header. Returns (shape, fortran_order, dtype, data offset)."""
+    version = np.lib.format.read_magic(file_obj)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file_obj)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file_obj)
+    else:
+        raise ValueError(f"Unsupported .npy format version {version}")
+
+    if len(shape) != 3 or shape[-1] != 8:
+        raise ValueError(f"Expected (H, W, 8) array, got {shape}")
+    if dtype.kind not in 'biuf':
+        raise ValueError(f"Unsupported dtype {dtype}")
+    return shape, fortran_order, dtype, file_obj.tell()
+
+def _disk_path(file_obj):
+    """Path of an upload that already lives on disk, or None for in-memory uploads."""
+    if hasattr(file_obj, 'temporary_file_path'):
+        return file_obj.temporary_file_path()
+    if isinstance(file_obj, io.BufferedReader):
+        return file_obj.name
+    return None
+
+def as_float32(data):
+    """
+    float32 array for the model. Skips the copy when the data already is float32;
+    memory-mapped arrays keep their stored dtype and are converted per tile or batch as they are read.
+    """
+    if isinstance(data, np.memmap):
+        return data
+    return data.astype(np.float32, copy=False)
 
 def preprocess_v1(file_obj):
     """
@@ -16,10 +114,10 @@ def preprocess_v1(file_obj):
         try:
             if hasattr(file_obj, 'seek'):
                 file_obj.seek(0)
-            data = np.load(file_obj)
+            data = load_npy(file_obj)
             if data.shape[-1] != 8:
                  raise ValueError(f"Expected 8 channels, got {data.shape[-1]}")
-            return np.expand_dims(data.astype(np.float32), axis=0)
+            return np.expand_dims(as_float32(data), axis=0)
         except Exception as e:
             raise ValueError(f"Invalid .npy file: {e}")
             
@@ -28,8 +126,7 @@ def preprocess_v1(file_obj):
         if hasattr(file_obj, 'seek'):
             file_obj.seek(0)
             
-        img = Image.open(file_obj).convert('RGB')
-        img = img.resize((256, 256))
+        img = decode_resized(file_obj)
         img_array = np.array(img) / 255.0
         
         # Create 8-channel input: 3 RGB + 5 Zero Padding
@@ -45,8 +142,7 @@ def preprocess_v2_legacy(image_file):
     2. Normalize [0, 1] ONLY. (Removing Standardization to fix 'worse' results)
     3. Pad to 8 channels.
     """
-    img = Image.open(image_file).convert('RGB')
-    img = img.resize((256, 256))
+    img = decode_resized(image_file)
     img_array = np.array(img)
     
     # 1. Normalize to 0-1 range (Safe & Stable)
@@ -78,7 +174,7 @@ def preprocess_v2(file_obj):
             if hasattr(file_obj, 'seek'):
                 file_obj.seek(0)
             
-            data = np.load(file_obj)
+            data = load_npy(file_obj)
             
             # Verify shape
             if data.shape != (256, 256, 8):
@@ -87,7 +183,7 @@ def preprocess_v2(file_obj):
                 
                 pass 
 
-            return np.expand_dims(data.astype(np.float32), axis=0)
+            return np.expand_dims(as_float32(data), axis=0)
             
         except Exception as e:
             print(f"Error loading .npy file: {e}")
@@ -100,8 +196,7 @@ def preprocess_v2(file_obj):
         if hasattr(file_obj, 'seek'):
             file_obj.seek(0)
             
-        img = Image.open(file_obj).convert('RGB')
-        img = img.resize((256, 256))
+        img = decode_resized(file_obj)
         img_array = np.array(img) / 255.0  # Normalize [0, 1]
 
         # Padding: Create a dummy 8-channel tensor (256, 256, 8)
@@ -128,10 +223,10 @@ def preprocess_v3(file_obj):
         try:
             if hasattr(file_obj, 'seek'):
                 file_obj.seek(0)
-            data = np.load(file_obj)
+            data = load_npy(file_obj)
             if data.shape[-1] != 8:
                  raise ValueError(f"Expected 8 channels, got {data.shape[-1]}")
-            return np.expand_dims(data.astype(np.float32), axis=0)
+            return np.expand_dims(as_float32(data), axis=0)
         except Exception as e:
             raise ValueError(f"Invalid .npy file: {e}")
             
@@ -149,19 +244,34 @@ def remap_classes(prediction):
     """
     # prediction shape: (1, 256, 256, 5) -> argmax -> (256, 256)
     pred_mask = np.argmax(prediction, axis=-1)[0]
-    
-    remapped_mask = np.zeros_like(pred_mask)
-    
-    # Map Shadow (2) -> 1
-    remapped_mask[pred_mask == 2] = 1
-    # Map Thin Cloud (3) -> 2
-    remapped_mask[pred_mask == 3] = 2
-    # Map Thick Cloud (4) -> 3
-    remapped_mask[pred_mask == 4] = 3
-    
-    # 0, 1, 5 remain 0 (Clear)
-    
-    return remapped_mask
+    return remap_class_indices(pred_mask)
+
+def remap_class_indices(pred_mask):
+    """Same mapping as remap_classes, for an already argmax-ed (H, W) raw class mask."""
+    # Single lookup: Shadow (2) -> 1, Thin Cloud (3) -> 2, Thick Cloud (4) -> 3, rest -> 0 (Clear)
+    return np.take(DISPLAY_CLASS_LUT, pred_mask)
+
+def load_full_resolution(file_obj):
+    """
+    Loads an upload at its native resolution for tiled inference (no 256x256 resize).
+    Standard Image -> (H, W, 3) float32 RGB in [0, 1] (channels 3-7 are padded per tile).
+    Scientific Data (.npy) -> (H, W, 8) array as stored.
+    """
+    filename = getattr(file_obj, 'name', '').lower()
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+
+    if filename.endswith('.npy'):
+        try:
+            data = load_npy(file_obj)
+        except Exception as e:
+            raise ValueError(f"Invalid .npy file: {e}")
+        if data.ndim != 3 or data.shape[-1] != 8:
+            raise ValueError(f"Expected (H, W, 8) array, got {data.shape}")
+        return data
+
+    img = decode_image(file_obj)
+    return np.asarray(img, dtype=np.float32) / 255.0
 
 def mask_to_base64(mask):
     """
@@ -172,21 +282,17 @@ def mask_to_base64(mask):
     2 (Thin) -> 170 (Light Gray)
     3 (Thick) -> 255 (White)
     """
-    h, w = mask.shape
-    img_gray = np.zeros((h, w), dtype=np.uint8)
-    
     # Map classes to grayscale intensities
-    img_gray[mask == 1] = 85   # Shadow
-    img_gray[mask == 2] = 170  # Thin Cloud
-    img_gray[mask == 3] = 255  # Thick Cloud
-    
-    img = Image.fromarray(img_gray, mode='L') # 'L' mode for 8-bit grayscale
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return gray_to_base64(np.take(GRAY_LUT, mask))
+
+def gray_to_base64(img_gray):
+    # 'L' mode for 8-bit grayscale
+    return base64.b64encode(png_bytes(img_gray, mode='L')).decode('utf-8')
 
-def mitigate_shadows(input_tensor, mask):
+def mitigate_shadows_legacy(input_tensor, mask):
     """
+    Original np.unique-based implementation, kept as the reference for
+    analyzer.mitigation.mitigate_shadows (which must match it exactly) and for benchmarks.
     Uses histogram matching to mitigate shadows.
     User Request: Make Clear/Fill regions look like Shadow regions.
     Target (Reference): Shadow Class (1)
@@ -257,6 +363,10 @@ def generate_preview_image(input_tensor):
     Input: (1, 256, 256, 8) or similar.
     Output: Base64 encoded PNG string.
     """
+    return image_to_base64(preview_rgb(input_tensor))
+
+def preview_rgb(input_tensor):
+    """The (H, W, 3) uint8 preview behind generate_preview_image."""
     # Remove batch dimension: (256, 256, 8)
     data = input_tensor[0]
     
@@ -276,13 +386,17 @@ def generate_preview_image(input_tensor):
     # Convert to uint8 [0, 255]
     rgb_uint8 = (rgb_norm * 255).astype(np.uint8)
     
-    return image_to_base64(rgb_uint8)
+    return rgb_uint8
 
 def image_to_base64(img_array):
-    img = Image.fromarray(img_array.astype(np.uint8))
+    return base64.b64encode(png_bytes(img_array)).decode('utf-8')
+
+def png_bytes(img_array, mode=None):
+    """Encodes a uint8 array as PNG and returns the raw bytes."""
+    img = Image.fromarray(img_array.astype(np.uint8), mode=mode)
     buffer = io.BytesIO()
     img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return buffer.getvalue()
 import cv2
 
 def generate_solar_heatmap(mask):
@@ -301,22 +415,75 @@ def generate_solar_heatmap(mask):
     2: Thin -> Medium Potential (50%)
     3: Thick -> Low Potential (10%)
     """
-    h, w = mask.shape
-    heatmap = np.zeros((h, w), dtype=np.uint8)
-    
-    # Assign intensities (0-255)
-    # Clear (0) -> 255 (High)
-    heatmap[mask == 0] = 255
-    # Thin Cloud (2) -> 127 (Medium)
-    heatmap[mask == 2] = 127
-    # Shadow (1) & Thick (3) -> 25 (Low)
-    heatmap[mask == 1] = 25
-    heatmap[mask == 3] = 25
-    
-    # Apply Color Map (Jet)
-    # cv2.applyColorMap expects uint8 [0, 255]
-    # It returns BGR, so convert to RGB
-    colormap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-    colormap_rgb = cv2.cvtColor(colormap, cv2.COLOR_BGR2RGB)
-    
-    return image_to_base64(colormap_rgb)
+    # Assign intensities (0-255) and apply the Jet color map in one lookup
+    return image_to_base64(np.take(solar_heatmap_lut(), mask, axis=0))
+
+
+# --- POST-PROCESSING LOOKUP TABLES ---
+# All tables have 256 entries so any uint8 class mask can index them directly.
+
+# Raw model class -> display class (see remap_classes)
+DISPLAY_CLASS_LUT = np.zeros(256, dtype=np.uint8)
+DISPLAY_CLASS_LUT[2] = 1  # Shadow
+DISPLAY_CLASS_LUT[3] = 2  # Thin Cloud
+DISPLAY_CLASS_LUT[4] = 3  # Thick Cloud
+
+# Display class -> grayscale intensity (see mask_to_base64)
+GRAY_LUT = np.zeros(256, dtype=np.uint8)
+GRAY_LUT[1] = 85   # Shadow
+GRAY_LUT[2] = 170  # Thin Cloud
+GRAY_LUT[3] = 255  # Thick Cloud
+
+# Display class -> solar potential intensity (see generate_solar_heatmap)
+SOLAR_INTENSITY_LUT = np.zeros(256, dtype=np.uint8)
+SOLAR_INTENSITY_LUT[0] = 255  # Clear -> High
+SOLAR_INTENSITY_LUT[2] = 127  # Thin Cloud -> Medium
+SOLAR_INTENSITY_LUT[1] = 25   # Shadow -> Low
+SOLAR_INTENSITY_LUT[3] = 25   # Thick -> Low
+
+_solar_heatmap_lut = None
+
+def solar_heatmap_lut():
+    """(256, 3) display class -> RGB heatmap color. cv2's Jet map is itself a per-pixel lookup."""
+    global _solar_heatmap_lut
+    if _solar_heatmap_lut is None:
+        ramp = np.arange(256, dtype=np.uint8).reshape(-1, 1)
+        jet_bgr = cv2.applyColorMap(ramp, cv2.COLORMAP_JET).reshape(256, 3)
+        _solar_heatmap_lut = np.ascontiguousarray(jet_bgr[SOLAR_INTENSITY_LUT][:, ::-1])  # BGR -> RGB
+    return _solar_heatmap_lut
+
+# Composite tables indexed by the raw model class
+RAW_GRAY_LUT = GRAY_LUT[DISPLAY_CLASS_LUT]
+
+PostProcessed = namedtuple('PostProcessed', ['mask', 'gray', 'heatmap', 'counts'])
+
+def postprocess_indices(raw_mask):
+    """
+    Fused post-processing of an argmax-ed raw class mask (H, W): one table lookup each
+    for the display mask, grayscale image and heatmap RGB, and a single bincount for
+    the display class counts.
+    """
+    raw_mask = raw_mask.astype(np.uint8, copy=False)
+    raw_counts = np.bincount(raw_mask.ravel(), minlength=256)
+    counts = np.bincount(DISPLAY_CLASS_LUT, weights=raw_counts, minlength=4)[:4].astype(np.int64)
+    # np.take is markedly faster than fancy indexing for table lookups
+    return PostProcessed(
+        mask=np.take(DISPLAY_CLASS_LUT, raw_mask),
+        gray=np.take(RAW_GRAY_LUT, raw_mask),
+        heatmap=np.take(solar_heatmap_lut()[DISPLAY_CLASS_LUT], raw_mask, axis=0),
+        counts=counts,
+    )
+
+def postprocess_display(mask):
+    """PostProcessed outputs rebuilt from a stored (H, W) display-class mask."""
+    mask = mask.astype(np.uint8, copy=False)
+    return PostProcessed(
+        mask=mask,
+        gray=np.take(GRAY_LUT, mask),
+        heatmap=np.take(solar_heatmap_lut(), mask, axis=0),
+        counts=np.bincount(mask.ravel(), minlength=4)[:4].astype(np.int64),
+    )
+
+def fused_postprocess(prediction):
+    """Argmax once over (1, H, W, K) scores, then postprocess_indices."""
+    return postprocess_indices(np.argmax(prediction[0], axis=-1).astype(np.uint8))
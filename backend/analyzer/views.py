@@ -2,15 +2,39 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from .model_loader import ModelLoader
-from .utils import preprocess_v1, preprocess_v2, preprocess_v3, remap_classes, mask_to_base64, mitigate_shadows, image_to_base64, generate_preview_image, generate_solar_heatmap
-import numpy as np
-import google.generativeai as genai
-import os
-import json
+from .batching import batching_stats
+from .inference_server import inference_server_stats
+from .cache import prediction_cache
+from .encoding import encoder_timings
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry
+from .profiling import list_profiles, profile_path, trace_archive
+from .batch_predict import NDJSON_CONTENT_TYPE, OUTPUT_JSON, OUTPUTS as BATCH_OUTPUTS, stream_predictions
+from .pipeline import segment, build_predict_result, build_mitigate_result, class_percentages, predict_body
+from .warmup import warmup_state
+from .geotiff import analyze_geotiff
+from .jobs import submit_job, cancel_job, recover_orphaned_job
+from .models import AnalysisJob, AnalysisResult
+from .result_store import result_store
+from .formats import FORMAT_JSON, FallbackContentNegotiation, negotiate_format, render_predict_response, rle_encode, sse_event
+from .utils import mask_to_base64, generate_solar_heatmap
+from .llm import GeminiNotConfigured, chat_prompt, generate, generate_report, get_model, report_cache, stream_chat, stream_stats
+
+
+def _flag(request, name):
+    """Reads a boolean form field or query parameter ('1', 'true', 'yes')."""
+    value = request.data.get(name, request.query_params.get(name, ''))
+    return str(value).lower() in ('1', 'true', 'yes')
 
 class PredictView(APIView):
+    """
+    Segments an uploaded image. The response format is negotiated via ?output= or Accept:
+    json (default, base64 PNGs), raw (uint8 mask bytes), rle (run-length mask) or multipart.
+    """
     parser_classes = (MultiPartParser, FormParser)
+    content_negotiation_class = FallbackContentNegotiation
 
     def post(self, request, *args, **kwargs):
         file_obj = request.data.get('file')
@@ -19,6 +43,11 @@ class PredictView(APIView):
         if not file_obj:
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
+        try:
+            output_format = negotiate_format(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             # Load Model
             loader = ModelLoader()
@@ -27,62 +56,89 @@ class PredictView(APIView):
             if not model:
                  return Response({'error': f'Model {model_type} not loaded'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-            # Preprocess based on model type
-            if model_type == 'v1':
-                input_tensor = preprocess_v1(file_obj)
-            elif model_type == 'v3':
-                input_tensor = preprocess_v3(file_obj)
-            else:
-                input_tensor = preprocess_v2(file_obj)
-
-            # Predict
-            prediction = model.predict(input_tensor)
-            
-            # Correction: Suppress "Thin Cloud" (Class 3) for V2/V3
-            # Reported "extra thin clouds" (false positives). 
-            # We apply a penalty to the Thin Cloud channel to reduce sensitivity.
-            if model_type in ['v2', 'v3']:
-                # Index 3 is Thin Cloud (based on remap_classes docstring)
-                # Multiply by 0.65 to require higher confidence for this class
-                prediction[0, :, :, 3] *= 0.65
-            
-            # Generate Preview Image (Fix for broken .npy preview)
-            preview_b64 = generate_preview_image(input_tensor)
-            
-            # Remap Classes
-            remapped_mask = remap_classes(prediction)
-            
-            # Calculate Percentages
-            total_pixels = remapped_mask.size
-            counts = np.bincount(remapped_mask.flatten(), minlength=4)
-            percentages = {
-                "Clear": (counts[0] / total_pixels) * 100,
-                "Shadow": (counts[1] / total_pixels) * 100,
-                "Thin Cloud": (counts[2] / total_pixels) * 100,
-                "Thick Cloud": (counts[3] / total_pixels) * 100
-            }
-            
-            has_shadow = percentages["Shadow"] > 1.0
-            
-            # Convert Mask to Base64 (Grayscale)
-            mask_b64 = mask_to_base64(remapped_mask)
-            
-            # Generate Solar Heatmap
-            solar_heatmap_b64 = generate_solar_heatmap(remapped_mask)
+            # Preprocess + Predict + Remap (cached per upload for the follow-up /mitigate/ call)
+            # tiled=true keeps full resolution via sliding-window inference
+            input_tensor, processed, _ = segment(file_obj, model_type, tiled=_flag(request, 'tiled'))
             
+            if output_format != FORMAT_JSON:
+                return render_predict_response(output_format, input_tensor, processed, model_type)
+            return Response(build_predict_result(input_tensor, processed, model_type))
+
+        except Exception as e:
+            print(f"Prediction Error: {e}")
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class GeoTiffPredictView(APIView):
+    """
+    Full-scene prediction for a multi-band GeoTIFF, or a set of per-band TIFs (_B2.TIF ... _B11.TIF).
+    Bands go through the same clip/normalize as training and are streamed window by window.
+    """
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        file_objs = request.FILES.getlist('file') or request.FILES.getlist('files')
+        model_type = request.data.get('model_type', 'v2')
+
+        if not file_objs:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            import rasterio  # noqa: F401
+        except ImportError:
+            return Response({'error': 'GeoTIFF support requires rasterio'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        try:
+            model = ModelLoader().load_model(model_type)
+            if not model:
+                 return Response({'error': f'Model {model_type} not loaded'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+            thumbnail, counts, (height, width) = analyze_geotiff(file_objs, model_type)
+
+            percentages = class_percentages(counts)
+
             return Response({
-                'mask': mask_b64,
+                'mask': mask_to_base64(thumbnail),
                 'percentages': percentages,
-                'has_shadow': has_shadow,
+                'has_shadow': percentages["Shadow"] > 1.0,
                 'model_used': model_type,
-                'original_image_url': f"data:image/png;base64,{preview_b64}",
-                'solar_heatmap': solar_heatmap_b64
+                'scene_size': {'height': height, 'width': width},
+                'solar_heatmap': generate_solar_heatmap(thumbnail)
             })
 
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            print(f"Prediction Error: {e}")
+            print(f"GeoTIFF Prediction Error: {e}")
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class BatchPredictView(APIView):
+    """
+    Segments many files in one request: repeated `file` fields and/or .zip/.tar archives.
+    Files are preprocessed in parallel and run through the model in stacked batches; one
+    NDJSON line per file is streamed back as soon as its chunk is done, then a summary line.
+    ?output= (or an `output` field) picks the per-file body: json (as /predict/), rle or summary.
+    """
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        uploads = request.FILES.getlist('file') or request.FILES.getlist('files')
+        model_type = request.data.get('model_type', 'v2')
+        output = request.query_params.get('output', request.data.get('output', OUTPUT_JSON))
+
+        if not uploads:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if output not in BATCH_OUTPUTS:
+            return Response({'error': f"Unsupported output '{output}' (use one of {', '.join(BATCH_OUTPUTS)})"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        loader = ModelLoader()
+        if not loader.load_model(model_type):
+            return Response({'error': f'Model {model_type} not loaded'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        response = StreamingHttpResponse(stream_predictions(uploads, model_type, output), content_type=NDJSON_CONTENT_TYPE)
+        response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+        return response
+
 class MitigateView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
@@ -101,19 +157,11 @@ class MitigateView(APIView):
             if not model:
                  return Response({'error': 'Model not loaded'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-            if model_type == 'v1':
-                input_tensor = preprocess_v1(file_obj)
-            else:
-                input_tensor = preprocess_v2(file_obj)
-                
-            prediction = model.predict(input_tensor)
-            remapped_mask = remap_classes(prediction)
+            # Reuses the mask from the preceding /predict/ call when cached
+            input_tensor, processed, _ = segment(file_obj, model_type, tiled=_flag(request, 'tiled'))
             
             # Mitigate
-            mitigated_img = mitigate_shadows(input_tensor, remapped_mask)
-            mitigated_b64 = image_to_base64(mitigated_img)
-            
-            return Response({'mitigated_image': mitigated_b64})
+            return Response(build_mitigate_result(input_tensor, processed, model_type))
             
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -126,34 +174,23 @@ class GeminiAnalysisView(APIView):
         percentages = request.data.get('percentages')
         if not percentages:
             return Response({'error': 'No percentages provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(percentages, dict):
+            return Response({'error': 'percentages must be an object of class names and values'},
+                            status=status.HTTP_400_BAD_REQUEST)
             
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-             return Response({'error': 'Gemini API Key not configured'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-             
         try:
-            genai.configure(api_key=api_key)
-            # Use gemini-2.5-flash-lite
-            model = genai.GenerativeModel('gemini-2.5-flash-lite')
-            
-            prompt = (
-                f"Analyze these satellite cloud metrics: {json.dumps(percentages)}. "
-                "Provide a meteorological report in the following format:\n"
-                "1. Small Paragraph: General overview.\n"
-                "2. AI Suggestions: Actionable advice.\n"
-                "3. Future Prediction: Short-term forecast.\n"
-                "4. Precautions: Safety measures.\n"
-                "Do not use special characters like asterisks or markdown bolding. Keep it clean text."
-            )
-            
-            response = model.generate_content(prompt)
-            return Response({'analysis': response.text})
-            
+            return Response({'analysis': generate_report(percentages)})
+
+        except GeminiNotConfigured as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             print(f"Gemini API Error: {e}")
             # Return the actual error to the frontend for debugging
             return Response({'analysis': f"AI Analysis Error: {str(e)}"}, status=status.HTTP_200_OK)
 
+CHAT_ERROR_REPLY = "I'm having trouble connecting to the satellite network right now. Please try again."
+
+
 class ChatView(APIView):
     def post(self, request, *args, **kwargs):
         message = request.data.get('message')
@@ -162,31 +199,205 @@ class ChatView(APIView):
         if not message:
             return Response({'error': 'No message provided'}, status=status.HTTP_400_BAD_REQUEST)
             
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-             return Response({'error': 'Gemini API Key not configured'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-             
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-2.5-flash-lite')
-            
-            # Construct System Prompt
-            context = f"The user is looking at an image with the following stats: {json.dumps(metrics)}." if metrics else "No specific image context provided."
-            
-            system_prompt = (
-                "You are CloudVision AI, an expert Satellite Analyst for CloudVision. "
-                f"{context} "
-                "Answer the user's questions specifically based on this data if available. "
-                "Keep answers concise, professional, and helpful. "
-                "If asked about solar potential, refer to the Clear Sky percentage. "
-                "If asked about weather, refer to the Cloud Coverage."
-            )
-            
-            full_prompt = f"{system_prompt}\n\nUser: {message}\nCloudVision AI:"
-            
-            response = model.generate_content(full_prompt)
-            return Response({'reply': response.text})
-            
+            return Response({'reply': generate(chat_prompt(message, metrics))})
+
+        except GeminiNotConfigured as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             print(f"Chat Error: {e}")
-            return Response({'reply': "I'm having trouble connecting to the satellite network right now. Please try again."}, status=status.HTTP_200_OK)
+            return Response({'reply': CHAT_ERROR_REPLY}, status=status.HTTP_200_OK)
+
+
+def _sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+def _chat_events(chunks):
+    """SSE framing for stream_chat. Closing this generator (client disconnect) closes the Gemini stream."""
+    try:
+        for text in chunks:
+            yield sse_event('token', {'text': text})
+        yield sse_event('done', {})
+    except Exception as e:
+        print(f"Chat Stream Error: {e}")
+        yield sse_event('error', {'reply': CHAT_ERROR_REPLY})
+    finally:
+        chunks.close()
+
+class ChatStreamView(APIView):
+    """ChatView with the reply streamed as server-sent events (token, then done or error)."""
+
+    def post(self, request, *args, **kwargs):
+        message = request.data.get('message')
+        metrics = request.data.get('image_metrics')
+
+        if not message:
+            return Response({'error': 'No message provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            model = get_model()
+        except GeminiNotConfigured as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return _sse_response(_chat_events(stream_chat(chat_prompt(message, metrics), model)))
+
+class StatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'batching': batching_stats(),
+            'prediction_cache': prediction_cache.stats(),
+            'models': ModelLoader().stats(),
+            'encoding': encoder_timings.stats(),
+            'gemini_cache': report_cache.stats(),
+            'chat_stream': stream_stats.stats(),
+            'result_store': result_store.stats(),
+            'inference_server': inference_server_stats(),
+        })
+
+class MetricsView(APIView):
+    """Per-stage latency summaries, counters and gauges in the Prometheus text format."""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+class ProfileListView(APIView):
+    """Stored request profiles, newest first. Admin only."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response({'profiles': list_profiles()})
+
+class ProfileDownloadView(APIView):
+    """
+    Downloads one profile as a pstats file (load with pstats.Stats or snakeviz),
+    or its TensorFlow trace as a zip with ?part=trace. Admin only.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, profile_id, *args, **kwargs):
+        if request.query_params.get('part') == 'trace':
+            archive = trace_archive(profile_id)
+            if archive is None:
+                return Response({'error': 'No trace for this profile'}, status=status.HTTP_404_NOT_FOUND)
+            response = HttpResponse(archive, content_type='application/zip')
+            response['Content-Disposition'] = f'attachment; filename="{profile_id}-tf.zip"'
+            return response
+
+        path = profile_path(profile_id)
+        if path is None:
+            return Response({'error': 'Profile not found'}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=f"{profile_id}.prof",
+                            content_type='application/octet-stream')
+
+class ReadinessView(APIView):
+    """Healthy (200) only once the opt-in startup warm-up has finished without errors."""
+
+    def get(self, request, *args, **kwargs):
+        snapshot = warmup_state.snapshot()
+        code = status.HTTP_200_OK if snapshot['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE
+        return Response(snapshot, status=code)
+
+class JobSubmitView(APIView):
+    """Queues a predict/mitigate run on the worker pool and returns its job id immediately."""
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        file_obj = request.data.get('file')
+        model_type = request.data.get('model_type', 'v2')
+        kind = request.data.get('kind', AnalysisJob.KIND_PREDICT)
+
+        if not file_obj:
+            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if kind not in dict(AnalysisJob.KIND_CHOICES):
+            return Response({'error': f'Unknown job kind {kind}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            job = submit_job(file_obj, kind, model_type, tiled=_flag(request, 'tiled'))
+            return Response(job.as_status_dict(), status=status.HTTP_202_ACCEPTED)
+        except Exception as e:
+            print(f"Job Submit Error: {e}")
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class JobStatusView(APIView):
+    def get(self, request, job_id, *args, **kwargs):
+        job = AnalysisJob.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        recover_orphaned_job(job)
+        return Response(job.as_status_dict())
+
+class JobResultView(APIView):
+    def get(self, request, job_id, *args, **kwargs):
+        job = AnalysisJob.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        recover_orphaned_job(job)
+        if job.status == AnalysisJob.STATUS_SUCCEEDED:
+            return Response(job.result)
+        if job.is_finished:
+            return Response(job.as_status_dict(), status=status.HTTP_409_CONFLICT)
+        # Still queued or running
+        return Response(job.as_status_dict(), status=status.HTTP_202_ACCEPTED)
+
+class JobCancelView(APIView):
+    def post(self, request, job_id, *args, **kwargs):
+        job = AnalysisJob.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not cancel_job(job):
+            job.refresh_from_db()
+            return Response(job.as_status_dict(), status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(job.as_status_dict())
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+class HistoryListView(APIView):
+    """
+    Past analyses from the result store, newest first, without recomputing anything.
+    Filters: ?model_type=, ?digest= (SHA-256 of the upload), ?has_shadow=true|false. Paging: ?limit=, ?offset=.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.query_params.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+            offset = max(int(request.query_params.get('offset', 0)), 0)
+        except ValueError:
+            return Response({'error': 'limit and offset must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        entries = AnalysisResult.objects.all()
+        for field in ('model_type', 'digest'):
+            if request.query_params.get(field):
+                entries = entries.filter(**{field: request.query_params[field]})
+        if request.query_params.get('has_shadow'):
+            entries = entries.filter(has_shadow=request.query_params['has_shadow'].lower() in ('1', 'true', 'yes'))
+
+        return Response({
+            'count': entries.count(),
+            'results': [entry.as_history_dict() for entry in entries[offset:offset + max(limit, 0)]],
+        })
+
+class HistoryDetailView(APIView):
+    """
+    One stored analysis: the /predict/ body from the stored images or, for entries without
+    images (e.g. only ever mitigated), the metadata plus the run-length-encoded mask.
+    """
+
+    def get(self, request, result_id, *args, **kwargs):
+        entry = AnalysisResult.objects.filter(pk=result_id).first()
+        if entry is None:
+            return Response({'error': 'Analysis not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        images = result_store.entry_images(entry)
+        if images is not None:
+            return Response(dict(entry.as_history_dict(), **predict_body(images, entry.percentages, entry.model_type)))
+        try:
+            mask_rle = rle_encode(result_store.entry_mask(entry))
+        except OSError:
+            return Response({'error': 'Stored result is no longer available'}, status=status.HTTP_410_GONE)
+        return Response(dict(entry.as_history_dict(), mask_rle=mask_rle))
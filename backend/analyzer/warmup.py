@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from .batching import MAX_BATCH_SIZE
+
+
+# --- WARM-UP CONFIGURATION ---
+# MODEL_PRELOAD=v1,v2,v3 loads those models at startup. Empty (default) keeps lazy loading.
+PRELOAD_MODELS = [k.strip() for k in os.getenv('MODEL_PRELOAD', '').split(',') if k.strip()]
+# Batch sizes to trace during warm-up; defaults to single requests and a full micro-batch
+WARMUP_BATCH_SIZES = sorted({
+    int(b) for b in os.getenv('MODEL_WARMUP_BATCH_SIZES', f"1,{MAX_BATCH_SIZE}").split(',') if b.strip()
+})
+INPUT_SHAPE = (256, 256, 8)
+
+
+class WarmupState:
+    """Tracks startup warm-up so the readiness endpoint can report on it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.finished = False
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}  # model_key -> {'load_seconds': .., 'batches': {size: seconds}}
+        self.errors = {}
+
+    @property
+    def ready(self):
+        with self._lock:
+            return (not self.enabled) or (self.finished and not self.errors)
+
+    def snapshot(self):
+        with self._lock:
+            total = None
+            if self.started_at is not None and self.finished_at is not None:
+                total = self.finished_at - self.started_at
+            return {
+                'ready': (not self.enabled) or (self.finished and not self.errors),
+                'warmup_enabled': self.enabled,
+                'warmup_finished': self.finished,
+                'warmup_seconds': total,
+                'models': {k: dict(v) for k, v in self.timings.items()},
+                'errors': dict(self.errors),
+            }
+
+
+warmup_state = WarmupState()
+
+
+def warm_up_model(model_key, batch_sizes=WARMUP_BATCH_SIZES):
+    """Loads a model and runs one dummy batch per served batch size so graph tracing happens now."""
+    from .model_loader import ModelLoader
+
+    started = time.perf_counter()
+    model = ModelLoader().load_model(model_key)
+    if model is None:
+        raise RuntimeError(f"Model {model_key} could not be loaded")
+    timings = {'load_seconds': time.perf_counter() - started, 'batches': {}}
+
+    for size in batch_sizes:
+        dummy = np.zeros((size,) + INPUT_SHAPE, dtype=np.float32)
+        batch_started = time.perf_counter()
+        model.predict(dummy, verbose=0)
+        timings['batches'][size] = time.perf_counter() - batch_started
+
+    return timings
+
+
+def run_warmup(model_keys=None, batch_sizes=WARMUP_BATCH_SIZES):
+    model_keys = PRELOAD_MODELS if model_keys is None else model_keys
+    with warmup_state._lock:
+        warmup_state.enabled = True
+        warmup_state.finished = False
+        warmup_state.started_at = time.perf_counter()
+
+    for model_key in model_keys:
+        try:
+            timings = warm_up_model(model_key, batch_sizes)
+            with warmup_state._lock:
+                warmup_state.timings[model_key] = timings
+            print(f"Warm-up of {model_key} finished: {timings}")
+        except Exception as e:
+            print(f"Warm-up of {model_key} failed: {e}")
+            with warmup_state._lock:
+                warmup_state.errors[model_key] = str(e)
+
+    with warmup_state._lock:
+        warmup_state.finished = True
+        warmup_state.finished_at = time.perf_counter()
+
+
+def start_warmup():
+    """Kicks off warm-up in a background thread so the server can bind and answer readiness probes."""
+    if not PRELOAD_MODELS:
+        return None
+    warmup_state.enabled = True
+    thread = threading.Thread(target=run_warmup, name='model-warmup', daemon=True)
+    thread.start()
+    return thread
@@ -59,6 +59,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'analyzer.profiling.ProfilingMiddleware', # Opt-in via PROFILING_ENABLED
 ]
 
 CORS_ALLOW_ALL_ORIGINS = True
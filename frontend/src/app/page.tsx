@@ -16,6 +16,7 @@ export default function Home() {
 
   const [currentFile, setCurrentFile] = useState<File | null>(null);
   const [mitigatedImage, setMitigatedImage] = useState<string | null>(null);
+  const [mitigatedFormat, setMitigatedFormat] = useState<string | undefined>(undefined);
   const [solarHeatmap, setSolarHeatmap] = useState<string | null>(null);
   const [isMitigating, setIsMitigating] = useState(false);
 
@@ -109,6 +110,7 @@ export default function Home() {
 
       const data = await response.json();
       setMitigatedImage(data.mitigated_image);
+      setMitigatedFormat(data.image_format);
 
     } catch (error) {
       console.error("Error mitigating shadows:", error);
@@ -205,6 +207,9 @@ export default function Home() {
             maskImage={analysisResult.mask}
             mitigatedImage={mitigatedImage}
             solarHeatmap={solarHeatmap}
+            imageFormat={analysisResult.image_format}
+            maskFormat={analysisResult.mask_format}
+            mitigatedFormat={mitigatedFormat}
             percentages={analysisResult.percentages}
             hasShadow={analysisResult.has_shadow}
             geminiAnalysis={geminiAnalysis}
@@ -10,11 +10,18 @@ import WeatherCard from './WeatherCard';
 
 ChartJS.register(ArcElement, Tooltip, Legend);
 
+const dataUrl = (base64: string, mime: string) => `data:${mime};base64,${base64}`;
+const extension = (mime: string) => (mime === 'image/webp' ? 'webp' : 'png');
+
 interface ResultsDashboardProps {
     originalImage: string | null;
     maskImage: string | null;
     mitigatedImage?: string | null;
     solarHeatmap?: string | null;
+    // Mime types of the base64 images, from the image_format / mask_format fields of the API
+    imageFormat?: string;
+    maskFormat?: string;
+    mitigatedFormat?: string;
     percentages: {
         Clear: number;
         Shadow: number;
@@ -32,6 +39,9 @@ export default function ResultsDashboard({
     maskImage,
     mitigatedImage,
     solarHeatmap,
+    imageFormat = 'image/png',
+    maskFormat = 'image/png',
+    mitigatedFormat = 'image/png',
     percentages,
     hasShadow,
     geminiAnalysis,
@@ -108,29 +118,29 @@ export default function ResultsDashboard({
         // Also download images
         if (maskImage) {
             const aMask = document.createElement('a');
-            aMask.href = `data:image/png;base64,${maskImage}`;
-            aMask.download = 'segmentation_mask.png';
+            aMask.href = dataUrl(maskImage, maskFormat);
+            aMask.download = `segmentation_mask.${extension(maskFormat)}`;
             aMask.click();
         }
 
         if (originalImage) {
             const aOriginal = document.createElement('a');
             aOriginal.href = originalImage;
-            aOriginal.download = 'original_image.png';
+            aOriginal.download = `original_image.${extension(imageFormat)}`;
             aOriginal.click();
         }
 
         if (mitigatedImage) {
             const aMitigated = document.createElement('a');
-            aMitigated.href = `data:image/png;base64,${mitigatedImage}`;
-            aMitigated.download = 'mitigated_image.png';
+            aMitigated.href = dataUrl(mitigatedImage, mitigatedFormat);
+            aMitigated.download = `mitigated_image.${extension(mitigatedFormat)}`;
             aMitigated.click();
         }
 
         if (solarHeatmap) {
             const aSolar = document.createElement('a');
-            aSolar.href = `data:image/png;base64,${solarHeatmap}`;
-            aSolar.download = 'solar_potential_map.png';
+            aSolar.href = dataUrl(solarHeatmap, imageFormat);
+            aSolar.download = `solar_potential_map.${extension(imageFormat)}`;
             aSolar.click();
         }
     };
@@ -192,9 +202,9 @@ export default function ResultsDashboard({
                     <h3 className="text-lg font-medium text-gray-300 mb-3">{showSolarMap ? 'Solar Potential Heatmap' : 'Segmentation Mask'}</h3>
                     <div className="relative aspect-square rounded-lg overflow-hidden bg-slate-900">
                         {showSolarMap && solarHeatmap ? (
-                            <Image src={`data:image/png;base64,${solarHeatmap}`} alt="Solar Map" fill className="object-cover" />
+                            <Image src={dataUrl(solarHeatmap, imageFormat)} alt="Solar Map" fill className="object-cover" />
                         ) : maskImage ? (
-                            <Image src={`data:image/png;base64,${maskImage}`} alt="Mask" fill className="object-cover" />
+                            <Image src={dataUrl(maskImage, maskFormat)} alt="Mask" fill className="object-cover" />
                         ) : (
                             <div className="flex items-center justify-center h-full text-gray-500 text-sm">No data generated</div>
                         )}
@@ -221,7 +231,7 @@ export default function ResultsDashboard({
                     <h3 className="text-lg font-medium text-gray-300 mb-3">Mitigated Output</h3>
                     <div className="relative aspect-square rounded-lg overflow-hidden bg-slate-900 flex items-center justify-center">
                         {mitigatedImage ? (
-                            <Image src={`data:image/png;base64,${mitigatedImage}`} alt="Mitigated" fill className="object-cover" />
+                            <Image src={dataUrl(mitigatedImage, mitigatedFormat)} alt="Mitigated" fill className="object-cover" />
                         ) : (
                             <div className="text-center p-6">
                                 <p className="text-gray-500 text-sm">Mitigation not applied</p>